@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2013, GEM Foundation.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/agpl.html>.
+
+"""
+Batch exports: the building exposure of several areas in one request (see
+:func:`exposure.views.export_building_batch`).
+
+The areas are exported with a single query (see
+:func:`exposure.util.batch_area`), so the grid points where they overlap are
+read once. Each row comes with the set of areas it belongs to, and
+:func:`split` deals the rows out to one output file per area.
+"""
+
+import cPickle
+import tempfile
+
+from django.utils import simplejson
+
+from exposure import util
+
+
+def parse_areas(text):
+    """
+    Parse the areas of a batch export.
+
+    :param str text:
+        A JSON list of areas: bounding boxes, as [lng1, lat1, lng2, lat2]
+        lists, and polygons, as WKT strings or GeoJSON geometries (see
+        :func:`exposure.util.parse_polygon`).
+    :returns:
+        The area to pass to the export queries (see
+        :func:`exposure.util.batch_area`).
+    :raises ValueError:
+        If the areas are not valid.
+    """
+    try:
+        items = simplejson.loads(text)
+    except ValueError:
+        raise ValueError('Invalid export areas')
+    if not isinstance(items, list):
+        raise ValueError('The export areas must be a JSON list')
+
+    areas = []
+    for item in items:
+        if isinstance(item, list):
+            if len(item) != 4:
+                raise ValueError('Bounding boxes must be [lng1, lat1, lng2, '
+                                 'lat2] lists')
+            areas.append(util.bbox_area(*item))
+        elif isinstance(item, dict):
+            areas.append(util.parse_polygon(simplejson.dumps(item)))
+        elif isinstance(item, basestring):
+            areas.append(util.parse_polygon(item))
+        else:
+            raise ValueError('Invalid export area %r' % (item, ))
+    return util.batch_area(areas)
+
+
+def split(rows, count):
+    """
+    Deal out the rows of a batch export query to its areas.
+
+    The rows of the first area are streamed as the query is read. The rows of
+    the other areas are spooled to temporary files in the meantime, so they
+    can only be read once the first iterator has been exhausted (as when
+    writing one file after the other into an archive).
+
+    :param rows:
+        The rows of the query, each ending with the bit mask of its areas
+        (see :func:`exposure.util._area_members`).
+    :param int count:
+        Number of areas of the batch.
+    :returns:
+        A list of iterators over the rows of each area, without the bit mask.
+    """
+    spools = [tempfile.TemporaryFile() for _ in xrange(count - 1)]
+    return ([_deal(rows, spools)]
+            + [_read_spool(spool) for spool in spools])
+
+
+def _deal(rows, spools):
+    buffers = [[] for _ in spools]
+    try:
+        for row in rows:
+            members = row[-1]
+            row = row[:-1]
+            if members & 1:
+                yield row
+            members >>= 1
+            i = 0
+            while members:
+                if members & 1:
+                    buffers[i].append(row)
+                    if len(buffers[i]) >= util.EXPORT_FETCH_SIZE:
+                        _dump(spools[i], buffers[i])
+                        buffers[i] = []
+                members >>= 1
+                i += 1
+    finally:
+        for spool, buffer_ in zip(spools, buffers):
+            if buffer_:
+                _dump(spool, buffer_)
+
+
+def _dump(spool, rows):
+    cPickle.dump(rows, spool, cPickle.HIGHEST_PROTOCOL)
+
+
+def _read_spool(spool):
+    try:
+        spool.seek(0)
+        while True:
+            try:
+                rows = cPickle.load(spool)
+            except EOFError:
+                return
+            for row in rows:
+                yield row
+    finally:
+        spool.close()
@@ -0,0 +1,504 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2013, GEM Foundation.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/agpl.html>.
+
+"""
+Offline benchmarks for the exposure export pipeline.
+
+No database is needed: the export generators are fed synthetic rows shaped
+like the results of the queries in :mod:`exposure.util`. The parallel query
+benchmark can also be run against the GED database, with `--bbox`. See
+`run-exposure-benchmarks.sh` for how to run them.
+
+The `serializers` benchmark runs every export generator, and can be used as
+a regression gate: save its results with `--save`, and compare later runs
+against them with `--baseline`. The run fails if a generator got slower, or
+uses more memory, than the baseline allows.
+
+The `precision` benchmark compares the CPU time and output size of the CSV
+and NRML export generators writing the `str` of the numbers, and writing
+them with a fixed number of decimals (see
+:data:`exposure.views.POPULATION_DECIMALS`).
+"""
+
+import argparse
+import itertools
+import math
+import os
+import random
+import resource
+import sys
+import time
+import traceback
+
+from django.utils import simplejson
+
+from exposure import columnar
+from exposure import util
+from exposure import views
+
+#: Number of distinct synthetic rows, cycled through to produce larger
+#: inputs, so that generating the input costs (almost) nothing.
+_ROW_POOL_SIZE = 10000
+
+
+def _synthetic_pop_rows(count):
+    """
+    Generate rows shaped like the results of
+    :func:`exposure.util._get_population_exposure`.
+    """
+    rnd = random.Random(count)
+    for i in xrange(count):
+        yield (i, 8.1 + rnd.random(), 45.2 + rnd.random(),
+               rnd.random() * 1000, 'ITA')
+
+
+_TAXONOMIES = ['MUR/LWAL/HEX:1', 'CR/LFINF/HEX:3', 'W/LWAL/HEX:2',
+               'S/LFM/HEX:5', 'MUR+ADO/LWAL/HEX:1', 'UNK']
+
+
+def _synthetic_national_rows(count, tod):
+    """
+    Generate rows shaped like the results of
+    :func:`exposure.util._get_national_exposure`, with the time of day
+    ratios of `tod` ('off' or 'all').
+    """
+    rnd = random.Random(1)
+    pool = []
+    for i in xrange(min(count, _ROW_POOL_SIZE)):
+        if tod == 'all':
+            ratios = (rnd.random(), rnd.random(), rnd.random())
+        else:
+            ratios = (None, None, None)
+        pool.append((i, 88.1 + rnd.random(), 22.2 + rnd.random(),
+                     rnd.random() * 1000, 19, 'BGD', 1 + i % 7,
+                     _TAXONOMIES[i % len(_TAXONOMIES)], rnd.random())
+                    + ratios)
+    return itertools.islice(itertools.cycle(pool), count)
+
+
+def _synthetic_subnat_rows(count):
+    """
+    Generate rows shaped like the results of
+    :func:`exposure.util._get_subnational_exposure`.
+    """
+    return (row[:9] for row in _synthetic_national_rows(count, 'off'))
+
+
+def _synthetic_aggregated_rows(count):
+    """
+    Generate rows shaped like the results of
+    :func:`exposure.util._get_aggregated_exposure`: one row per region and
+    building type.
+    """
+    rnd = random.Random(2)
+    pool = []
+    for i in xrange(min(count, _ROW_POOL_SIZE)):
+        pool.append((1000 + i // len(_TAXONOMIES), 'BGD',
+                     _TAXONOMIES[i % len(_TAXONOMIES)],
+                     rnd.random() * 100000, 88.1 + rnd.random(),
+                     22.2 + rnd.random(), rnd.randint(1, 5000)))
+    return itertools.islice(itertools.cycle(pool), count)
+
+
+def _synthetic_pop_pool(count):
+    return itertools.islice(
+        itertools.cycle(list(_synthetic_pop_rows(min(count, _ROW_POOL_SIZE)))),
+        count
+    )
+
+
+#: (name, export generator, synthetic rows) of each export generator.
+SERIALIZERS = [
+    ('bldg_csv_admin0', views._bldg_csv_admin0_generator,
+     lambda n: _synthetic_national_rows(n, 'off')),
+    ('bldg_csv_admin0_tod', views._bldg_csv_admin0_generator,
+     lambda n: _synthetic_national_rows(n, 'all')),
+    ('bldg_nrml_admin0', views._bldg_nrml_admin0_generator,
+     lambda n: _synthetic_national_rows(n, 'off')),
+    ('bldg_nrml_admin0_tod', views._bldg_nrml_admin0_generator,
+     lambda n: _synthetic_national_rows(n, 'all')),
+    ('bldg_csv_subnat', views._bldg_csv_subnat_generator,
+     _synthetic_subnat_rows),
+    ('bldg_nrml_subnat', views._bldg_nrml_subnat_generator,
+     _synthetic_subnat_rows),
+    ('bldg_csv_aggregate', views._bldg_csv_aggregate_generator,
+     _synthetic_aggregated_rows),
+    ('bldg_nrml_aggregate', views._bldg_nrml_aggregate_generator,
+     _synthetic_aggregated_rows),
+    ('pop_csv', views._pop_csv_generator, _synthetic_pop_pool),
+    ('pop_nrml', views._pop_nrml_generator, _synthetic_pop_pool),
+]
+if columnar.available():
+    SERIALIZERS.extend([
+        ('bldg_npz_admin0_tod', columnar.bldg_admin0_generator,
+         lambda n: _synthetic_national_rows(n, 'all')),
+        ('bldg_npz_subnat', columnar.bldg_subnat_generator,
+         _synthetic_subnat_rows),
+        ('pop_npz', columnar.pop_generator, _synthetic_pop_pool),
+    ])
+
+
+def _max_rss():
+    # Kilobytes, on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _run_serializer(generator, rows_func, rows):
+    """
+    Drain an export generator fed with `rows` synthetic rows.
+
+    :returns:
+        A `dict` with the 'seconds' (and 'cpu_seconds') it took, the number
+        of 'bytes' produced and the 'peak_memory' of the process (in bytes).
+    """
+    start = time.time()
+    cpu_start = _cpu_time()
+    nbytes = 0
+    for chunk in generator(rows_func(rows)):
+        nbytes += len(chunk)
+    return dict(seconds=time.time() - start,
+                cpu_seconds=_cpu_time() - cpu_start, bytes=nbytes,
+                peak_memory=_max_rss())
+
+
+def bench_serializer(generator, rows_func, rows):
+    """
+    Run :func:`_run_serializer` in a child process, so that the peak memory
+    is the one of this generator alone.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            result = _run_serializer(generator, rows_func, rows)
+            os.write(write_fd, simplejson.dumps(result))
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as fh:
+        data = fh.read()
+    os.waitpid(pid, 0)
+    if not data:
+        raise RuntimeError('The benchmark process failed')
+    result = simplejson.loads(data)
+    result.update(rows=rows,
+                  rows_per_sec=rows / result['seconds'],
+                  bytes_per_sec=result['bytes'] / result['seconds'])
+    return result
+
+
+def bench_precision(generator, rows_func, rows, population_decimals,
+                    coordinate_decimals):
+    """
+    Compare an export generator writing the `str` of the numbers with it
+    writing them with fixed numbers of decimals.
+
+    :returns:
+        The results of :func:`bench_serializer` for the 'str' and the
+        'fixed' precision.
+    """
+    saved = views.POPULATION_DECIMALS, views.COORDINATE_DECIMALS
+    results = []
+    try:
+        for label, decimals in (
+                ('str', (None, None)),
+                ('fixed', (population_decimals, coordinate_decimals))):
+            # Inherited by the benchmark process.
+            views.POPULATION_DECIMALS, views.COORDINATE_DECIMALS = decimals
+            results.append((label, bench_serializer(generator, rows_func,
+                                                    rows)))
+    finally:
+        views.POPULATION_DECIMALS, views.COORDINATE_DECIMALS = saved
+    return results
+
+
+def check_regressions(results, baseline, tolerance):
+    """
+    Compare serializer benchmark results with a baseline.
+
+    :param dict results:
+        Results by "name/rows" key, as returned by :func:`bench_serializer`.
+    :param dict baseline:
+        Results of an earlier run, in the same format.
+    :param float tolerance:
+        Allowed slowdown (or memory increase), as a fraction.
+    :returns:
+        A list of messages, one for each regression.
+    """
+    regressions = []
+    for key, result in sorted(results.iteritems()):
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if result['rows_per_sec'] < base['rows_per_sec'] * (1 - tolerance):
+            regressions.append('%s: %.0f rows/s, baseline %.0f rows/s' % (
+                key, result['rows_per_sec'], base['rows_per_sec']))
+        if result['peak_memory'] > base['peak_memory'] * (1 + tolerance):
+            regressions.append('%s: peak memory %.1f MB, baseline %.1f MB' % (
+                key, result['peak_memory'] / 2.0 ** 20,
+                base['peak_memory'] / 2.0 ** 20))
+    return regressions
+
+
+class _WsgiSink(object):
+    """
+    Mimic a WSGI server writing a response body to a socket: each chunk
+    received costs one unbuffered ``write`` system call.
+    """
+
+    def __init__(self):
+        self.fd = os.open(os.devnull, os.O_WRONLY)
+        self.writes = 0
+        self.bytes = 0
+
+    def write(self, data):
+        os.write(self.fd, data)
+        self.writes += 1
+        self.bytes += len(data)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _drain(chunks):
+    sink = _WsgiSink()
+    start = time.time()
+    try:
+        for chunk in chunks:
+            sink.write(chunk)
+    finally:
+        sink.close()
+    return time.time() - start, sink.writes, sink.bytes
+
+
+class _SyntheticQuery(object):
+    """
+    Stand-in for the population export query over a square bounding box,
+    which holds `rows` evenly spread grid points. Each batch of
+    :data:`exposure.util.EXPORT_FETCH_SIZE` rows costs `latency` seconds,
+    spent waiting as for a database round trip.
+    """
+
+    __name__ = '_get_population_exposure'
+
+    def __init__(self, rows, latency):
+        self.side = int(rows ** 0.5)
+        self.latency = latency
+
+    def __call__(self, lng1, lat1, lng2, lat2):
+        lng1, lat1, lng2, lat2 = [float(x) for x in (lng1, lat1, lng2, lat2)]
+        step = 1.0 / self.side
+        batch = 0
+        i_range = xrange(max(0, int(math.ceil(lng1 / step))),
+                         min(self.side, int(math.floor(lng2 / step)) + 1))
+        j_range = xrange(max(0, int(math.ceil(lat1 / step))),
+                         min(self.side, int(math.floor(lat2 / step)) + 1))
+        # Ids run along rows of latitude, as in the GED grid.
+        for j in j_range:
+            for i in i_range:
+                batch += 1
+                if batch == util.EXPORT_FETCH_SIZE:
+                    time.sleep(self.latency)
+                    batch = 0
+                yield (j * self.side + i, i * step, j * step, 100.0, 'ITA')
+
+
+def bench_parallel(query_func, bbox, workers):
+    """
+    Compare running an export query as a single query with running it on
+    sub-boxes, in parallel (see :func:`exposure.util.get_exposure`).
+    """
+    results = []
+    for label, n in (('single', 1), ('parallel', workers)):
+        start = time.time()
+        count = 0
+        for _ in util.get_exposure(query_func, *bbox, workers=n):
+            count += 1
+        results.append((label, time.time() - start, count))
+    return results
+
+
+def bench_coalesce(rows, chunk_size):
+    """
+    Compare writing the population CSV export one row at a time with writing
+    it through :func:`exposure.util.coalesce`.
+    """
+    results = []
+    for label, make_chunks in (
+            ('per-row', lambda: views._pop_csv_generator(
+                _synthetic_pop_rows(rows))),
+            ('coalesced', lambda: util.coalesce(
+                views._pop_csv_generator(_synthetic_pop_rows(rows)),
+                chunk_size=chunk_size))):
+        elapsed, writes, nbytes = _drain(make_chunks())
+        results.append((label, elapsed, writes, nbytes))
+    return results
+
+
+def _main_coalesce(args):
+    print 'coalesce: %d rows, chunk size %d bytes' % (args.rows,
+                                                      args.chunk_size)
+    for label, elapsed, writes, nbytes in bench_coalesce(args.rows,
+                                                          args.chunk_size):
+        print '  %-10s %8.3fs %10d writes %12.0f rows/s %8.1f MB/s' % (
+            label, elapsed, writes, args.rows / elapsed,
+            nbytes / elapsed / 2 ** 20)
+
+
+def _main_parallel(args):
+    if args.bbox:
+        query_func = util._get_population_exposure
+        bbox = args.bbox.split(',')
+        print 'parallel query: population, bbox %s' % args.bbox
+    else:
+        query_func = _SyntheticQuery(args.rows, args.latency)
+        bbox = (0, 0, 1, 1)
+        print 'parallel query: %d rows, %.3fs per batch of %d rows' % (
+            args.rows, args.latency, util.EXPORT_FETCH_SIZE)
+    # Make sure the area is large enough to be split.
+    util.PARALLEL_QUERY_MIN_AREA_SQ_DEG = 0
+    for label, elapsed, count in bench_parallel(query_func, bbox,
+                                                args.workers):
+        print '  %-10s %8.3fs %10d rows %12.0f rows/s' % (
+            label, elapsed, count, count / elapsed)
+
+
+def _main_serializers(args):
+    sizes = [int(float(x)) for x in args.sizes.split(',')]
+    results = dict()
+    print '%-22s %10s %9s %12s %10s %10s' % (
+        'serializer', 'rows', 'time', 'rows/s', 'MB/s', 'peak MB')
+    for name, generator, rows_func in SERIALIZERS:
+        if args.only and args.only not in name:
+            continue
+        for rows in sizes:
+            result = bench_serializer(generator, rows_func, rows)
+            results['%s/%d' % (name, rows)] = result
+            print '%-22s %10d %8.2fs %12.0f %10.1f %10.1f' % (
+                name, rows, result['seconds'], result['rows_per_sec'],
+                result['bytes_per_sec'] / 2 ** 20,
+                result['peak_memory'] / 2.0 ** 20)
+            sys.stdout.flush()
+
+    if args.save:
+        with open(args.save, 'w') as fh:
+            simplejson.dump(results, fh, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = simplejson.load(fh)
+        regressions = check_regressions(results, baseline, args.tolerance)
+        for msg in regressions:
+            print 'REGRESSION %s' % msg
+        if regressions:
+            sys.exit(1)
+
+
+def _main_precision(args):
+    print ('precision: %d rows, %d population decimals, %d coordinate '
+           'decimals' % (args.rows, args.population_decimals,
+                         args.coordinate_decimals))
+    print '%-22s %9s %9s %7s %10s %10s %7s' % (
+        'serializer', 'str CPU', 'fixed CPU', 'saved', 'str MB', 'fixed MB',
+        'saved')
+    for name, generator, rows_func in SERIALIZERS:
+        if 'npz' in name or (args.only and args.only not in name):
+            continue
+        [(_, base), (_, fixed)] = bench_precision(
+            generator, rows_func, args.rows, args.population_decimals,
+            args.coordinate_decimals
+        )
+        print '%-22s %8.2fs %8.2fs %6.1f%% %10.1f %10.1f %6.1f%%' % (
+            name, base['cpu_seconds'], fixed['cpu_seconds'],
+            100 * (1 - fixed['cpu_seconds'] / base['cpu_seconds']),
+            base['bytes'] / 2.0 ** 20, fixed['bytes'] / 2.0 ** 20,
+            100 * (1 - float(fixed['bytes']) / base['bytes']))
+        sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers()
+
+    coalesce = subparsers.add_parser(
+        'coalesce', help='per-row vs. coalesced writes of an export'
+    )
+    coalesce.add_argument('--rows', type=int, default=1000000)
+    coalesce.add_argument('--chunk-size', type=int,
+                          default=util.EXPORT_CHUNK_SIZE)
+    coalesce.set_defaults(func=_main_coalesce)
+
+    parallel = subparsers.add_parser(
+        'parallel', help='single vs. parallel export queries'
+    )
+    parallel.add_argument('--rows', type=int, default=1000000)
+    parallel.add_argument('--workers', type=int, default=4,
+                          help='number of sub-boxes of the parallel queries')
+    parallel.add_argument('--latency', type=float, default=0.01,
+                          help='database time (in seconds) per batch of the '
+                               'synthetic query')
+    parallel.add_argument('--bbox',
+                          help='run on the GED database instead, for this '
+                               'lng1,lat1,lng2,lat2 bounding box')
+    parallel.set_defaults(func=_main_parallel)
+
+    serializers = subparsers.add_parser(
+        'serializers', help='throughput and peak memory of every export '
+                            'generator'
+    )
+    serializers.add_argument('--sizes', default='1e4,1e6,1e7',
+                             help='comma separated numbers of rows')
+    serializers.add_argument('--only',
+                             help='only run the generators whose name '
+                                  'contains this')
+    serializers.add_argument('--save', help='save the results to this file')
+    serializers.add_argument('--baseline',
+                             help='fail if the results are worse than the '
+                                  'ones saved in this file')
+    serializers.add_argument('--tolerance', type=float, default=0.2,
+                             help='allowed slowdown or memory increase, '
+                                  'compared to the baseline (default: 0.2)')
+    serializers.set_defaults(func=_main_serializers)
+
+    precision = subparsers.add_parser(
+        'precision', help='CPU time and size of the CSV and NRML exports, '
+                          'with and without fixed-precision numbers'
+    )
+    precision.add_argument('--rows', type=int, default=1000000)
+    precision.add_argument('--population-decimals', type=int, default=2)
+    precision.add_argument('--coordinate-decimals', type=int, default=5)
+    precision.add_argument('--only',
+                           help='only run the generators whose name '
+                                'contains this')
+    precision.set_defaults(func=_main_precision)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
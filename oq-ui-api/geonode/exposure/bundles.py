@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2013, GEM Foundation.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/agpl.html>.
+
+"""
+Pre-generated, gzipped admin level 0 building exports of whole countries.
+
+Whole-country exports (an 'admin0' region, see
+:func:`exposure.views._get_export_area`) are the same for every user until
+the GED data is reloaded. The `build_exposure_bundles` management command
+writes them to :data:`BUNDLE_DIR`, one file per country, output type,
+occupancy and time of day, and :func:`exposure.views.export_building` sends
+them as they are, with a gzip 'Content-Encoding'.
+
+Behind nginx, set :data:`BUNDLE_ACCEL_REDIRECT` to let nginx send them
+instead: the response then only holds an `X-Accel-Redirect` header,
+pointing to an internal nginx location which serves :data:`BUNDLE_DIR`, to
+add to the configuration of the site::
+
+    location /exposure_bundles/ {
+        internal;
+        alias /var/lib/openquake/exposure_bundles/;
+        add_header Content-Encoding gzip;
+        add_header Vary Accept-Encoding;
+    }
+
+Bundles are only used if :data:`BUNDLE_DIR` is set, and for clients which
+accept gzip. Exports without a bundle are streamed as usual.
+"""
+
+import os
+import shutil
+import uuid
+
+from django.conf import settings
+
+from exposure import compression
+from exposure import util
+
+#: Directory of the bundles. `None` disables them.
+BUNDLE_DIR = getattr(settings, 'EXPOSURE_BUNDLE_DIR', None)
+#: Let nginx send the bundles, from the internal location at
+#: :data:`BUNDLE_URL`. Off by default, since the platform is served by
+#: Apache, which ignores `X-Accel-Redirect`: the web workers send them.
+BUNDLE_ACCEL_REDIRECT = getattr(settings, 'EXPOSURE_BUNDLE_ACCEL_REDIRECT',
+                                False)
+#: URL of the internal nginx location serving :data:`BUNDLE_DIR`.
+BUNDLE_URL = getattr(settings, 'EXPOSURE_BUNDLE_URL', '/exposure_bundles/')
+
+OUTPUT_TYPES = ('csv', 'nrml')
+RESIDENTIAL = ('res', 'non-res', 'both')
+TIMES_OF_DAY = ('day', 'night', 'transit', 'all', 'off')
+
+_EXTENSIONS = dict(csv='csv', nrml='xml')
+
+
+def enabled():
+    """
+    :returns:
+        `True` if the bundles are configured.
+    """
+    return BUNDLE_DIR is not None
+
+
+def _bundle_name(country_id, output_type, residential, tod):
+    return '%s/%s_%s.%s.gz' % (country_id, residential, tod,
+                               _EXTENSIONS[output_type])
+
+
+def find(params):
+    """
+    Find the bundle of an export.
+
+    :param params:
+        The parameters of :func:`exposure.views.export_building`, as a
+        `dict`.
+    :returns:
+        The path of the bundle, relative to :data:`BUNDLE_DIR` (and to
+        :data:`BUNDLE_URL`), or `None` if the export has no bundle.
+    """
+    if not enabled():
+        return None
+    if (params.get('adminLevel') != 'admin0'
+            or params.get('regionLevel', 'admin0') != 'admin0'
+            or params.get('polygon') or params.get('aggregate')
+            or 'taxonomy' in params
+            or params.get('order', 'id') != 'id'
+            or params.get('outputType') not in OUTPUT_TYPES
+            or params.get('residential') not in RESIDENTIAL
+            or params.get('timeOfDay') not in TIMES_OF_DAY):
+        return None
+    try:
+        country_id = int(params.get('regionId'))
+    except (TypeError, ValueError):
+        return None
+
+    name = _bundle_name(country_id, params['outputType'],
+                        params['residential'], params['timeOfDay'])
+    if not os.path.isfile(os.path.join(BUNDLE_DIR, name)):
+        return None
+    return name
+
+
+def build_country(country_id, stream_func, output_types=OUTPUT_TYPES):
+    """
+    (Re)build the bundles of a country, for all occupancies and times of
+    day. Each bundle is swapped in once it is complete.
+
+    :param int country_id:
+        The GADM id of the country.
+    :param stream_func:
+        :func:`exposure.views._stream_building_exposure`.
+    :param output_types:
+        The output types to build.
+    """
+    country_dir = os.path.join(BUNDLE_DIR, str(country_id))
+    if not os.path.isdir(country_dir):
+        os.makedirs(country_dir)
+
+    for output_type in output_types:
+        for residential in RESIDENTIAL:
+            for tod in TIMES_OF_DAY:
+                params = dict(outputType=output_type, adminLevel='admin0',
+                              residential=residential, timeOfDay=tod,
+                              regionLevel='admin0', regionId=str(country_id))
+                chunks = compression.gzip_stream(util.coalesce(
+                    stream_func(util.ExportRequest(params), output_type)
+                ))
+                path = os.path.join(BUNDLE_DIR, _bundle_name(
+                    country_id, output_type, residential, tod
+                ))
+                _write_bundle(path, chunks)
+
+
+def _write_bundle(path, chunks):
+    tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    try:
+        with open(tmp_path, 'wb') as fh:
+            for chunk in chunks:
+                fh.write(chunk)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def clear():
+    """
+    Delete all of the bundles.
+    """
+    if enabled() and os.path.isdir(BUNDLE_DIR):
+        shutil.rmtree(BUNDLE_DIR, ignore_errors=True)
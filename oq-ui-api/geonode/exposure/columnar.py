@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2013, GEM Foundation.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/agpl.html>.
+
+"""
+Columnar (NumPy `.npz`) exports.
+
+An `.npz` export holds one typed array per column, all of the same length,
+one item per asset (or grid cell, for population exports):
+
+* `grid_id` (int64), `lon`, `lat` (float64)
+* `population` (float64): for building exports, the population allocated to
+  the building type of the asset (population value * dwelling fraction)
+* `iso_code` (int32), indexing the `iso` table of country codes
+
+Building exports also have:
+
+* `gadm_level_id`, `study_region` (int64)
+* `taxonomy_code` (int32), indexing the `taxonomy` table of GEM taxonomy
+  strings
+* `day`, `night`, `transit` (float64, admin level 0 only): the population
+  of the asset at each time of day, or NaN if that time of day was not
+  requested
+
+The table arrays are string arrays (NULL strings are stored as ''), so the
+whole archive can be loaded with `numpy.load` without enabling pickles.
+
+Columns are spooled to temporary files while the rows are read, so memory
+use does not depend on the size of the export. Since the length of each
+array must be written before its data, nothing is sent until all rows have
+been read.
+
+NumPy is optional: without it, the 'npz' output type is not available.
+"""
+
+import collections
+import StringIO
+import tempfile
+
+try:
+    import numpy
+    from numpy.lib import format as npy_format
+except ImportError:
+    numpy = None
+
+from exposure import compression
+from exposure import util
+
+#: Size of the blocks read back from the column spool files.
+_READ_SIZE = 64 * 1024
+
+
+def available():
+    """
+    :returns:
+        `True` if NumPy is installed, and so columnar exports are available.
+    """
+    return numpy is not None
+
+
+class _ColumnSpool(object):
+    """
+    A column of a fixed dtype, appended to in batches and kept in a temporary
+    file.
+    """
+
+    def __init__(self, dtype):
+        self.dtype = numpy.dtype(dtype)
+        self.length = 0
+        self._file = tempfile.TemporaryFile()
+
+    def extend(self, values):
+        values = numpy.asarray(values, dtype=self.dtype)
+        values.tofile(self._file)
+        self.length += len(values)
+
+    def npy_chunks(self):
+        """
+        Yield the content of the column in the `.npy` format.
+        """
+        header = StringIO.StringIO()
+        npy_format.write_array_header_1_0(header, dict(
+            descr=npy_format.dtype_to_descr(self.dtype),
+            fortran_order=False,
+            shape=(self.length, ),
+        ))
+        yield header.getvalue()
+
+        self._file.seek(0)
+        while True:
+            data = self._file.read(_READ_SIZE)
+            if not data:
+                break
+            yield data
+        self._file.close()
+
+
+class NpzWriter(object):
+    """
+    Build an `.npz` archive from batches of column values.
+
+    :param columns:
+        A list of (column name, dtype) pairs.
+    :param encoded:
+        Names of string columns to dictionary-encode. Column `name` is stored
+        as an int32 `name_code` array plus a `name` table of the distinct
+        values.
+    """
+
+    def __init__(self, columns, encoded=()):
+        self._spools = collections.OrderedDict()
+        self._tables = dict()
+        for name, dtype in columns:
+            if name in encoded:
+                self._tables[name] = dict()
+                self._spools['%s_code' % name] = _ColumnSpool('int32')
+            else:
+                self._spools[name] = _ColumnSpool(dtype)
+
+    def append(self, **columns):
+        """
+        Append a batch of rows, given as one sequence of values per column.
+        All the columns must be given, with the same number of values.
+        """
+        for name, values in columns.iteritems():
+            if name in self._tables:
+                self._spools['%s_code' % name].extend(
+                    self._encode(name, values)
+                )
+            else:
+                self._spools[name].extend(values)
+
+    def _encode(self, name, values):
+        table = self._tables[name]
+        # A NULL would make the table an object array, which only loads
+        # with pickles enabled.
+        values = ['' if value is None else value for value in values]
+        uniques, inverse = numpy.unique(numpy.asarray(values, dtype=object),
+                                        return_inverse=True)
+        codes = numpy.array([table.setdefault(u, len(table)) for u in uniques],
+                            dtype=numpy.int32)
+        return codes[inverse]
+
+    def _table_npy(self, name):
+        table = self._tables[name]
+        values = sorted(table, key=table.get)
+        npy = StringIO.StringIO()
+        npy_format.write_array(npy, numpy.array(values, dtype=str))
+        return [npy.getvalue()]
+
+    def chunks(self):
+        """
+        Yield the content of the `.npz` archive.
+        """
+        members = [('%s.npy' % name, spool.npy_chunks())
+                   for name, spool in self._spools.iteritems()]
+        members.extend(('%s.npy' % name, self._table_npy(name))
+                       for name in sorted(self._tables))
+        return compression.zip_stream(members)
+
+
+def _stream_npz(writer, exposure_data, append_batch):
+    """
+    Feed `exposure_data` to `writer` in batches, transposed to columns with
+    `append_batch(writer, columns)`, then yield the archive.
+    """
+    for batch in util.batches(exposure_data, util.EXPORT_FETCH_SIZE):
+        append_batch(writer, zip(*batch))
+    for chunk in writer.chunks():
+        yield chunk
+
+
+#: (name, dtype) of the columns of each type of export. String columns
+#: (dtype `None`) are dictionary-encoded.
+BLDG_ADMIN_0_COLUMNS = [
+    ('grid_id', 'int64'),
+    ('lon', 'float64'),
+    ('lat', 'float64'),
+    ('population', 'float64'),
+    ('gadm_level_id', 'int64'),
+    ('iso', None),
+    ('study_region', 'int64'),
+    ('taxonomy', None),
+    ('day', 'float64'),
+    ('night', 'float64'),
+    ('transit', 'float64'),
+]
+BLDG_SUBNAT_COLUMNS = BLDG_ADMIN_0_COLUMNS[:8]
+POP_COLUMNS = BLDG_ADMIN_0_COLUMNS[:4] + [('iso', None)]
+
+
+def bldg_admin0_generator(exposure_data):
+    """
+    Generate an admin level 0 `.npz` building exposure export.
+    """
+    def append_batch(writer, cols):
+        (grid_id, lon, lat, pop_value, country_id, iso, study_region_id,
+         building_type, dwelling_fraction, day, night, transit) = cols
+        population = (numpy.asarray(pop_value, dtype=numpy.float64)
+                      * numpy.asarray(dwelling_fraction, dtype=numpy.float64))
+        # NULL ratios (time of day not requested) become NaN
+        writer.append(
+            grid_id=grid_id, lon=lon, lat=lat, population=population,
+            gadm_level_id=country_id, iso=iso, study_region=study_region_id,
+            taxonomy=building_type,
+            day=population * numpy.asarray(day, dtype=numpy.float64),
+            night=population * numpy.asarray(night, dtype=numpy.float64),
+            transit=population * numpy.asarray(transit, dtype=numpy.float64),
+        )
+
+    writer = NpzWriter(BLDG_ADMIN_0_COLUMNS, encoded=('iso', 'taxonomy'))
+    return _stream_npz(writer, exposure_data, append_batch)
+
+
+def bldg_subnat_generator(exposure_data):
+    """
+    Generate an admin level 1-3 `.npz` building exposure export.
+    """
+    def append_batch(writer, cols):
+        (grid_id, lon, lat, pop_value, admin_id, iso, study_region_id,
+         building_type, dwelling_fraction) = cols
+        population = (numpy.asarray(pop_value, dtype=numpy.float64)
+                      * numpy.asarray(dwelling_fraction, dtype=numpy.float64))
+        writer.append(
+            grid_id=grid_id, lon=lon, lat=lat, population=population,
+            gadm_level_id=admin_id, iso=iso, study_region=study_region_id,
+            taxonomy=building_type,
+        )
+
+    writer = NpzWriter(BLDG_SUBNAT_COLUMNS, encoded=('iso', 'taxonomy'))
+    return _stream_npz(writer, exposure_data, append_batch)
+
+
+def pop_generator(exposure_data):
+    """
+    Generate an `.npz` population exposure export.
+    """
+    def append_batch(writer, cols):
+        grid_id, lon, lat, pop_value, iso = cols
+        writer.append(grid_id=grid_id, lon=lon, lat=lat, population=pop_value,
+                      iso=iso)
+
+    writer = NpzWriter(POP_COLUMNS, encoded=('iso', ))
+    return _stream_npz(writer, exposure_data, append_batch)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2013, GEM Foundation.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/agpl.html>.
+
+"""
+Incremental compression of streamed exports.
+
+Both helpers take an iterable of strings (the output of the export
+generators) and yield compressed data as it becomes available, so the
+compressed response can be streamed without holding the whole document in
+memory.
+"""
+
+import struct
+import time
+import zlib
+
+from django.conf import settings
+
+#: zlib compression level used for exports. Exports are produced on the fly,
+#: so favor speed over the last few percent of compression.
+COMPRESSION_LEVEL = getattr(settings, 'EXPOSURE_EXPORT_COMPRESSION_LEVEL', 6)
+
+#: Version needed to extract: 4.5, for the ZIP64 extensions.
+_ZIP_VERSION = 45
+#: General purpose flag: CRC and sizes follow the file data, in a data
+#: descriptor, since they are not known when the local header is written.
+_ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+_ZIP_DEFLATED = 8
+#: Sizes, offsets and counts from which the ZIP64 records are needed. The
+#: fields they don't fit in are then set to the maximum value.
+_ZIP64_LIMIT = 0xffffffff
+_ZIP64_COUNT_LIMIT = 0xffff
+_ZIP64_EXTRA_ID = 0x0001
+
+
+def gzip_stream(chunks, level=None):
+    """
+    Compress a stream of strings to the gzip format.
+
+    :param chunks:
+        An iterable of strings.
+    :param int level:
+        zlib compression level. Defaults to :data:`COMPRESSION_LEVEL`.
+    """
+    if level is None:
+        level = COMPRESSION_LEVEL
+    # wbits = 16 + MAX_WBITS makes zlib write a gzip header and trailer.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _dos_date_time(timestamp):
+    t = time.localtime(timestamp)
+    dos_date = (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    dos_time = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+    return dos_date, dos_time
+
+
+def zip_stream(members, level=None):
+    """
+    Write a zip archive, without seeking.
+
+    Each member is written with a data descriptor, so its content is
+    compressed and sent as it is produced. Since the size of a member is not
+    known in advance, its local header announces ZIP64 sizes in the data
+    descriptor; the central directory only uses the ZIP64 records for the
+    sizes and offsets which don't fit in 4 bytes, so that archives larger
+    than 4 GiB are valid.
+
+    :param members:
+        An iterable of (file name, iterable of strings) pairs, one for each
+        file in the archive.
+    :param int level:
+        zlib compression level. Defaults to :data:`COMPRESSION_LEVEL`.
+    """
+    if level is None:
+        level = COMPRESSION_LEVEL
+    dos_date, dos_time = _dos_date_time(time.time())
+
+    offset = 0
+    central_dir = []
+    for name, chunks in members:
+        header_offset = offset
+        # The sizes are given in the ZIP64 extra field (as 0, since they
+        # follow in the data descriptor).
+        extra = struct.pack('<HHQQ', _ZIP64_EXTRA_ID, 16, 0, 0)
+        local_header = struct.pack(
+            '<4sHHHHHIIIHH', 'PK\x03\x04', _ZIP_VERSION,
+            _ZIP_FLAG_DATA_DESCRIPTOR, _ZIP_DEFLATED, dos_time, dos_date,
+            0, 0xffffffff, 0xffffffff, len(name), len(extra)
+        ) + name + extra
+        yield local_header
+        offset += len(local_header)
+
+        crc = 0
+        size = 0
+        compressed_size = 0
+        # Negative wbits: raw deflate data, no zlib header.
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                compressed_size += len(data)
+                yield data
+        data = compressor.flush()
+        compressed_size += len(data)
+        yield data
+        crc &= 0xffffffff
+
+        descriptor = struct.pack('<4sIQQ', 'PK\x07\x08', crc,
+                                 compressed_size, size)
+        yield descriptor
+        offset += compressed_size + len(descriptor)
+
+        # Values too large for the central directory header go in its ZIP64
+        # extra field, in this order.
+        fields = [size, compressed_size, header_offset]
+        large = [value for value in fields if value >= _ZIP64_LIMIT]
+        extra = ''
+        if large:
+            extra = struct.pack('<HH%dQ' % len(large), _ZIP64_EXTRA_ID,
+                                8 * len(large), *large)
+        size, compressed_size, header_offset = [
+            _zip_field(value, _ZIP64_LIMIT, 0xffffffff) for value in fields
+        ]
+        central_dir.append(struct.pack(
+            '<4sHHHHHHIIIHHHHHII', 'PK\x01\x02', _ZIP_VERSION, _ZIP_VERSION,
+            _ZIP_FLAG_DATA_DESCRIPTOR, _ZIP_DEFLATED, dos_time, dos_date,
+            crc, compressed_size, size, len(name), len(extra), 0, 0, 0, 0,
+            header_offset
+        ) + name + extra)
+
+    central_dir_data = ''.join(central_dir)
+    yield central_dir_data
+    count = len(central_dir)
+    if (count >= _ZIP64_COUNT_LIMIT or offset >= _ZIP64_LIMIT
+            or len(central_dir_data) >= _ZIP64_LIMIT):
+        # ZIP64 end of central directory record (whose size excludes its
+        # first 12 bytes), and its locator.
+        end_offset = offset + len(central_dir_data)
+        yield struct.pack('<4sQHHIIQQQQ', 'PK\x06\x06', 44, _ZIP_VERSION,
+                          _ZIP_VERSION, 0, 0, count, count,
+                          len(central_dir_data), offset)
+        yield struct.pack('<4sIQI', 'PK\x06\x07', 0, end_offset, 1)
+    count = _zip_field(count, _ZIP64_COUNT_LIMIT, 0xffff)
+    yield struct.pack('<4sHHHHIIH', 'PK\x05\x06', 0, 0, count, count,
+                      _zip_field(len(central_dir_data), _ZIP64_LIMIT,
+                                 0xffffffff),
+                      _zip_field(offset, _ZIP64_LIMIT, 0xffffffff), 0)
+
+
+def _zip_field(value, limit, maximum):
+    """
+    :returns:
+        `value`, or `maximum` if it reaches `limit`: the field is then given
+        by a ZIP64 record.
+    """
+    return maximum if value >= limit else value
@@ -1,6 +1,8 @@
 from django import forms
 from django.utils.safestring import mark_safe
 
+from exposure import columnar
+
 ADMIN_LEVEL_CHOICES = [['admin0', 'Level 0'], ['admin1', 'Level 1'],
                        ['admin2', 'Level 2'], ['admin3', 'Level 3']]
 TOD = [['day', 'Day'], ['night', 'Night'], ['transit', 'Transit'],
@@ -8,6 +10,8 @@ TOD = [['day', 'Day'], ['night', 'Night'], ['transit', 'Transit'],
 res = [['res', 'Residential'], ['non-res', 'Non-Residential'],
        ['both', 'Both']]
 OUTPUT_TYPES = [('csv', 'CSV'), ('nrml', 'NRML')]
+if columnar.available():
+    OUTPUT_TYPES.append(('npz', 'NumPy (.npz)'))
 
 #: Default widget attrs for each widget rendered to HTML:
 WIDGET_ATTRS = {'class': 'exposure_export_widget'}
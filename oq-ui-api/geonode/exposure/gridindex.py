@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2013, GEM Foundation.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/agpl.html>.
+
+"""
+Memory-mapped index of the populated GED grid points, to export the
+population of a bounding box (or of a GADM region) without querying the
+database.
+
+The index is a directory of `.npy` arrays, one per column (see
+:data:`COLUMNS`), built by the `build_exposure_grid_index` management
+command. Grid points are sorted by bucket, a cell of :data:`BUCKET_SIZE`
+degrees, row by row of buckets, then by id. The `offsets` array holds the
+position of the first grid point of each bucket, so that the grid points of
+a row of buckets are a slice of the arrays.
+
+For each GADM admin level, the index also holds the positions of the grid
+points sorted by region, then by id (`<column>.region_rows`), with the
+sorted ids of the regions (`<column>.regions`) and the position of the
+first grid point of each region in `region_rows` (`<column>.region_offsets`),
+so that the grid points of a region are found without scanning the whole
+region column.
+
+Each process maps the arrays in memory (the pages are shared between the
+processes by the OS), and maps them again when the index is rebuilt.
+
+The index is used if NumPy is installed, :data:`GRID_INDEX_DIR` is set and
+the index was built there. It must be rebuilt whenever the GED data changes.
+"""
+
+import itertools
+import logging
+import os
+import shutil
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django.conf import settings
+from django.utils import simplejson
+
+from exposure import util
+
+LOG = logging.getLogger(__name__)
+
+#: Directory of the grid point index. `None` disables the index.
+GRID_INDEX_DIR = getattr(settings, 'EXPOSURE_GRID_INDEX_DIR', None)
+#: Size (in degrees) of the buckets of the index.
+BUCKET_SIZE = 0.25
+
+#: Columns of the index, and their dtypes. `iso_code` indexes the ISO codes
+#: of the metadata, and missing admin ids are -1.
+COLUMNS = (
+    ('grid_id', 'int64'),
+    ('lon', 'float64'),
+    ('lat', 'float64'),
+    ('pop_value', 'float64'),
+    ('iso_code', 'int32'),
+    ('gadm_country_id', 'int64'),
+    ('gadm_admin_1_id', 'int64'),
+    ('gadm_admin_2_id', 'int64'),
+    ('gadm_admin_3_id', 'int64'),
+)
+
+_META = 'meta.json'
+_OFFSETS = 'offsets'
+_REGIONS = '%s.regions'
+_REGION_OFFSETS = '%s.region_offsets'
+_REGION_ROWS = '%s.region_rows'
+#: Version of the index files.
+_FORMAT_VERSION = 2
+
+_lock = threading.Lock()
+#: (stamp of the metadata file, :class:`GridIndex`) of the loaded index.
+_loaded = None
+
+
+def available():
+    """
+    :returns:
+        `True` if the index is configured and can be used (it may still not
+        be built, see :func:`get_index`).
+    """
+    return numpy is not None and GRID_INDEX_DIR is not None
+
+
+def get_index():
+    """
+    :returns:
+        The :class:`GridIndex` of this process, or `None` if it is not
+        available, or not built.
+    """
+    global _loaded
+
+    if not available():
+        return None
+    try:
+        stat = os.stat(os.path.join(GRID_INDEX_DIR, _META))
+    except OSError:
+        return None
+    stamp = (stat.st_ino, stat.st_mtime)
+    with _lock:
+        if _loaded is None or _loaded[0] != stamp:
+            try:
+                _loaded = (stamp, GridIndex(GRID_INDEX_DIR))
+            except (IOError, ValueError):
+                # Being rebuilt: use the database this time.
+                LOG.exception('Cannot load the grid point index')
+                return None
+        return _loaded[1]
+
+
+def _bucket(value, origin, count):
+    """
+    :returns:
+        The bucket of a coordinate (or NumPy array of coordinates), along an
+        axis of `count` buckets starting at `origin`.
+    """
+    bucket = numpy.floor((numpy.asarray(value, dtype=numpy.float64) - origin)
+                         / BUCKET_SIZE).astype(numpy.int64)
+    return numpy.clip(bucket, 0, count - 1)
+
+
+def _bucket_counts():
+    return int(round(360 / BUCKET_SIZE)), int(round(180 / BUCKET_SIZE))
+
+
+class GridIndex(object):
+    """
+    A loaded (memory-mapped) grid point index.
+    """
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, _META)) as fh:
+            meta = simplejson.load(fh)
+        if (meta.get('version') != _FORMAT_VERSION
+                or meta.get('bucket_size') != BUCKET_SIZE):
+            raise ValueError('Incompatible grid point index, rebuild it')
+        self.iso = [str(iso) for iso in meta['iso']]
+        self.columns = dict(
+            (name, numpy.load(os.path.join(directory, name + '.npy'),
+                              mmap_mode='r'))
+            for name, _ in COLUMNS
+        )
+        self.offsets = numpy.load(os.path.join(directory, _OFFSETS + '.npy'),
+                                  mmap_mode='r')
+        self.regions = dict(
+            (column, tuple(
+                numpy.load(os.path.join(directory, (name % column) + '.npy'),
+                           mmap_mode='r')
+                for name in (_REGIONS, _REGION_OFFSETS, _REGION_ROWS)
+            ))
+            for column in util.REGION_COLUMN_MAP.values()
+        )
+
+    def bbox_indices(self, lng1, lat1, lng2, lat2):
+        """
+        :returns:
+            The positions, in bucket order, of the grid points within a
+            bounding box (edges included).
+        """
+        lng1, lng2 = sorted([float(lng1), float(lng2)])
+        lat1, lat2 = sorted([float(lat1), float(lat2)])
+        nx, ny = _bucket_counts()
+        bx1, bx2 = _bucket([lng1, lng2], -180, nx).tolist()
+        by1, by2 = _bucket([lat1, lat2], -90, ny).tolist()
+
+        slices = []
+        for by in xrange(by1, by2 + 1):
+            start = self.offsets[by * nx + bx1]
+            end = self.offsets[by * nx + bx2 + 1]
+            if end > start:
+                slices.append(numpy.arange(start, end))
+        if not slices:
+            return numpy.zeros(0, dtype=numpy.int64)
+        indices = numpy.concatenate(slices)
+        lon = self.columns['lon'][indices]
+        lat = self.columns['lat'][indices]
+        return indices[(lon >= lng1) & (lon <= lng2)
+                       & (lat >= lat1) & (lat <= lat2)]
+
+    def region_indices(self, admin_level, region_id):
+        """
+        :returns:
+            The positions, in grid point id order, of the grid points of a
+            GADM region.
+        """
+        regions, offsets, rows = self.regions[
+            util.REGION_COLUMN_MAP[admin_level]
+        ]
+        i = int(numpy.searchsorted(regions, region_id))
+        if i == len(regions) or regions[i] != region_id:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.asarray(rows[offsets[i]:offsets[i + 1]])
+
+    def get_population_exposure(self, lng1, lat1, lng2, lat2, area=None):
+        """
+        Same as :func:`exposure.util._get_population_exposure`, for a
+        bounding box or a GADM region (see :func:`supports`).
+
+        :returns:
+            An iterator over the rows, ordered by grid point id.
+        """
+        if area is not None:
+            _, admin_level, region_id = area
+            return self._rows(self.region_indices(admin_level, region_id))
+        indices = self.bbox_indices(lng1, lat1, lng2, lat2)
+        order = numpy.argsort(self.columns['grid_id'][indices],
+                              kind='mergesort')
+        return self._rows(indices[order])
+
+    def _rows(self, indices):
+        columns = self.columns
+        iso = self.iso
+        for start in xrange(0, len(indices), util.EXPORT_FETCH_SIZE):
+            batch = indices[start:start + util.EXPORT_FETCH_SIZE]
+            for row in itertools.izip(
+                    columns['grid_id'][batch].tolist(),
+                    columns['lon'][batch].tolist(),
+                    columns['lat'][batch].tolist(),
+                    columns['pop_value'][batch].tolist(),
+                    [iso[code] for code in
+                     columns['iso_code'][batch].tolist()]):
+                yield row
+
+
+def supports(area):
+    """
+    :returns:
+        `True` if the index can export an `area` (see
+        :func:`exposure.views._get_export_area`): a bounding box (`None`) or
+        a GADM region, not a polygon.
+    """
+    return area is None or area[0] == 'region'
+
+
+def build(directory=None):
+    """
+    (Re)build the index from the database. The new index is written next to
+    the current one, and swapped in when it is complete.
+
+    :param directory:
+        Defaults to :data:`GRID_INDEX_DIR`.
+    """
+    if directory is None:
+        directory = GRID_INDEX_DIR
+    new_dir = directory + '.new'
+    old_dir = directory + '.old'
+    shutil.rmtree(new_dir, ignore_errors=True)
+    os.makedirs(new_dir)
+
+    columns, iso = _read_grid_points()
+    nx, ny = _bucket_counts()
+    buckets = (_bucket(columns['lat'], -90, ny) * nx
+               + _bucket(columns['lon'], -180, nx))
+    order = numpy.lexsort((columns['grid_id'], buckets))
+    for name, _ in COLUMNS:
+        numpy.save(os.path.join(new_dir, name + '.npy'), columns[name][order])
+    counts = numpy.bincount(buckets, minlength=nx * ny)
+    offsets = numpy.zeros(nx * ny + 1, dtype=numpy.int64)
+    numpy.cumsum(counts, out=offsets[1:])
+    numpy.save(os.path.join(new_dir, _OFFSETS + '.npy'), offsets)
+    grid_ids = columns['grid_id'][order]
+    for column in util.REGION_COLUMN_MAP.values():
+        _save_regions(new_dir, column, columns[column][order], grid_ids)
+    # Written last: the index is loaded once its metadata is there.
+    with open(os.path.join(new_dir, _META), 'w') as fh:
+        simplejson.dump(dict(version=_FORMAT_VERSION, bucket_size=BUCKET_SIZE,
+                             iso=iso, rows=len(order)), fh)
+
+    # Processes which mapped the current index keep their (deleted) files.
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(directory):
+        os.rename(directory, old_dir)
+    os.rename(new_dir, directory)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def _save_regions(directory, column, region_ids, grid_ids):
+    """
+    Save the region arrays of a region column (see :class:`GridIndex`).
+
+    :param region_ids, grid_ids:
+        The region and grid point ids of the grid points, in index order.
+    """
+    rows = numpy.lexsort((grid_ids, region_ids))
+    regions, starts = numpy.unique(region_ids[rows], return_index=True)
+    offsets = numpy.append(starts, len(rows)).astype(numpy.int64)
+    for name, array in [(_REGIONS, regions), (_REGION_OFFSETS, offsets),
+                        (_REGION_ROWS, rows)]:
+        numpy.save(os.path.join(directory, (name % column) + '.npy'), array)
+
+
+_GRID_POINTS_QUERY = """\
+SELECT
+    grid_point.id,
+    ST_X(grid_point.the_geom),
+    ST_Y(grid_point.the_geom),
+    grid_point.pop_value,
+    gadm_country.iso,
+    grid_point.gadm_country_id,
+    COALESCE(grid_point.gadm_admin_1_id, -1),
+    COALESCE(grid_point.gadm_admin_2_id, -1),
+    COALESCE(grid_point.gadm_admin_3_id, -1)
+FROM ged2.grid_point AS grid_point
+
+JOIN ged2.gadm_country AS gadm_country
+    ON grid_point.gadm_country_id = gadm_country.id
+
+WHERE grid_point.pop_value > 0
+"""
+
+
+def _read_grid_points():
+    """
+    :returns:
+        The columns of the populated grid points, as a `dict` of NumPy
+        arrays, and the list of their ISO codes.
+    """
+    iso_codes = {}
+    chunks = dict((name, []) for name, _ in COLUMNS)
+    for rows in util.batches(util._stream_query(_GRID_POINTS_QUERY, []),
+                             util.EXPORT_FETCH_SIZE):
+        values = zip(*rows)
+        values[4] = [iso_codes.setdefault(iso, len(iso_codes))
+                     for iso in values[4]]
+        for (name, dtype), column in zip(COLUMNS, values):
+            chunks[name].append(numpy.array(column, dtype=dtype))
+
+    columns = {}
+    for name, dtype in COLUMNS:
+        if chunks[name]:
+            columns[name] = numpy.concatenate(chunks[name])
+        else:
+            columns[name] = numpy.zeros(0, dtype=dtype)
+    iso = sorted(iso_codes, key=iso_codes.get)
+    return columns, iso
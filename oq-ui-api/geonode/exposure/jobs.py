@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2013, GEM Foundation.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/agpl.html>.
+
+"""
+Background export jobs.
+
+Exports which are too large to be streamed within a single request are run
+in the background, and write their result to disk.
+
+Each job lives in its own directory under :data:`EXPORT_JOB_DIR`, holding a
+`job.json` file with the export to run, a `status.json` file and, once the
+job is complete, the exported file. Since all of the job state is on disk,
+any web worker process can report the status of a job and serve its result,
+and queued jobs are not lost when the process which submitted them exits.
+
+Queued jobs are picked off disk, oldest first, by :func:`run_next`, which is
+called by a small pool of worker threads in each web worker process, and by
+the `run_export_jobs` management command. Set :data:`EXPORT_JOB_WORKERS` to
+0 to run the jobs in the management command only, outside of the web
+workers. A job is claimed by holding an exclusive lock on its `claim` file
+while it runs, so that each job is run once.
+
+The status of a running job records the id of the process running it, and a
+heartbeat updated every :data:`HEARTBEAT_INTERVAL` seconds. A running job
+whose process is gone, or whose heartbeat is older than
+:data:`HEARTBEAT_TIMEOUT`, is reported as failed by :func:`get_status`.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.db import connections
+from django.utils import importlib
+from django.utils import simplejson
+
+from exposure import metrics
+from exposure import util
+
+LOG = logging.getLogger(__name__)
+
+#: Directory where the job status and results are stored.
+EXPORT_JOB_DIR = getattr(
+    settings, 'EXPOSURE_EXPORT_JOB_DIR',
+    os.path.join(tempfile.gettempdir(), 'oq-exposure-export-jobs')
+)
+#: Number of worker threads running export jobs, per web worker process.
+#: With 0, jobs are only run by the `run_export_jobs` management command.
+EXPORT_JOB_WORKERS = getattr(settings, 'EXPOSURE_EXPORT_JOB_WORKERS', 2)
+#: Jobs older than this (in seconds) are deleted, along with their results.
+EXPORT_JOB_MAX_AGE = getattr(settings, 'EXPOSURE_EXPORT_JOB_MAX_AGE',
+                             24 * 3600)
+#: Minimum interval (in seconds) between progress updates of a running job.
+PROGRESS_INTERVAL = 2
+#: Interval (in seconds) between the heartbeats of a running job.
+HEARTBEAT_INTERVAL = 10
+#: A running job without a heartbeat for this long (in seconds) is failed.
+HEARTBEAT_TIMEOUT = getattr(settings, 'EXPOSURE_EXPORT_JOB_HEARTBEAT_TIMEOUT',
+                            120)
+#: Interval (in seconds) at which idle workers look for queued jobs.
+POLL_INTERVAL = 1
+
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETE = 'complete'
+FAILED = 'failed'
+
+JOB_FILE = 'job.json'
+STATUS_FILE = 'status.json'
+CLAIM_FILE = 'claim'
+RESULT_FILE = 'result'
+
+_JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+_workers = []
+_workers_lock = threading.Lock()
+#: Set when a job is submitted, to wake up the idle workers of the process.
+_submitted = threading.Event()
+
+
+class _RunningJob(object):
+    """
+    The status of a job run by this process, updated by the job and by its
+    heartbeat thread.
+    """
+
+    def __init__(self, job_id, status):
+        self.job_id = job_id
+        self.status = status
+        self._lock = threading.Lock()
+
+    def update(self, **kwargs):
+        """
+        Update the status, and its heartbeat, and write it.
+        """
+        with self._lock:
+            self.status.update(kwargs)
+            self.status['heartbeat'] = time.time()
+            _write_status(self.job_id, self.status)
+
+    def beat(self, stop):
+        """
+        Update the heartbeat of the job until `stop` is set.
+
+        :param stop:
+            A :class:`threading.Event`.
+        """
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            self.update()
+
+
+def submit(user, stream_func, params, output_type, mimetype, filename,
+           estimated_rows=None):
+    """
+    Queue an export job.
+
+    :param str user:
+        Name of the user submitting the job. Only this user can see the job
+        status and download its result.
+    :param stream_func:
+        The export generator to run, for example
+        :func:`exposure.views._stream_building_exposure`. It must be a module
+        level function, since it is imported by the process running the job.
+    :param dict params:
+        The export parameters, as they would be passed in the GET parameters
+        of a synchronous export.
+    :param str output_type:
+        'csv' or 'nrml'.
+    :param str mimetype:
+        The mimetype to use when serving the result.
+    :param str filename:
+        The file name to use when serving the result.
+    :param int estimated_rows:
+        The estimated number of rows of the export (see
+        :func:`exposure.util._estimate_export_rows`), if known, against which
+        the progress of the job is reported.
+    :returns:
+        The id of the new job.
+    """
+    _purge_old_jobs()
+
+    job_id = uuid.uuid4().hex
+    os.makedirs(_job_dir(job_id))
+    _write_file(job_id, JOB_FILE, dict(
+        export='%s.%s' % (stream_func.__module__, stream_func.__name__),
+        params=params, output_type=output_type
+    ))
+    # The job is picked up by the workers once its status is written.
+    _write_status(job_id, dict(status=QUEUED, user=user, mimetype=mimetype,
+                               filename=filename, bytes=0, rows=0,
+                               estimated_rows=estimated_rows,
+                               submitted=time.time()))
+
+    _start_workers()
+    _submitted.set()
+    return job_id
+
+
+def get_status(job_id):
+    """
+    A running job which was orphaned, because the process running it exited
+    or hangs, is marked as failed.
+
+    :returns:
+        The status `dict` of the given job, or `None` if there is no such job.
+    """
+    if not _JOB_ID_RE.match(job_id or ''):
+        return None
+    status = _read_file(job_id, STATUS_FILE)
+    if status is None:
+        return None
+    if status['status'] == QUEUED:
+        # Make sure that this process can run the job, if no other one does.
+        _start_workers()
+    elif status['status'] == RUNNING and _orphaned(status):
+        LOG.error('Export job %s was orphaned by process %s on %s', job_id,
+                  status.get('pid'), status.get('host'))
+        status.update(status=FAILED, error='The export job was interrupted',
+                      finished=time.time())
+        _write_status(job_id, status)
+    return status
+
+
+def result_path(job_id):
+    """
+    :returns:
+        The path of the exported file of the given job.
+    """
+    return os.path.join(_job_dir(job_id), RESULT_FILE)
+
+
+def run_next():
+    """
+    Claim and run the oldest queued job, if any.
+
+    :returns:
+        `True` if a job was run.
+    """
+    for job_id in _queued_jobs():
+        fd = _claim(job_id)
+        if fd is None:
+            continue
+        try:
+            # The job may have been run by another worker since it was
+            # listed.
+            status = _read_file(job_id, STATUS_FILE)
+            if status is None or status['status'] != QUEUED:
+                continue
+            _run(job_id, status)
+            return True
+        finally:
+            os.close(fd)
+    return False
+
+
+def work():
+    """
+    Run the queued jobs, forever.
+    """
+    while True:
+        try:
+            ran = run_next()
+        except Exception:
+            LOG.exception('Cannot run the queued export jobs')
+            ran = False
+        finally:
+            # Each thread has its own database connection; don't keep it
+            # (and any open transaction) around while waiting for the next
+            # job.
+            connections['geddb'].close()
+        if not ran:
+            _submitted.wait(POLL_INTERVAL)
+            _submitted.clear()
+
+
+def _job_dir(job_id):
+    return os.path.join(EXPORT_JOB_DIR, job_id)
+
+
+def _read_file(job_id, name):
+    try:
+        with open(os.path.join(_job_dir(job_id), name)) as fh:
+            return simplejson.load(fh)
+    except IOError:
+        return None
+
+
+def _write_file(job_id, name, data):
+    # Write to a temporary file first, so that a concurrent reader never
+    # reads a partially written file.
+    path = os.path.join(_job_dir(job_id), name)
+    tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    with open(tmp_path, 'w') as fh:
+        simplejson.dump(data, fh)
+    os.rename(tmp_path, path)
+
+
+def _write_status(job_id, status):
+    _write_file(job_id, STATUS_FILE, status)
+
+
+def _orphaned(status):
+    if time.time() - status.get('heartbeat', 0) > HEARTBEAT_TIMEOUT:
+        return True
+    return (status.get('host') == socket.gethostname()
+            and not _process_exists(status['pid']))
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _queued_jobs():
+    """
+    :returns:
+        The ids of the queued jobs, oldest first.
+    """
+    if not os.path.isdir(EXPORT_JOB_DIR):
+        return []
+    queued = []
+    for job_id in os.listdir(EXPORT_JOB_DIR):
+        if not _JOB_ID_RE.match(job_id):
+            continue
+        status = _read_file(job_id, STATUS_FILE)
+        if status is not None and status['status'] == QUEUED:
+            queued.append((status['submitted'], job_id))
+    return [job_id for _, job_id in sorted(queued)]
+
+
+def _claim(job_id):
+    """
+    Lock the claim file of a job.
+
+    :returns:
+        The file descriptor holding the lock (close it to release the lock),
+        or `None` if the job is claimed by another worker, or was deleted.
+    """
+    try:
+        fd = os.open(os.path.join(_job_dir(job_id), CLAIM_FILE),
+                     os.O_WRONLY | os.O_CREAT, 0644)
+    except OSError:
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _purge_old_jobs():
+    if not os.path.isdir(EXPORT_JOB_DIR):
+        return
+    oldest = time.time() - EXPORT_JOB_MAX_AGE
+    for job_id in os.listdir(EXPORT_JOB_DIR):
+        job_dir = _job_dir(job_id)
+        try:
+            mtime = os.path.getmtime(job_dir)
+        except OSError:
+            # Purged concurrently.
+            continue
+        if mtime < oldest:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def _start_workers():
+    with _workers_lock:
+        while len(_workers) < EXPORT_JOB_WORKERS:
+            worker = threading.Thread(target=work)
+            worker.daemon = True
+            worker.start()
+            _workers.append(worker)
+
+
+def _import_export(name):
+    module, _, func = name.rpartition('.')
+    return getattr(importlib.import_module(module), func)
+
+
+def _run(job_id, status):
+    """
+    Run a claimed export job, writing the result to :func:`result_path`.
+    """
+    job = _RunningJob(job_id, status)
+    job.update(status=RUNNING, started=time.time(), pid=os.getpid(),
+               host=socket.gethostname())
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=job.beat, args=(stop, ))
+    heartbeat.daemon = True
+    heartbeat.start()
+
+    path = result_path(job_id)
+    tmp_path = '%s.tmp' % path
+    progress = dict(bytes=0, rows=0)
+
+    def update_progress(record):
+        progress.update(bytes=record.bytes,
+                        rows=record.rows + record.cached_rows)
+
+    try:
+        spec = _read_file(job_id, JOB_FILE)
+        params = spec['params']
+        stream_func = _import_export(spec['export'])
+        last_update = time.time()
+        with open(tmp_path, 'wb') as fh:
+            chunks = metrics.instrument(
+                params.get('exportType'), params,
+                util.coalesce(stream_func(util.ExportRequest(params),
+                                          spec['output_type'])),
+                background=True, progress=update_progress
+            )
+            for chunk in chunks:
+                fh.write(chunk)
+                if time.time() - last_update > PROGRESS_INTERVAL:
+                    job.update(**progress)
+                    last_update = time.time()
+        os.rename(tmp_path, path)
+        final = dict(status=COMPLETE)
+    except Exception as e:
+        LOG.exception('Export job %s failed', job_id)
+        final = dict(status=FAILED, error=str(e))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    finally:
+        stop.set()
+    final.update(progress)
+    job.update(finished=time.time(), **final)
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2013, GEM Foundation.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/agpl.html>.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from exposure import bundles
+from exposure import util
+from exposure import views
+
+
+class Command(BaseCommand):
+    args = '[<ISO country code> ...]'
+    help = ('Build the pre-generated whole-country building exposure '
+            'exports. If country codes are given, only the bundles of those '
+            'countries are rebuilt. Run it after each GED reload.')
+    option_list = BaseCommand.option_list + (
+        make_option('--output-type', action='append', dest='output_types',
+                    help=('Output type to build (csv or nrml). Can be '
+                          'repeated. Default: all output types.')),
+        make_option('--clear', action='store_true', dest='clear',
+                    default=False,
+                    help='Delete all of the bundles first.'),
+    )
+
+    def handle(self, *isos, **options):
+        if not bundles.enabled():
+            raise CommandError('EXPOSURE_BUNDLE_DIR is not set')
+        output_types = options.get('output_types') or bundles.OUTPUT_TYPES
+        for output_type in output_types:
+            if output_type not in bundles.OUTPUT_TYPES:
+                raise CommandError("Invalid output type '%s'" % output_type)
+
+        if options.get('clear'):
+            bundles.clear()
+        for country_id, iso in util._get_countries(isos):
+            self.stdout.write('Building the bundles of %s\n' % iso)
+            bundles.build_country(country_id, views._stream_building_exposure,
+                                  output_types=output_types)
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2013, GEM Foundation.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/agpl.html>.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from exposure import util
+
+
+class Command(BaseCommand):
+    args = '[<ISO country code> ...]'
+    help = ('Build the denormalized exposure tables used by the building '
+            'exposure exports. If country codes are given, only the rows of '
+            'those countries are refreshed.')
+    option_list = BaseCommand.option_list + (
+        make_option('--level', action='append', dest='levels',
+                    help=('Admin level to build (admin0, admin1, admin2 or '
+                          'admin3). Can be repeated. Default: all levels.')),
+    )
+
+    def handle(self, *isos, **options):
+        levels = options.get('levels') or sorted(util.EXPOSURE_FACT_TABLES)
+        for level in levels:
+            if level not in util.EXPOSURE_FACT_TABLES:
+                raise CommandError("Invalid admin level '%s'" % level)
+
+        for level in levels:
+            self.stdout.write('Building %s\n' % util.EXPOSURE_FACT_TABLES[level])
+            # One transaction per level: exports keep reading the previous
+            # rows until the new ones are committed.
+            with transaction.commit_on_success(using='geddb'):
+                util._build_exposure_facts(level, isos=isos)
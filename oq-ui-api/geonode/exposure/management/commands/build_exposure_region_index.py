@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2013, GEM Foundation.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/agpl.html>.
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from exposure import util
+
+
+class Command(NoArgsCommand):
+    help = ('Build the region to grid point index used by region exposure '
+            'exports. Run it after each GED reload.')
+
+    def handle_noargs(self, **options):
+        with transaction.commit_on_success(using='geddb'):
+            util._build_region_index()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2013, GEM Foundation.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/agpl.html>.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from exposure import util
+
+
+class Command(BaseCommand):
+    help = ('Add Hilbert keys to the denormalized exposure tables and '
+            'cluster them in key order, for the spatially ordered building '
+            'exports. Run it after build_exposure_facts.')
+    option_list = BaseCommand.option_list + (
+        make_option('--level', action='append', dest='levels',
+                    help=('Admin level to cluster (admin0, admin1, admin2 or '
+                          'admin3). Can be repeated. Default: all levels.')),
+    )
+
+    def handle(self, *args, **options):
+        levels = options.get('levels') or sorted(util.EXPOSURE_FACT_TABLES)
+        for level in levels:
+            if level not in util.EXPOSURE_FACT_TABLES:
+                raise CommandError("Invalid admin level '%s'" % level)
+
+        for level in levels:
+            table = util.EXPOSURE_FACT_TABLES[level]
+            # CLUSTER locks the table until the transaction is committed.
+            with transaction.commit_on_success(using='geddb'):
+                if util._build_hilbert_keys(level):
+                    self.stdout.write('Clustered %s\n' % table)
+                else:
+                    self.stdout.write('Skipped %s: not built\n' % table)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2013, GEM Foundation.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/agpl.html>.
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from exposure import jobs
+
+
+class Command(NoArgsCommand):
+    help = ('Run the queued background export jobs, outside of the web '
+            'workers (see EXPOSURE_EXPORT_JOB_WORKERS). Several instances '
+            'can run at the same time, each job is only run once.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--once', action='store_true', dest='once',
+                    default=False,
+                    help=('Exit once there is no queued job, rather than '
+                          'waiting for new ones.')),
+    )
+
+    def handle_noargs(self, **options):
+        if not options.get('once'):
+            jobs.work()
+        while jobs.run_next():
+            pass
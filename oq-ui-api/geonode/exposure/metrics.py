@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2013, GEM Foundation.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/agpl.html>.
+
+"""
+Export instrumentation.
+
+Each export is timed in phases:
+
+* 'plan': declaring the server-side cursor, which plans the query
+* 'fetch': fetching the rows, which includes executing the query
+* 'format': turning the rows into the output document
+* 'write': everything done with the output between two chunks, outside of
+  the export generator (compression, writing to the socket or to a file)
+
+Database times, and the number of rows read from the database, are measured
+in :func:`exposure.util._stream_query`. They are summed over all connections
+when a query runs in parallel (see :func:`exposure.util.get_exposure`).
+Rows read from the tile cache (see :mod:`exposure.tilecache`) are counted
+separately, as 'cached_rows'.
+The 'format' time is what is left of the time spent in the export generator.
+
+When an export is done, one record is logged (as JSON, on the
+`exposure.metrics` logger) and added to the per-process statistics served
+by :func:`exposure.views.export_metrics`.
+
+The record of an export also tracks its running queries, so that they can
+be cancelled (see :meth:`ExportRecord.cancel`) when the client goes away, or
+when the export runs for longer than :data:`EXPORT_DEADLINE`. The 'cancelled'
+statistic counts the exports for which running queries were cancelled.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.utils import simplejson
+
+LOG = logging.getLogger(__name__)
+
+#: Number of export records kept for the metrics view, per process.
+RECENT_EXPORTS = 100
+#: Time (in seconds) after which an export (other than a background export
+#: job) is cancelled. `None` disables the deadline.
+EXPORT_DEADLINE = getattr(settings, 'EXPOSURE_EXPORT_DEADLINE', None)
+
+PHASES = ('plan', 'fetch', 'format', 'write')
+#: Export parameters included in the records.
+RECORDED_PARAMS = ('outputType', 'adminLevel', 'residential', 'timeOfDay',
+                   'lng1', 'lat1', 'lng2', 'lat2', 'regionLevel', 'regionId',
+                   'aggregate', 'taxonomy', 'order')
+
+#: Export outcomes.
+COMPLETE = 'complete'
+FAILED = 'failed'
+#: The consumer stopped reading, for example because the client went away.
+ABORTED = 'aborted'
+#: The export ran for longer than :data:`EXPORT_DEADLINE`.
+TIMED_OUT = 'timed_out'
+STATUSES = (COMPLETE, FAILED, ABORTED, TIMED_OUT)
+
+_local = threading.local()
+_lock = threading.Lock()
+_recent = collections.deque(maxlen=RECENT_EXPORTS)
+_totals = dict()
+
+
+class ExportCancelled(Exception):
+    """
+    Raised by the queries of a cancelled export.
+    """
+
+
+class ExportRecord(object):
+    """
+    Timers and counters of one export, and its running queries.
+
+    Database times may be added, and queries run, from several threads (see
+    :func:`activate`).
+    """
+
+    def __init__(self, export, params):
+        self.export = export
+        self.params = params
+        self.rows = 0
+        self.cached_rows = 0
+        self.bytes = 0
+        self.timings = dict((phase, 0.0) for phase in PHASES)
+        #: `False` while the queries of the export are shared with other
+        #: exports (see :mod:`exposure.singleflight`), and must not be
+        #: cancelled.
+        self.cancellable = True
+        self.cancelled = False
+        #: Number of running queries cancelled by :meth:`cancel`.
+        self.cancelled_queries = 0
+        self._queries = set()
+        self._lock = threading.Lock()
+
+    def add_db_time(self, phase, seconds, rows=0):
+        with self._lock:
+            self.timings[phase] += seconds
+            self.rows += rows
+
+    def add_cached_rows(self, rows):
+        with self._lock:
+            self.cached_rows += rows
+
+    def query_started(self, connection):
+        """
+        Register a running query of the export.
+
+        :param connection:
+            The psycopg2 connection running the query.
+        :raises ExportCancelled:
+            If the export was cancelled.
+        """
+        with self._lock:
+            if self.cancelled:
+                raise ExportCancelled()
+            self._queries.add(connection)
+
+    def query_done(self, connection):
+        with self._lock:
+            self._queries.discard(connection)
+
+    def cancel(self):
+        """
+        Cancel the export, unless it isn't :attr:`cancellable`. Its running
+        queries are cancelled (the same as `pg_cancel_backend` does), and
+        fail, as well as the ones it tries to start.
+        """
+        with self._lock:
+            if self.cancelled or not self.cancellable:
+                return
+            self.cancelled = True
+            queries = list(self._queries)
+        for connection in queries:
+            try:
+                connection.cancel()
+            except Exception:
+                LOG.exception('Cannot cancel an export query')
+            else:
+                self.cancelled_queries += 1
+
+    def as_dict(self):
+        return dict(export=self.export, rows=self.rows,
+                    cached_rows=self.cached_rows, bytes=self.bytes,
+                    timings=dict(self.timings), **self.params)
+
+
+def current():
+    """
+    :returns:
+        The :class:`ExportRecord` of the export running in this thread, or
+        `None`.
+    """
+    return getattr(_local, 'record', None)
+
+
+def activate(record):
+    """
+    Make `record` the :func:`current` record of this thread (or none, if
+    `record` is `None`).
+    """
+    _local.record = record
+
+
+def instrument(export, params, chunks, background=False, progress=None):
+    """
+    Time an export and record it when it is done.
+
+    :param str export:
+        'building' or 'population'.
+    :param params:
+        The parameters of the export view. Only the ones in
+        :data:`RECORDED_PARAMS` are recorded.
+    :param chunks:
+        The output of the export generator. Timers are read once per item,
+        so this should be coalesced (see :func:`exposure.util.coalesce`).
+    :param bool background:
+        `True` for background export jobs, which have no deadline.
+    :param progress:
+        If given, called with the :class:`ExportRecord` of the export before
+        each chunk is returned, for example to report the progress of an
+        export job (see :mod:`exposure.jobs`).
+    :raises ExportCancelled:
+        If the export runs for longer than :data:`EXPORT_DEADLINE`.
+    """
+    recorded = dict((k, params[k]) for k in RECORDED_PARAMS if k in params)
+    recorded['background'] = background
+    record = ExportRecord(export, recorded)
+    status = ABORTED
+    generate = 0.0
+    start = time.time()
+    chunks = iter(chunks)
+    deadline = None
+    if EXPORT_DEADLINE is not None and not background:
+        # Also cancels the queries while they run.
+        deadline = threading.Timer(EXPORT_DEADLINE, record.cancel)
+        deadline.daemon = True
+        deadline.start()
+    try:
+        while True:
+            before = time.time()
+            activate(record)
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                break
+            finally:
+                activate(None)
+                after = time.time()
+                generate += after - before
+            if record.cancelled:
+                raise ExportCancelled()
+            record.bytes += len(chunk)
+            if progress is not None:
+                progress(record)
+            yield chunk
+            record.timings['write'] += time.time() - after
+        status = COMPLETE
+    except ExportCancelled:
+        # Also raised by the shared export of another request (see
+        # exposure.singleflight), which ran past its deadline.
+        status = TIMED_OUT
+        raise
+    except Exception:
+        if record.cancelled:
+            status = TIMED_OUT
+        else:
+            status = FAILED
+        raise
+    finally:
+        if deadline is not None:
+            deadline.cancel()
+        if status != COMPLETE:
+            # Stop the queries still running for the export, in other
+            # threads, and release its cursors and connections right away,
+            # rather than when the export generators are garbage collected.
+            record.cancel()
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+        db_time = record.timings['plan'] + record.timings['fetch']
+        record.timings['format'] = max(0.0, generate - db_time)
+        _record(record, status, time.time() - start)
+
+
+def _record(record, status, elapsed):
+    data = record.as_dict()
+    data.update(status=status, seconds=elapsed,
+                cancelled_queries=record.cancelled_queries,
+                rows_per_sec=record.rows / elapsed if elapsed else None)
+    LOG.info('export %s', simplejson.dumps(data, sort_keys=True))
+
+    with _lock:
+        _recent.append(data)
+        totals = _totals.setdefault(record.export, dict(
+            exports=0, rows=0, cached_rows=0, bytes=0, seconds=0.0,
+            timings=dict((phase, 0.0) for phase in PHASES),
+            cancelled=0, **dict((s, 0) for s in STATUSES)
+        ))
+        totals['exports'] += 1
+        totals[status] += 1
+        if record.cancelled_queries:
+            totals['cancelled'] += 1
+        totals['rows'] += record.rows
+        totals['cached_rows'] += record.cached_rows
+        totals['bytes'] += record.bytes
+        totals['seconds'] += elapsed
+        for phase in PHASES:
+            totals['timings'][phase] += record.timings[phase]
+
+
+def snapshot():
+    """
+    :returns:
+        A `dict` with the 'totals' of all of the exports run by this process,
+        by export type, and the records of the 'recent' ones.
+    """
+    with _lock:
+        return dict(totals=simplejson.loads(simplejson.dumps(_totals)),
+                    recent=list(_recent))
+
+
+def reset():
+    """
+    Forget all of the recorded exports.
+    """
+    with _lock:
+        _recent.clear()
+        _totals.clear()
@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2013, GEM Foundation.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/agpl.html>.
+
+"""
+Sharing of concurrent identical exports.
+
+Identical exports (see :func:`export_key`) running at the same time, in any
+web worker process, are run once. The first one starts a thread which runs
+the export and writes its output to a spool file in
+:data:`SINGLE_FLIGHT_DIR`. All of the requests, including the first one,
+stream the spool file as it grows. Once the export is complete, the spool
+file is deleted (readers keep their open copy), so that the next identical
+export runs again.
+
+The spool file is a sequence of records, each holding a 4-byte length
+followed by a chunk of the export. A zero length marks the end of the
+export, :data:`_FAILED` that it failed and :data:`_CANCELLED` that it was
+cancelled.
+
+The thread running the export holds an exclusive `flock` on the spool file
+until it is done, so that a spool file left behind by a killed process is
+told apart from the one of a slow export. Each request reading an export
+holds a lock on its own reader file, next to the spool file. While requests
+other than the first one read the export, it is not cancelled when the first
+request goes away or runs past its deadline (see
+:mod:`exposure.metrics`); once no request reads it anymore, its queries are
+cancelled.
+
+Sharing is disabled unless :data:`SINGLE_FLIGHT_DIR` is set.
+"""
+
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.db import connections
+
+from exposure import metrics
+
+LOG = logging.getLogger(__name__)
+
+#: Directory of the spool files. `None` disables the sharing of exports.
+SINGLE_FLIGHT_DIR = getattr(settings, 'EXPOSURE_SINGLE_FLIGHT_DIR', None)
+#: Time (in seconds) between two reads of a spool file which has no new data.
+POLL_INTERVAL = 0.05
+#: Time (in seconds) between two counts of the requests reading an export.
+READER_CHECK_INTERVAL = 0.5
+
+#: Parameters of the export views which change the export output.
+#: Compression is applied by each request to the shared output.
+KEY_PARAMS = ('outputType', 'adminLevel', 'residential', 'timeOfDay',
+              'lng1', 'lat1', 'lng2', 'lat2', 'polygon', 'regionLevel',
+              'regionId', 'aggregate', 'taxonomy', 'order')
+_COORDINATE_PARAMS = ('lng1', 'lat1', 'lng2', 'lat2')
+
+_RECORD_HEADER = struct.Struct('<I')
+_END = 0
+_FAILED = 0xffffffff
+_CANCELLED = 0xfffffffe
+_SPOOL_SUFFIX = '.spool'
+_READER_SUFFIX = '.reader'
+#: Suffix of the files being created, which are renamed (or linked) once
+#: locked.
+_TMP_SUFFIX = '.tmp'
+
+
+def enabled():
+    """
+    :returns:
+        `True` if the sharing of exports is configured.
+    """
+    return SINGLE_FLIGHT_DIR is not None
+
+
+def export_key(export, params):
+    """
+    :param str export:
+        'building' or 'population'.
+    :param params:
+        The parameters of the export view.
+    :returns:
+        A key identifying the output of the export.
+    """
+    items = []
+    for name in KEY_PARAMS:
+        value = params.get(name)
+        if value is None:
+            continue
+        if name in _COORDINATE_PARAMS:
+            try:
+                value = repr(float(value))
+            except ValueError:
+                pass
+        items.append((name, value))
+    return hashlib.sha1(repr((export, items))).hexdigest()
+
+
+def stream(key, chunks_func):
+    """
+    Yield the output of an export, shared with the identical exports running
+    at the same time.
+
+    :param key:
+        The key of the export (see :func:`export_key`).
+    :param chunks_func:
+        A function returning the output of the export, as an iterable of
+        strings. It's only called if no identical export is running, in its
+        own thread.
+    :raises exposure.metrics.ExportCancelled:
+        If the shared export was cancelled.
+    :raises RuntimeError:
+        If the shared export failed (the error is logged by the process
+        which ran it), or its process died.
+    """
+    if not enabled():
+        return chunks_func()
+    return _shared_stream(key, chunks_func)
+
+
+def _shared_stream(key, chunks_func):
+    if not os.path.isdir(SINGLE_FLIGHT_DIR):
+        try:
+            os.makedirs(SINGLE_FLIGHT_DIR)
+        except OSError:
+            # Created concurrently.
+            pass
+
+    # Registered before the spool is opened, so that the export is never
+    # seen without readers while this request joins it.
+    token = uuid.uuid4().hex
+    reader_lock = _register_reader(key, token)
+    try:
+        fh = _join_or_start(key, token, chunks_func)
+        try:
+            for chunk in _read_spool(fh):
+                yield chunk
+        finally:
+            fh.close()
+    finally:
+        _unregister_reader(key, token, reader_lock)
+
+
+def _path(*parts):
+    return os.path.join(SINGLE_FLIGHT_DIR, ''.join(parts))
+
+
+def _create_locked(path, operation):
+    """
+    Create a file, locked with `operation` (`fcntl.LOCK_SH` or
+    `fcntl.LOCK_EX`), under a temporary name.
+
+    :returns:
+        The file descriptor, and the temporary path.
+    """
+    tmp_path = '%s.%s%s' % (path, uuid.uuid4().hex, _TMP_SUFFIX)
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    fcntl.flock(fd, operation)
+    return fd, tmp_path
+
+
+def _is_locked(fd):
+    """
+    :returns:
+        `True` if another open file holds a lock on the file of `fd`.
+    """
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return True
+        raise
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    return False
+
+
+def _unlink_if_same(path, fd):
+    """
+    Delete `path`, unless it's not the file of `fd` anymore.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return
+    own = os.fstat(fd)
+    if (stat.st_dev, stat.st_ino) == (own.st_dev, own.st_ino):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def _register_reader(key, token):
+    """
+    Create the reader file of a request, locked while the request reads
+    the export.
+
+    :returns:
+        The file descriptor holding the lock.
+    """
+    path = _path(key, '.', token, _READER_SUFFIX)
+    fd, tmp_path = _create_locked(path, fcntl.LOCK_EX)
+    os.rename(tmp_path, path)
+    return fd
+
+
+def _unregister_reader(key, token, fd):
+    try:
+        os.unlink(_path(key, '.', token, _READER_SUFFIX))
+    except OSError:
+        pass
+    os.close(fd)
+
+
+def _live_readers(key):
+    """
+    :returns:
+        The tokens of the requests reading an export. Reader files left by
+        killed processes are deleted.
+    """
+    prefix = key + '.'
+    tokens = []
+    for name in os.listdir(SINGLE_FLIGHT_DIR):
+        if not (name.startswith(prefix) and name.endswith(_READER_SUFFIX)):
+            continue
+        path = os.path.join(SINGLE_FLIGHT_DIR, name)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            # Unregistered in the meantime.
+            continue
+        try:
+            if _is_locked(fd):
+                tokens.append(name[len(prefix):-len(_READER_SUFFIX)])
+            else:
+                _unlink_if_same(path, fd)
+        finally:
+            os.close(fd)
+    return tokens
+
+
+def _join_or_start(key, token, chunks_func):
+    """
+    Open the spool file of a running export, or start the export.
+
+    :returns:
+        The spool file, open for reading.
+    """
+    path = _path(key, _SPOOL_SUFFIX)
+    while True:
+        # The spool file is locked before it can be seen, so that an
+        # unlocked spool file means that its export is not running anymore.
+        fd, tmp_path = _create_locked(path, fcntl.LOCK_EX)
+        try:
+            os.link(tmp_path, path)
+        except OSError as e:
+            os.close(fd)
+            if e.errno != errno.EEXIST:
+                raise
+        else:
+            # Open the spool for reading before the export can delete it.
+            reader = open(path, 'rb')
+            state = _ExportState(key, token, metrics.current())
+            thread = threading.Thread(
+                target=_produce,
+                args=(os.fdopen(fd, 'wb'), path, chunks_func, state)
+            )
+            thread.daemon = True
+            thread.start()
+            return reader
+        finally:
+            os.unlink(tmp_path)
+
+        try:
+            reader = open(path, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                # Completed in the meantime.
+                continue
+            raise
+        # The export deletes its spool before releasing its lock: if it is
+        # unlocked and still there, its process died.
+        if _is_locked(reader.fileno()):
+            return reader
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Complete: the whole export can be read.
+            return reader
+        own = os.fstat(reader.fileno())
+        if (stat.st_dev, stat.st_ino) != (own.st_dev, own.st_ino):
+            # Replaced in the meantime.
+            reader.close()
+            continue
+        LOG.warning('Removing the abandoned export spool %s', path)
+        _unlink_if_same(path, reader.fileno())
+        reader.close()
+
+
+class _ExportState(object):
+    """
+    The readers of an export run by this process.
+
+    :param record:
+        The :class:`exposure.metrics.ExportRecord` of the request which
+        started the export, which gets the database timings, and through
+        which the export is cancelled.
+    """
+
+    def __init__(self, key, token, record):
+        self.key = key
+        #: Reader token of the request which started the export.
+        self.token = token
+        self.record = record
+        self.done = threading.Event()
+        #: Set once no request reads the export anymore.
+        self.abandoned = False
+
+    def watch(self):
+        """
+        Count the readers of the export until it is done: pin it while other
+        requests than the first one read it, and cancel it once none does.
+        """
+        while not self.done.wait(READER_CHECK_INTERVAL):
+            try:
+                tokens = _live_readers(self.key)
+            except OSError:
+                LOG.exception('Cannot count the readers of an export')
+                continue
+            if not tokens:
+                self.abandoned = True
+                if self.record is not None:
+                    self.record.cancellable = True
+                    self.record.cancel()
+                return
+            if self.record is not None:
+                self.record.cancellable = tokens == [self.token]
+
+
+def _produce(fh, path, chunks_func, state):
+    """
+    Run an export, writing its output to a (locked) spool file.
+    """
+    metrics.activate(state.record)
+    watcher = threading.Thread(target=state.watch)
+    watcher.daemon = True
+    watcher.start()
+    try:
+        try:
+            for chunk in chunks_func():
+                if state.abandoned:
+                    raise metrics.ExportCancelled()
+                if not chunk:
+                    continue
+                fh.write(_RECORD_HEADER.pack(len(chunk)))
+                fh.write(chunk)
+                fh.flush()
+            fh.write(_RECORD_HEADER.pack(_END))
+        except metrics.ExportCancelled:
+            fh.write(_RECORD_HEADER.pack(_CANCELLED))
+        except Exception:
+            LOG.exception('Shared export failed')
+            fh.write(_RECORD_HEADER.pack(_FAILED))
+        fh.flush()
+    finally:
+        state.done.set()
+        # From now on, identical exports run again. The spool is deleted
+        # before its lock is released (when closing it).
+        _unlink_if_same(path, fh.fileno())
+        fh.close()
+        metrics.activate(None)
+        # Each thread has its own connections.
+        connections['geddb'].close()
+
+
+def _read_spool(fh):
+    pos = 0
+    producer_gone = False
+    while True:
+        fh.seek(pos)
+        header = fh.read(_RECORD_HEADER.size)
+        if len(header) == _RECORD_HEADER.size:
+            [length] = _RECORD_HEADER.unpack(header)
+            if length == _END:
+                return
+            if length == _FAILED:
+                raise RuntimeError('The export failed')
+            if length == _CANCELLED:
+                raise metrics.ExportCancelled()
+            data = fh.read(length)
+            if len(data) == length:
+                pos = fh.tell()
+                yield data
+                continue
+
+        # Wait for the rest of the record, for as long as the export runs.
+        if producer_gone:
+            raise RuntimeError('The export was abandoned')
+        if not _is_locked(fh.fileno()):
+            # Read what it wrote before it stopped.
+            producer_gone = True
+            continue
+        time.sleep(POLL_INTERVAL)
@@ -1,15 +1,41 @@
+import gzip
+import math
 import mock
+import os
+import Queue
+import random
+import shutil
+import socket
+import StringIO
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
-
+import zipfile
+
+from exposure import batch
+from exposure import benchmark
+from exposure import bundles
+from exposure import columnar
+from exposure import compression
+from exposure import gridindex
+from exposure import jobs
+from exposure import metrics
+from exposure import singleflight
+from exposure import tilecache
 from exposure import util
+from exposure import vectortiles
 from exposure import views
 
 from django.http import HttpResponse
+from django.utils import simplejson
 
 
 class FakeUser(object):
-    def __init__(self, authed):
+    def __init__(self, authed, username='fake'):
         self.authed = authed
+        self.username = username
 
     def is_authenticated(self):
         return self.authed
@@ -44,6 +70,12 @@ class ExportBuildingTestCase(unittest.TestCase):
         self.get_dict = dict(lat1=8, lng1=45,
                              lat2=9, lng2=46,
                              outputType='nrml')
+        self.estimate_patch = mock.patch('exposure.util._estimate_export_rows',
+                                         return_value=None)
+        self.estimate_patch.start()
+
+    def tearDown(self):
+        self.estimate_patch.stop()
 
     def test_invalid_export_area(self):
         self.get_dict = dict(lat1=8, lng1=45,
@@ -67,8 +99,8 @@ class ExportBuildingTestCase(unittest.TestCase):
             views.export_building(request)
 
         expected_error = (
-            "Unrecognized output type 'pdf', only 'nrml' and 'csv' are "
-            "supported"
+            "Unrecognized output type 'pdf', only %s are supported"
+            % views._SUPPORTED_OUTPUT_TYPES_MSG
         )
         self.assertEqual(expected_error, ar.exception.message)
 
@@ -122,6 +154,12 @@ class ExportPopulationTestCase(unittest.TestCase):
             outputType='csv'
         )
         self.request = FakeHttpGetRequest(request_params)
+        self.estimate_patch = mock.patch('exposure.util._estimate_export_rows',
+                                         return_value=None)
+        self.estimate_patch.start()
+
+    def tearDown(self):
+        self.estimate_patch.stop()
 
     def test_invalid_output_type(self):
         self.request.GET['outputType'] = 'pdf'
@@ -129,8 +167,8 @@ class ExportPopulationTestCase(unittest.TestCase):
             views.export_population(self.request)
 
         expected_error = (
-            "Unrecognized output type 'pdf', only 'nrml' and 'csv' are "
-            "supported"
+            "Unrecognized output type 'pdf', only %s are supported"
+            % views._SUPPORTED_OUTPUT_TYPES_MSG
         )
         self.assertEqual(expected_error, ar.exception.message)
 
@@ -250,9 +288,9 @@ class StreamBuildingExposureTestCase(unittest.TestCase):
             self.assertEqual((('8.1', '45.2', '9.1', '46.2', 'day', [1]), {}),
                              gne.call_args)
 
-            # 6 rows expected: xml header, copyright, nrml header,
-            # two data rows, and nrml footer
-            self.assertEqual(7, len(result))
+            # 5 items expected: xml header, copyright, nrml header,
+            # one block of assets, and nrml footer
+            self.assertEqual(5, len(result))
             exp1 = """
             <asset id="1_8" number="10.8" taxonomy="8">
                 <location lon="2" lat="3" />
@@ -262,7 +300,6 @@ class StreamBuildingExposureTestCase(unittest.TestCase):
                     <occupancy occupants="10.8" period="transit" />
                 </occupancies>
             </asset>"""
-            self.assertEqual(exp1, result[3])
             exp2 = """
             <asset id="11_18" number="159.6" taxonomy="18">
                 <location lon="12" lat="13" />
@@ -273,12 +310,47 @@ class StreamBuildingExposureTestCase(unittest.TestCase):
                     <occupancy occupants="159.6" period="transit" />
                 </occupancies>
             </asset>"""
-            self.assertEqual(exp2, result[4])
             exp3 = """
             <asset id="20_27" number="23" taxonomy="27">
                 <location lon="21" lat="22" />
             </asset>"""
-            self.assertEqual(exp3, result[5])
+            self.assertEqual(exp1 + exp2 + exp3, result[3])
+
+    @unittest.skipUnless(views.numpy, 'NumPy is not installed')
+    def test_nrml_admin0_block_is_vectorized(self):
+        rows = [
+            (1, 8.5, 45.25, 1234.5678, 5, 'ITA', 7, 'MUR/LWAL', 0.1,
+             0.123456789, None, 0.3),
+            (2, 8.75, 45.5, 17, 5, 'ITA', 7, 'CR/LFINF', 0.7,
+             0.4, None, 0.6),
+            (3, 9.0, 45.75, 1e20 / 3, 5, 'ITA', 7, 'W', 1.0 / 3,
+             1.0, None, 1e-7),
+        ]
+        expected = ''.join(views._bldg_nrml_admin0_assets(rows))
+        with mock.patch('exposure.views._bldg_nrml_admin0_assets') as assets:
+            self.assertEqual(expected, views._bldg_nrml_admin0_block(rows))
+        self.assertEqual(0, assets.call_count)
+
+    def test_nrml_admin0_block_without_tod(self):
+        rows = [(1, 8.5, 45.25, 1234.5678, 5, 'ITA', 7, 'W', 0.1,
+                 None, None, None),
+                (2, 8.75, 45.5, 17, 5, 'ITA', 7, 'W', 0.7,
+                 None, None, None)]
+        self.assertEqual(''.join(views._bldg_nrml_admin0_assets(rows)),
+                         views._bldg_nrml_admin0_block(rows))
+
+    def test_nrml_admin0_block_fallback(self):
+        # Missing ratios, and values which NumPy would not multiply the same
+        # way as Python:
+        for rows in (
+                [(1, 8.5, 45.25, 100.0, 5, 'ITA', 7, 'W', 0.5, 0.2, None,
+                  None),
+                 (2, 8.5, 45.25, 100.0, 5, 'ITA', 7, 'W', 0.5, None, None,
+                  None)],
+                [(1, 8.5, 45.25, 100, 5, 'ITA', 7, 'W', 1, 2, None, None)]):
+            expected = ''.join(views._bldg_nrml_admin0_assets(rows))
+            self.assertEqual(expected, views._bldg_nrml_admin0_block(rows))
+        self.assertIn('<occupancy occupants="200" period="day" />', expected)
 
     def test_stream_admin_1_csv(self):
         self.request.GET['adminLevel'] = 'admin1'
@@ -451,12 +523,2433 @@ class ValidateExportTestCase(unittest.TestCase):
             'lat2': '47.0',
         }
         self.request = FakeHttpGetRequest(req_params)
+        self.estimate_patch = mock.patch('exposure.util._estimate_export_rows',
+                                         return_value=None)
+        self.estimate_rows = self.estimate_patch.start()
+
+    def tearDown(self):
+        self.estimate_patch.stop()
 
     def test_valid(self):
         resp = views.validate_export(self.request)
         self.assertEqual(200, resp.status_code)
+        self.assertEqual(None, simplejson.loads(resp.content)['rows'])
 
     def test_invalid(self):
         self.request.GET['lat2'] = '47.001'
+        with mock.patch('exposure.views.MAX_ASYNC_EXPORT_AREA_SQ_DEG', 4):
+            resp = views.validate_export(self.request)
+        self.assertEqual(403, resp.status_code)
+
+    def test_invalid_residential(self):
+        self.request.GET['residential'] = 'bogus'
+        resp = views.validate_export(self.request)
+        self.assertEqual(403, resp.status_code)
+        self.assertEqual("Invalid 'residential' selection: 'bogus'. "
+                         "Expected 'res', 'non-res', or 'both'.",
+                         resp.content)
+
+    def test_invalid_compression(self):
+        self.request.GET['compress'] = 'rar'
+        resp = views.validate_export(self.request)
+        self.assertEqual(403, resp.status_code)
+        self.assertEqual("Unrecognized compression 'rar', only 'zip' is "
+                         "supported", resp.content)
+
+    def test_background_job(self):
+        self.request.GET['lat2'] = '47.001'
+        resp = views.validate_export(self.request)
+        self.assertEqual(202, resp.status_code)
+
+    def test_estimate(self):
+        # With row counts, a large area with little data can be exported
+        # directly:
+        self.request.GET['lat2'] = '50.0'
+        self.request.GET['timeOfDay'] = 'all'
+        self.estimate_rows.return_value = 1000
+        resp = views.validate_export(self.request)
+
+        self.assertEqual(200, resp.status_code)
+        result = simplejson.loads(resp.content)
+        self.assertEqual(1000, result['rows'])
+        # One CSV row per time of day:
+        self.assertEqual(1000 * 3 * 85, result['bytes'])
+        self.assertEqual((('admin0', '8.0', '45.0', '10.0', '50.0'),
+                          dict(occupancy=[0])),
+                         self.estimate_rows.call_args)
+
+    def test_estimate_population(self):
+        del self.request.GET['adminLevel']
+        self.estimate_rows.return_value = 10
         resp = views.validate_export(self.request)
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(dict(rows=10, bytes=500),
+                         dict((k, v) for k, v in
+                              simplejson.loads(resp.content).items()
+                              if k != 'message'))
+        self.assertEqual('population', self.estimate_rows.call_args[0][0])
+
+    def test_estimate_background_job(self):
+        self.estimate_rows.return_value = views.MAX_EXPORT_ROWS + 1
+        resp = views.validate_export(self.request)
+        self.assertEqual(202, resp.status_code)
+
+    def test_estimate_too_large(self):
+        # A small area with too much data is refused:
+        self.estimate_rows.return_value = views.MAX_ASYNC_EXPORT_ROWS + 1
+        resp = views.validate_export(self.request)
+        self.assertEqual(403, resp.status_code)
+
+    def test_estimate_export_building(self):
+        # Direct exports can't fall back to background jobs:
+        self.estimate_rows.return_value = views.MAX_EXPORT_ROWS + 1
+        with mock.patch('exposure.views._stream_building_exposure') as sbe:
+            resp = views.export_building(self.request)
+
+        self.assertEqual(403, resp.status_code)
+        self.assertEqual(0, sbe.call_count)
+
+
+class StreamQueryTestCase(unittest.TestCase):
+
+    def test_fetches_in_batches_from_named_cursor(self):
+        with mock.patch('exposure.util.connections') as conns:
+            named_cursor = conns['geddb'].connection.cursor.return_value
+            named_cursor.fetchmany.side_effect = [[(1, ), (2, )], [(3, )], []]
+
+            rows = util._stream_query('SELECT 1', [1, 2], fetch_size=2)
+            # Nothing is executed until the rows are consumed:
+            self.assertEqual(0, named_cursor.execute.call_count)
+
+            self.assertEqual([(1, ), (2, ), (3, )], list(rows))
+
+            cursor_kwargs = conns['geddb'].connection.cursor.call_args[1]
+            self.assertTrue(cursor_kwargs['name'].startswith('exposure_'))
+            self.assertEqual((('SELECT 1', [1, 2]), {}),
+                             named_cursor.execute.call_args)
+            self.assertEqual([((2, ), {})] * 3,
+                             named_cursor.fetchmany.call_args_list)
+            self.assertEqual(1, named_cursor.close.call_count)
+
+
+class ParallelQueryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Points every 0.5 degrees, some of them on the strip edges, with
+        # ids unrelated to their location.
+        self.points = []
+        for i in range(21):
+            for j in range(5):
+                self.points.append((((i * 5 + j) * 37) % 105,
+                                    i * 0.5, j * 0.5))
+        self.points.sort()
+
+        def query(lng1, lat1, lng2, lat2, tag):
+            return iter([pt + (tag, ) for pt in self.points
+                         if lng1 <= pt[1] <= lng2 and lat1 <= pt[2] <= lat2])
+
+        self.query = mock.Mock(side_effect=query)
+
+    def test_merged_in_id_order(self):
+        expected = list(self.query(0, 0, 10, 2, 'x'))
+        self.query.reset_mock()
+
+        with mock.patch('exposure.util.EXPORT_FETCH_SIZE', 3):
+            rows = list(util.get_exposure(self.query, '10', '0', '0', '2',
+                                          'x', workers=4))
+
+        self.assertEqual(expected, rows)
+        self.assertEqual(4, self.query.call_count)
+        self.assertEqual([(0.0, 0.0, 2.5, 2.0, 'x'), (2.5, 0.0, 5.0, 2.0, 'x'),
+                          (5.0, 0.0, 7.5, 2.0, 'x'),
+                          (7.5, 0.0, 10.0, 2.0, 'x')],
+                         sorted(c[0] for c in self.query.call_args_list))
+
+    def test_small_area_is_not_split(self):
+        list(util.get_exposure(self.query, '0', '0', '1', '0.5', 'x',
+                               workers=4))
+        self.assertEqual((('0', '0', '1', '0.5', 'x'), {}),
+                         self.query.call_args)
+
+    def test_error(self):
+        def query(lng1, lat1, lng2, lat2):
+            if lng1 > 0:
+                raise RuntimeError('query failed')
+            return iter([(1, 0.0, 0.0)])
+
+        with self.assertRaises(RuntimeError) as ar:
+            list(util.get_exposure(query, '0', '0', '10', '10', workers=2))
+        self.assertEqual('query failed', ar.exception.message)
+
+    def test_stopped_query_closed(self):
+        closed = []
+        queries = []
+
+        def rows():
+            try:
+                for i in xrange(10):
+                    yield (i, 0.0, 0.0)
+            finally:
+                closed.append('query')
+
+        def query():
+            # Referenced elsewhere, the rows are not closed when the thread
+            # drops them.
+            queries.append(rows())
+            return queries[-1]
+
+        # Nothing reads the rows, and the export is stopped:
+        queue = Queue.Queue(maxsize=1)
+        stop = threading.Event()
+        stop.set()
+        with mock.patch('exposure.util.EXPORT_FETCH_SIZE', 3):
+            with mock.patch('exposure.util.connections') as connections:
+                connections['geddb'].close.side_effect = (
+                    lambda: closed.append('connection')
+                )
+                util._query_strip(query, (), None, queue, stop, None)
+
+        self.assertEqual(['query', 'connection'], closed)
+        self.assertTrue(queue.empty())
+
+
+class CoalesceTestCase(unittest.TestCase):
+
+    def test_coalesce(self):
+        chunks = list(util.coalesce(['ab', 'c', 'def', 'g', 'hi'],
+                                    chunk_size=3))
+        self.assertEqual(['abc', 'def', 'ghi'], chunks)
+
+    def test_coalesce_remainder(self):
+        chunks = list(util.coalesce(['abcd', 'e'], chunk_size=3))
+        self.assertEqual(['abcd', 'e'], chunks)
+
+    def test_coalesce_empty(self):
+        self.assertEqual([], list(util.coalesce([], chunk_size=3)))
+
+
+class NumberFormatTestCase(unittest.TestCase):
+
+    def test_format_numbers(self):
+        values = [1234.5678901234567, 2, 0.125]
+        self.assertEqual(['1234.57', '2.00', '0.12'],
+                         util.format_numbers(values, 2))
+        self.assertEqual([str(v) for v in values],
+                         util.format_numbers(values, None))
+        self.assertEqual([], util.format_numbers([], 2))
+
+    def test_fixed_precision_csv(self):
+        rows = [(1, 8.123456789, 45.0, 1234.5678901234567, 'ITA')]
+        with mock.patch('exposure.views.POPULATION_DECIMALS', 2):
+            with mock.patch('exposure.views.COORDINATE_DECIMALS', 5):
+                result = list(views._pop_csv_generator(rows))
+
+        self.assertEqual('ITA,1234.57,1,8.12346,45.00000\n', result[2])
+
+    def test_fixed_precision_csv_rows(self):
+        rows = [(1, 8.5, 45.25, 1234.5678, 5, 'ITA', 7, 'MUR', 0.1,
+                 0.123456789, None, 0.3),
+                (2, 8.75, 45.5, 10.0, 5, 'ITA', 7, 'W', 0.5, None, None,
+                 None)]
+        with mock.patch('exposure.views.POPULATION_DECIMALS', 2):
+            with mock.patch('exposure.views.COORDINATE_DECIMALS', 1):
+                admin0 = list(views._bldg_csv_admin0_generator(rows))
+                subnat = list(views._bldg_csv_subnat_generator(
+                    [row[:9] for row in rows]
+                ))
+
+        self.assertEqual(['ITA,15.24,1,8.5,45.2,7,5,MUR,day\n',
+                          'ITA,37.04,1,8.5,45.2,7,5,MUR,transit\n',
+                          'ITA,10.00,2,8.8,45.5,7,5,W,\n'],
+                         admin0[2:])
+        self.assertEqual(['ITA,123.46,1,8.5,45.2,7,5,MUR\n',
+                          'ITA,5.00,2,8.8,45.5,7,5,W\n'],
+                         subnat[2:])
+
+    def test_fixed_precision_nrml(self):
+        rows = [(1, 8.5, 45.25, 1234.5678, 5, 'ITA', 7, 'MUR/LWAL', 0.1,
+                 0.123456789, None, 0.3)]
+        with mock.patch('exposure.views.POPULATION_DECIMALS', 2):
+            with mock.patch('exposure.views.COORDINATE_DECIMALS', 1):
+                asset = ''.join(views._bldg_nrml_admin0_assets(rows))
+                block = views._bldg_nrml_admin0_block(rows)
+
+        self.assertEqual(asset, block)
+        self.assertIn('<asset id="1_MUR/LWAL" number="37.04" '
+                      'taxonomy="MUR/LWAL">', asset)
+        self.assertIn('<location lon="8.5" lat="45.2" />', asset)
+        self.assertIn('<occupancy occupants="15.24" period="day" />', asset)
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = util.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # touch 'a', so that 'b' is the least recently used
+        self.assertEqual(1, cache.get('a'))
+        cache.set('c', 3)
+
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+
+
+class AvailableAdminLevelsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        util._ADMIN_LEVEL_CACHE.clear()
+
+    def test_snap_to_cells(self):
+        self.assertEqual((80, 452, 91, 462),
+                         util._snap_to_cells('9.15', '46.25', '8.05', '45.25',
+                                             0.1))
+        self.assertEqual((-2, -1, 0, 0),
+                         util._snap_to_cells(-0.15, -0.05, 0.05, 0.05, 0.1))
+
+    def test_without_index(self):
+        with mock.patch('exposure.util._admin_level_index_exists') as alie:
+            alie.return_value = False
+            with mock.patch('exposure.util._query_available_admin_levels') \
+                    as qaal:
+                qaal.return_value = [0, 1]
+                levels = util._get_available_admin_levels('8.1', '45.2',
+                                                          '9.1', '46.2')
+
+        self.assertEqual([0, 1], levels)
+        self.assertEqual((('8.1', '45.2', '9.1', '46.2'), {}),
+                         qaal.call_args)
+
+    def test_with_index_is_cached(self):
+        with mock.patch('exposure.util._admin_level_index_exists') as alie:
+            alie.return_value = True
+            with mock.patch('exposure.util._query_admin_level_index') as qali:
+                qali.return_value = (0, 2)
+                levels1 = util._get_available_admin_levels('8.12', '45.23',
+                                                           '9.15', '46.27')
+                # Same cells, slightly different box:
+                levels2 = util._get_available_admin_levels('8.17', '45.28',
+                                                           '9.13', '46.21')
+
+        self.assertEqual([0, 2], levels1)
+        self.assertEqual([0, 2], levels2)
+        self.assertEqual(1, qali.call_count)
+        self.assertEqual(((81, 452, 91, 462), {}), qali.call_args)
+
+
+class ExportJobViewsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.params = {
+            'exportType': 'population',
+            'outputType': 'csv',
+            'lng1': '0',
+            'lat1': '40',
+            'lng2': '10',
+            'lat2': '50',
+        }
+        self.estimate_patch = mock.patch('exposure.util._estimate_export_rows',
+                                         return_value=None)
+        self.estimate_patch.start()
+
+    def tearDown(self):
+        self.estimate_patch.stop()
+
+    def test_submit(self):
+        request = FakeHttpPostRequest(self.params)
+        with mock.patch('exposure.jobs.submit') as submit:
+            submit.return_value = 'a' * 32
+            resp = views.submit_export_job(request)
+
+        self.assertEqual(202, resp.status_code)
+        self.assertEqual({'job_id': 'a' * 32}, simplejson.loads(resp.content))
+        self.assertEqual((('fake', views._stream_population_exposure,
+                           self.params, 'csv', 'text/csv',
+                           'exposure_export.csv'),
+                          {'estimated_rows': None}),
+                         submit.call_args)
+
+    def test_submit_too_large(self):
+        request = FakeHttpPostRequest(self.params)
+        with mock.patch('exposure.views.MAX_ASYNC_EXPORT_AREA_SQ_DEG', 99):
+            with mock.patch('exposure.jobs.submit') as submit:
+                resp = views.submit_export_job(request)
+
         self.assertEqual(403, resp.status_code)
+        self.assertEqual(0, submit.call_count)
+
+    def test_status_of_other_users_job(self):
+        request = FakeHttpGetRequest(dict(job_id='a' * 32))
+        with mock.patch('exposure.jobs.get_status') as get_status:
+            get_status.return_value = dict(status=jobs.RUNNING, bytes=10,
+                                           user='someone_else')
+            resp = views.export_job_status(request)
+
+        self.assertEqual(404, resp.status_code)
+
+    def test_status(self):
+        request = FakeHttpGetRequest(dict(job_id='a' * 32))
+        with mock.patch('exposure.jobs.get_status') as get_status:
+            get_status.return_value = dict(status=jobs.RUNNING, bytes=10,
+                                           rows=2, estimated_rows=8,
+                                           user='fake')
+            resp = views.export_job_status(request)
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(dict(status='running', bytes=10, rows=2,
+                              estimated_rows=8, error=None),
+                         simplejson.loads(resp.content))
+
+
+def _fake_job_stream(request, output_type):
+    # Export generators of the background jobs must be importable.
+    metrics.current().add_db_time('fetch', 0.0, rows=3)
+    yield 'x,%s\n' % request.GET['lat1']
+    metrics.current().add_cached_rows(2)
+    yield output_type
+
+
+def _failing_job_stream(request, output_type):
+    yield 'x'
+    raise ValueError('Boom')
+
+
+class ExportJobsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.job_dir = tempfile.mkdtemp()
+        self.patches = [
+            mock.patch('exposure.jobs.EXPORT_JOB_DIR', self.job_dir),
+            mock.patch('exposure.jobs.EXPORT_JOB_WORKERS', 0),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.job_dir)
+
+    def _submit(self, stream_func=_fake_job_stream, **kwargs):
+        return jobs.submit('fake', stream_func, dict(lat1='1.5'), 'csv',
+                           'text/csv', 'exposure_export.csv', **kwargs)
+
+    def _set_status(self, job_id, **kwargs):
+        status = jobs.get_status(job_id)
+        status.update(kwargs)
+        jobs._write_status(job_id, status)
+
+    def test_submit(self):
+        job_id = self._submit(estimated_rows=10)
+
+        status = jobs.get_status(job_id)
+        self.assertEqual(jobs.QUEUED, status['status'])
+        self.assertEqual(10, status['estimated_rows'])
+        self.assertEqual([job_id], jobs._queued_jobs())
+
+    def test_run(self):
+        job_id = self._submit(estimated_rows=10)
+
+        self.assertTrue(jobs.run_next())
+
+        status = jobs.get_status(job_id)
+        self.assertEqual(jobs.COMPLETE, status['status'])
+        self.assertEqual(9, status['bytes'])
+        self.assertEqual(5, status['rows'])
+        self.assertEqual(10, status['estimated_rows'])
+        self.assertEqual(os.getpid(), status['pid'])
+        self.assertIn('heartbeat', status)
+        with open(jobs.result_path(job_id)) as fh:
+            self.assertEqual('x,1.5\ncsv', fh.read())
+        # Each job is run once.
+        self.assertFalse(jobs.run_next())
+
+    def test_run_failure(self):
+        job_id = self._submit(_failing_job_stream)
+
+        with mock.patch('exposure.jobs.LOG') as log:
+            self.assertTrue(jobs.run_next())
+
+        status = jobs.get_status(job_id)
+        self.assertEqual(jobs.FAILED, status['status'])
+        self.assertEqual('Boom', status['error'])
+        self.assertFalse(os.path.exists(jobs.result_path(job_id)))
+        self.assertEqual(
+            (('Export job %s failed', job_id), {}), log.exception.call_args
+        )
+
+    def test_oldest_job_first(self):
+        first = self._submit()
+        second = self._submit()
+        self._set_status(first, submitted=time.time() + 1)
+
+        self.assertEqual([second, first], jobs._queued_jobs())
+
+    def test_claimed_job_is_skipped(self):
+        job_id = self._submit()
+
+        fd = jobs._claim(job_id)
+        try:
+            self.assertIsNone(jobs._claim(job_id))
+            self.assertFalse(jobs.run_next())
+        finally:
+            os.close(fd)
+        self.assertEqual(jobs.QUEUED, jobs.get_status(job_id)['status'])
+        self.assertTrue(jobs.run_next())
+
+    def test_running_job(self):
+        job_id = self._submit()
+        self._set_status(job_id, status=jobs.RUNNING, pid=os.getpid(),
+                         host=socket.gethostname(), heartbeat=time.time())
+
+        self.assertEqual(jobs.RUNNING, jobs.get_status(job_id)['status'])
+
+    def test_job_of_dead_process(self):
+        job_id = self._submit()
+        process = subprocess.Popen(['true'])
+        process.wait()
+        self._set_status(job_id, status=jobs.RUNNING, pid=process.pid,
+                         host=socket.gethostname(), heartbeat=time.time())
+
+        with mock.patch('exposure.jobs.LOG') as log:
+            status = jobs.get_status(job_id)
+
+        self.assertEqual(jobs.FAILED, status['status'])
+        self.assertEqual('The export job was interrupted', status['error'])
+        self.assertEqual(1, log.error.call_count)
+        # The failure is recorded.
+        self.assertEqual(jobs.FAILED, jobs._read_file(
+            job_id, jobs.STATUS_FILE
+        )['status'])
+
+    def test_job_without_heartbeat(self):
+        job_id = self._submit()
+        self._set_status(job_id, status=jobs.RUNNING, pid=os.getpid(),
+                         host='elsewhere',
+                         heartbeat=time.time() - jobs.HEARTBEAT_TIMEOUT - 1)
+
+        with mock.patch('exposure.jobs.LOG'):
+            self.assertEqual(jobs.FAILED, jobs.get_status(job_id)['status'])
+
+    def test_heartbeat(self):
+        job_id = self._submit()
+        job = jobs._RunningJob(job_id, jobs.get_status(job_id))
+        stop = threading.Event()
+        stop.set()
+        job.beat(stop)
+        self.assertNotIn('heartbeat', jobs.get_status(job_id))
+
+        with mock.patch('exposure.jobs.HEARTBEAT_INTERVAL', 0.01):
+            stop = threading.Event()
+            thread = threading.Thread(target=job.beat, args=(stop, ))
+            thread.start()
+            time.sleep(0.05)
+            stop.set()
+            thread.join()
+        self.assertIn('heartbeat', jobs.get_status(job_id))
+
+    def test_get_status_invalid_job_id(self):
+        self.assertIsNone(jobs.get_status('../../etc'))
+
+    def test_purge_old_jobs(self):
+        old_job_id = self._submit()
+        job_id = self._submit()
+        mtime = time.time() - jobs.EXPORT_JOB_MAX_AGE - 1
+        os.utime(jobs._job_dir(old_job_id), (mtime, mtime))
+        # A job purged while the others are listed is skipped.
+        listdir = os.listdir
+
+        def fake_listdir(path):
+            if path == self.job_dir:
+                return listdir(path) + ['b' * 32]
+            return listdir(path)
+
+        with mock.patch('os.listdir', side_effect=fake_listdir):
+            jobs._purge_old_jobs()
+
+        self.assertEqual([job_id], os.listdir(self.job_dir))
+
+
+class CompressionTestCase(unittest.TestCase):
+
+    def test_gzip_stream(self):
+        chunks = ['abc,%s\n' % i for i in xrange(1000)]
+        data = ''.join(compression.gzip_stream(iter(chunks)))
+
+        self.assertEqual(''.join(chunks),
+                         gzip.GzipFile(fileobj=StringIO.StringIO(data)).read())
+
+    def test_zip_stream(self):
+        members = [('a.csv', iter(['a,1\n', 'a,2\n'])),
+                   ('b.xml', iter(['<b />']))]
+        data = ''.join(compression.zip_stream(members))
+
+        archive = zipfile.ZipFile(StringIO.StringIO(data))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(['a.csv', 'b.xml'], archive.namelist())
+        self.assertEqual('a,1\na,2\n', archive.read('a.csv'))
+        self.assertEqual('<b />', archive.read('b.xml'))
+
+    def test_zip64_stream(self):
+        # Lower the limits, so that every size, offset and count needs a
+        # ZIP64 record.
+        members = [('a.csv', iter(['a,1\n', 'a,2\n'])),
+                   ('b.xml', iter(['<b />']))]
+        with mock.patch.multiple('exposure.compression', _ZIP64_LIMIT=4,
+                                 _ZIP64_COUNT_LIMIT=1):
+            data = ''.join(compression.zip_stream(members))
+
+        self.assertIn('PK\x06\x06', data)
+        archive = zipfile.ZipFile(StringIO.StringIO(data))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(['a.csv', 'b.xml'], archive.namelist())
+        self.assertEqual([8, 5], [info.file_size
+                                  for info in archive.infolist()])
+        self.assertEqual('a,1\na,2\n', archive.read('a.csv'))
+        self.assertEqual('<b />', archive.read('b.xml'))
+
+
+class ExportResponseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.request = FakeHttpGetRequest(dict())
+
+    def test_uncompressed(self):
+        resp = views._export_response(self.request, iter(['a', 'b']),
+                                      'text/csv', 'exposure_export.csv')
+
+        self.assertFalse(resp.has_header('Content-Encoding'))
+        self.assertEqual('ab', resp.content)
+
+    def test_gzip(self):
+        self.request.META['HTTP_ACCEPT_ENCODING'] = 'deflate, gzip;q=0.5'
+        resp = views._export_response(self.request, iter(['a', 'b']),
+                                      'text/csv', 'exposure_export.csv')
+
+        self.assertEqual('gzip', resp['Content-Encoding'])
+        self.assertEqual('text/csv', resp['Content-Type'])
+        self.assertEqual(
+            'ab', gzip.GzipFile(fileobj=StringIO.StringIO(resp.content)).read()
+        )
+
+    def test_gzip_refused(self):
+        self.request.META['HTTP_ACCEPT_ENCODING'] = 'gzip;q=0'
+        resp = views._export_response(self.request, iter(['a', 'b']),
+                                      'text/csv', 'exposure_export.csv')
+
+        self.assertFalse(resp.has_header('Content-Encoding'))
+
+    def test_zip(self):
+        self.request.GET['compress'] = 'zip'
+        self.request.META['HTTP_ACCEPT_ENCODING'] = 'gzip'
+        resp = views._export_response(self.request, iter(['a', 'b']),
+                                      'text/csv', 'exposure_export.csv')
+
+        self.assertFalse(resp.has_header('Content-Encoding'))
+        self.assertEqual('application/zip', resp['Content-Type'])
+        self.assertEqual('attachment; filename="exposure_export.csv.zip"',
+                         resp['Content-Disposition'])
+        archive = zipfile.ZipFile(StringIO.StringIO(resp.content))
+        self.assertEqual('ab', archive.read('exposure_export.csv'))
+
+    def test_invalid_compression(self):
+        self.request.GET['compress'] = 'rar'
+        with self.assertRaises(ValueError) as ar:
+            views._export_response(self.request, iter([]), 'text/csv',
+                                   'exposure_export.csv')
+
+        self.assertEqual("Unrecognized compression 'rar', only 'zip' is "
+                         "supported", ar.exception.message)
+
+
+@unittest.skipUnless(columnar.available(), 'requires NumPy')
+class ColumnarExportTestCase(unittest.TestCase):
+
+    def _load(self, chunks):
+        return columnar.numpy.load(StringIO.StringIO(''.join(chunks)),
+                                   allow_pickle=False)
+
+    def test_bldg_admin0(self):
+        rows = [[1, 2, 3, 4, 5, 'ITA', 7, 'MUR', 0.5, None, 0.2, None],
+                [11, 12, 13, 10, 15, 'CHE', 17, 'CR', 0.5, 0.4, 0.5, 0.6],
+                [20, 21, 22, 20, 5, 'ITA', 26, 'MUR', 0.25, None, None, None]]
+        npz = self._load(columnar.bldg_admin0_generator(iter(rows)))
+
+        self.assertEqual([1, 11, 20], list(npz['grid_id']))
+        self.assertEqual([2, 12, 21], list(npz['lon']))
+        self.assertEqual([2, 5, 5], list(npz['population']))
+        self.assertEqual(['ITA', 'CHE', 'ITA'],
+                         list(npz['iso'][npz['iso_code']]))
+        self.assertEqual(['MUR', 'CR', 'MUR'],
+                         list(npz['taxonomy'][npz['taxonomy_code']]))
+        self.assertEqual('int32', npz['taxonomy_code'].dtype)
+        self.assertEqual(0.4, npz['night'][0])
+        self.assertEqual([2.0, 2.5, 3.0], [npz['day'][1], npz['night'][1],
+                                           npz['transit'][1]])
+        # times of day which were not requested are NaN
+        self.assertTrue(columnar.numpy.isnan(npz['day'][0]))
+        self.assertTrue(columnar.numpy.isnan(npz['transit'][2]))
+
+    def test_pop(self):
+        rows = [[1, 2, 3, 4, 'ITA'], [6, 7, 8, 9, 'ITA']]
+        npz = self._load(columnar.pop_generator(iter(rows)))
+
+        self.assertEqual(['grid_id', 'iso', 'iso_code', 'lat', 'lon',
+                          'population'], sorted(npz.files))
+        self.assertEqual([4, 9], list(npz['population']))
+        self.assertEqual(['ITA'], list(npz['iso']))
+
+    def test_empty(self):
+        npz = self._load(columnar.pop_generator(iter([])))
+
+        self.assertEqual(0, len(npz['grid_id']))
+        self.assertEqual(0, len(npz['iso']))
+
+    def test_null_strings(self):
+        rows = [[1, 2, 3, 4, 5, None, 7, 'MUR', 0.5],
+                [11, 12, 13, 10, 15, 'CHE', 17, None, 0.5]]
+        npz = self._load(columnar.bldg_subnat_generator(iter(rows)))
+
+        self.assertEqual(['', 'CHE'], list(npz['iso'][npz['iso_code']]))
+        self.assertEqual(['MUR', ''],
+                         list(npz['taxonomy'][npz['taxonomy_code']]))
+        self.assertNotEqual(object, npz['iso'].dtype)
+
+
+class CellCountsTestCase(unittest.TestCase):
+
+    def test_without_cell_counts(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = False
+            rows = util._estimate_export_rows('admin0', '8.1', '45.2', '9.1',
+                                              '46.2', occupancy=[0])
+
+        self.assertEqual(None, rows)
+        self.assertEqual((('ged2.exposure_cell_count', ), {}), te.call_args)
+
+    def test_estimate(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = True
+            with mock.patch('exposure.util.connections') as conns:
+                cursor = conns['geddb'].cursor.return_value
+                cursor.fetchall.return_value = [(1234.6, )]
+                rows = util._estimate_export_rows('admin0', '9.15', '46.25',
+                                                  '8.05', '45.25',
+                                                  occupancy=[0, 1])
+
+        self.assertEqual(1235, rows)
+        query, args = cursor.execute.call_args[0]
+        self.assertIn('FROM ged2.exposure_cell_count', query)
+        self.assertIn('AND dist_occupancy_id IN (0, 1)', query)
+        self.assertIn('AND pop_occupancy_id IN (0, 1)', query)
+        self.assertEqual('admin0', args['export'])
+        # The bounding box is normalized, and snapped to cells:
+        self.assertEqual((8.05, 9.15, 45.25, 46.25),
+                         (args['lng1'], args['lng2'], args['lat1'],
+                          args['lat2']))
+        self.assertEqual((80, 452, 91, 462),
+                         (args['x1'], args['y1'], args['x2'], args['y2']))
+
+    def test_estimate_population(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.side_effect = lambda table: table == util.CELL_COUNT_TABLE
+            with mock.patch('exposure.util.connections') as conns:
+                cursor = conns['geddb'].cursor.return_value
+                cursor.fetchall.return_value = [(0, )]
+                rows = util._estimate_export_rows('population', '8.1',
+                                                  '45.2', '9.1', '46.2')
+
+        self.assertEqual(0, rows)
+        query, _ = cursor.execute.call_args[0]
+        self.assertNotIn('occupancy_id', query)
+
+
+class PopulationPyramidTestCase(unittest.TestCase):
+
+    def _simulate(self, points, bbox):
+        # Evaluate the decomposition as the queries of `population_total`
+        # would.
+        blocks, rest = util._pyramid_blocks(*bbox)
+
+        def in_block(lon, lat, block):
+            level, x1, y1, x2, y2 = block
+            size = util.POPULATION_PYRAMID_CELL_SIZES[level]
+            return (x1 <= math.floor(lon / size) <= x2
+                    and y1 <= math.floor(lat / size) <= y2)
+
+        count = 0
+        for lon, lat in points:
+            count += sum(1 for block in blocks if in_block(lon, lat, block))
+            if (any(r[0] <= lon <= r[2] and r[1] <= lat <= r[3]
+                    for r in rest)
+                    and not any(in_block(lon, lat, b) for b in blocks)):
+                count += 1
+        return count
+
+    def test_blocks_cover_bbox_once(self):
+        # A grid of points, on cell edges and in between:
+        points = [(8 + i / 80.0, 45 + j / 80.0)
+                  for i in xrange(241) for j in xrange(161)]
+        for bbox in [(8.0, 45.0, 10.0, 47.0), (8.1, 45.2, 10.6, 46.9),
+                     (8.0125, 45.3, 8.0125, 46.0), (9.5, 45.5, 9.75, 45.75),
+                     (8.33, 45.01, 10.99, 46.99)]:
+            expected = sum(1 for lon, lat in points
+                           if bbox[0] <= lon <= bbox[2]
+                           and bbox[1] <= lat <= bbox[3])
+            self.assertEqual(expected, self._simulate(points, bbox))
+
+    def test_blocks(self):
+        blocks, rest = util._pyramid_blocks(8.0, 45.0, 10.0, 47.0)
+        self.assertEqual([(0, 8, 45, 9, 46)], blocks)
+        # Only the points on the edges are read at native resolution:
+        self.assertEqual([(8.0, 45.0, 8.0, 47.0), (10.0, 45.0, 10.0, 47.0),
+                          (8.0, 45.0, 10.0, 45.0), (8.0, 47.0, 10.0, 47.0)],
+                         rest)
+
+    def test_total(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = True
+            with mock.patch('exposure.util.connections') as conns:
+                cursor = conns['geddb'].cursor.return_value
+                cursor.fetchall.return_value = [(1234.5, 12L)]
+                total = util.population_total('10.0', '47.0', '8.0', '45.0')
+
+        self.assertEqual(dict(population=1234.5, grid_points=12), total)
+        query, args = cursor.execute.call_args[0]
+        self.assertIn('FROM ged2.exposure_population_pyramid', query)
+        self.assertIn('NOT (floor(ST_X(grid_point.the_geom) / 1.0) '
+                      'BETWEEN %s AND %s', query)
+        self.assertEqual([0, 8, 9, 45, 46,
+                          8.0, 45.0, 8.0, 47.0, 10.0, 45.0, 10.0, 47.0,
+                          8.0, 45.0, 10.0, 45.0, 8.0, 47.0, 10.0, 47.0,
+                          8, 9, 45, 46], args)
+
+    def test_total_without_pyramid(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = False
+            with mock.patch('exposure.util.connections') as conns:
+                cursor = conns['geddb'].cursor.return_value
+                cursor.fetchall.return_value = [(0, 0L)]
+                util.population_total('8.0', '45.0', '8.1', '45.1')
+
+        query, args = cursor.execute.call_args[0]
+        self.assertNotIn('exposure_population_pyramid', query)
+        self.assertEqual([8.0, 45.0, 8.1, 45.1], args)
+
+    def test_estimate_population(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = True
+            with mock.patch('exposure.util.population_total') as pt:
+                pt.return_value = dict(population=10.0, grid_points=3)
+                rows = util._estimate_export_rows('population', '8.0', '45.0',
+                                                  '8.1', '45.1')
+        self.assertEqual(3, rows)
+
+    def test_view(self):
+        request = FakeHttpGetRequest(dict(lng1='8.0', lat1='45.0',
+                                          lng2='8.1', lat2='45.1'))
+        with mock.patch('exposure.util.population_total') as pt:
+            pt.return_value = dict(population=10.0, grid_points=3)
+            resp = views.population_total(request)
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(dict(population=10.0, grid_points=3),
+                         simplejson.loads(resp.content))
+        self.assertEqual((('8.0', '45.0', '8.1', '45.1'), {}), pt.call_args)
+
+
+class VectorTilesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.patch = mock.patch('exposure.vectortiles.VECTOR_TILE_CACHE_DIR',
+                                self.cache_dir)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_encode_tile(self):
+        tile = vectortiles.encode_tile('p', [(7, 1, -1, dict(n=2))])
+        self.assertEqual(
+            '\x1a\x1e'  # layer
+            '\x78\x02'  # version
+            '\x0a\x01p'  # name
+            '\x12\x0d'  # feature
+            '\x08\x07'  # id
+            '\x12\x02\x00\x00'  # tags
+            '\x18\x01'  # point
+            '\x22\x03\x09\x02\x01'  # geometry
+            '\x1a\x01n'  # key
+            '\x22\x02\x28\x02'  # value
+            '\x28\x80\x20',  # extent
+            tile
+        )
+
+    def test_tile_bounds(self):
+        lng1, lat1, lng2, lat2 = vectortiles.tile_bounds(1, 1, 0)
+        self.assertEqual((0, 180), (lng1, lng2))
+        self.assertAlmostEqual(0, lat1)
+        self.assertAlmostEqual(85.0511287798, lat2)
+
+    def test_get_tile(self):
+        with mock.patch('exposure.util._get_population_density') as gpd:
+            gpd.return_value = [
+                (45.0, 0.0, 10.0, 3, None),
+                # Outside of the tile:
+                (-45.0, 0.0, 20.0, 1, None),
+            ]
+            tile = vectortiles.get_tile(1, 1, 1)
+            lng1, lat1, lng2, lat2 = gpd.call_args[0]
+            self.assertEqual((0, 180), (lng1, lng2))
+            self.assertAlmostEqual(-85.0511287798, lat1)
+            self.assertAlmostEqual(0, lat2)
+            self.assertEqual(dict(cell_size=180.0 / 128), gpd.call_args[1])
+            self.assertEqual(vectortiles.encode_tile('population', [
+                (None, 1024, 0, dict(population=10.0, grid_points=3)),
+            ]), tile)
+
+            # Cached:
+            self.assertEqual(tile, vectortiles.get_tile(1, 1, 1))
+            self.assertEqual(1, gpd.call_count)
+
+            vectortiles.get_tile(vectortiles.VECTOR_TILE_NATIVE_ZOOM, 0, 0)
+            self.assertEqual(dict(cell_size=None), gpd.call_args[1])
+
+    def test_population_density(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = True
+            with mock.patch('exposure.util.connections') as conns:
+                cursor = conns['geddb'].cursor.return_value
+                util._get_population_density('8.0', '45.0', '9.0', '46.0',
+                                             cell_size=0.3)
+
+        query, args = cursor.execute.call_args[0]
+        self.assertIn('FROM ged2.exposure_population_pyramid', query)
+        self.assertIn('GROUP BY floor(lon / 0.3), floor(lat / 0.3)', query)
+        # From the 0.25 degree level:
+        self.assertEqual([1, 32, 36, 180, 184], args)
+
+    def test_view(self):
+        request = FakeHttpGetRequest({})
+        resp = views.population_tile(request, '1', '2', '0')
+        self.assertEqual(404, resp.status_code)
+
+        with mock.patch('exposure.vectortiles.get_tile') as gt:
+            gt.return_value = 'tile'
+            resp = views.population_tile(request, '1', '1', '0')
+        self.assertEqual('tile', resp.content)
+        self.assertEqual('application/vnd.mapbox-vector-tile',
+                         resp['Content-Type'])
+        self.assertEqual(((1, 1, 0), {}), gt.call_args)
+
+
+class BundlesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.bundle_dir = tempfile.mkdtemp()
+        self.patch = mock.patch('exposure.bundles.BUNDLE_DIR', self.bundle_dir)
+        self.patch.start()
+        self.params = dict(outputType='csv', residential='res',
+                           timeOfDay='day', adminLevel='admin0',
+                           regionId='42')
+
+    def tearDown(self):
+        self.patch.stop()
+        shutil.rmtree(self.bundle_dir)
+
+    def _stream(self, request, output_type):
+        yield '%(regionId)s,%(residential)s,%(timeOfDay)s\n' % request.GET
+        yield output_type
+
+    def test_build_and_find(self):
+        self.assertEqual(None, bundles.find(self.params))
+
+        bundles.build_country(42, self._stream, output_types=['csv'])
+        self.assertEqual(15, len(os.listdir(os.path.join(self.bundle_dir,
+                                                         '42'))))
+        name = bundles.find(self.params)
+        self.assertEqual('42/res_day.csv.gz', name)
+        with gzip.open(os.path.join(self.bundle_dir, name)) as fh:
+            self.assertEqual('42,res,day\ncsv', fh.read())
+
+        # Only whole-country, admin level 0 exports:
+        for key, value in [('adminLevel', 'admin1'), ('regionLevel', 'admin1'),
+                           ('aggregate', 'admin1'), ('outputType', 'nrml'),
+                           ('taxonomy', 'MUR'), ('order', 'spatial'),
+                           ('polygon', 'POLYGON((0 0, 1 0, 1 1, 0 0))')]:
+            params = dict(self.params)
+            params[key] = value
+            self.assertEqual(None, bundles.find(params))
+        del self.params['regionId']
+        self.assertEqual(None, bundles.find(self.params))
+
+        with mock.patch('exposure.bundles.BUNDLE_DIR', None):
+            self.assertEqual(None, bundles.find(self.params))
+
+    def test_export_building(self):
+        bundles.build_country(42, self._stream, output_types=['csv'])
+        request = FakeHttpGetRequest(self.params)
+        request.META['HTTP_ACCEPT_ENCODING'] = 'gzip'
+        with mock.patch('exposure.views._export_admission') as ea:
+            resp = views.export_building(request)
+
+        self.assertEqual(0, ea.call_count)
+        self.assertFalse(resp.has_header('X-Accel-Redirect'))
+        self.assertEqual('text/csv', resp['Content-Type'])
+        self.assertEqual('gzip', resp['Content-Encoding'])
+        with open(os.path.join(self.bundle_dir, '42/res_day.csv.gz'),
+                  'rb') as fh:
+            data = fh.read()
+        self.assertEqual(str(len(data)), resp['Content-Length'])
+        self.assertEqual(data, resp.content)
+
+        # Sent by nginx:
+        with mock.patch('exposure.bundles.BUNDLE_ACCEL_REDIRECT', True):
+            resp = views.export_building(request)
+        self.assertEqual('/exposure_bundles/42/res_day.csv.gz',
+                         resp['X-Accel-Redirect'])
+        self.assertEqual('text/csv', resp['Content-Type'])
+        self.assertEqual('', resp.content)
+
+        # Streamed, if the bundle was deleted since it was found:
+        with mock.patch('exposure.bundles.find') as find:
+            find.return_value = '42/missing.csv.gz'
+            with mock.patch('exposure.views._export_admission') as ea:
+                ea.return_value = (403, 'error', None)
+                resp = views.export_building(request)
+        self.assertEqual(1, ea.call_count)
+
+        # Streamed, if the client doesn't accept gzip:
+        del request.META['HTTP_ACCEPT_ENCODING']
+        with mock.patch('exposure.views._export_admission') as ea:
+            ea.return_value = (403, 'error', None)
+            resp = views.export_building(request)
+        self.assertEqual(1, ea.call_count)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.patch = mock.patch('exposure.singleflight.SINGLE_FLIGHT_DIR',
+                                self.spool_dir)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        shutil.rmtree(self.spool_dir)
+
+    def test_export_key(self):
+        params = dict(outputType='csv', adminLevel='admin0', lng1='1',
+                      lat1='2.0', lng2='3', lat2='4')
+        key = singleflight.export_key('building', params)
+        self.assertEqual(key, singleflight.export_key('building', dict(
+            params, lng1='1.0', lat1='2', compress='zip', _='1381234567'
+        )))
+        self.assertNotEqual(key, singleflight.export_key('population',
+                                                         params))
+        self.assertNotEqual(key, singleflight.export_key('building', dict(
+            params, residential='res'
+        )))
+
+    def test_concurrent_exports_share_the_query(self):
+        joined = threading.Event()
+        calls = []
+
+        def chunks():
+            calls.append(1)
+            yield 'a,b\n'
+            # Hold the export until the second request reads the spool.
+            joined.wait(5)
+            yield '1,2\n'
+
+        first = singleflight.stream('key', chunks)
+        self.assertEqual('a,b\n', first.next())
+        second = singleflight.stream('key', chunks)
+        self.assertEqual('a,b\n', second.next())
+        joined.set()
+
+        self.assertEqual(['1,2\n'], list(first))
+        self.assertEqual(['1,2\n'], list(second))
+        self.assertEqual(1, len(calls))
+        # The spool is deleted once the export is complete ...
+        self.assertEqual([], os.listdir(self.spool_dir))
+        # ... and later identical exports run again.
+        self.assertEqual(['a,b\n', '1,2\n'],
+                         list(singleflight.stream('key', chunks)))
+        self.assertEqual(2, len(calls))
+
+    def test_failed_export(self):
+        def chunks():
+            yield 'a,b\n'
+            raise ValueError('boom')
+
+        with mock.patch('exposure.singleflight.LOG') as log:
+            chunks_iter = singleflight.stream('key', chunks)
+            self.assertEqual('a,b\n', chunks_iter.next())
+            self.assertRaises(RuntimeError, list, chunks_iter)
+        self.assertEqual(mock.call('Shared export failed'),
+                         log.exception.call_args)
+
+    def test_abandoned_spool(self):
+        path = os.path.join(self.spool_dir, 'key.spool')
+        with open(path, 'wb') as fh:
+            fh.write('\x10\x00')
+        os.utime(path, (0, 0))
+
+        with mock.patch('exposure.singleflight.LOG') as log:
+            self.assertEqual(['a'], list(singleflight.stream('key',
+                                                             lambda: 'a')))
+        self.assertEqual(
+            mock.call('Removing the abandoned export spool %s', path),
+            log.warning.call_args
+        )
+
+    def test_disabled(self):
+        with mock.patch('exposure.singleflight.SINGLE_FLIGHT_DIR', None):
+            self.assertEqual(['a', 'b'], list(singleflight.stream(
+                'key', lambda: iter(['a', 'b'])
+            )))
+        self.assertEqual([], os.listdir(self.spool_dir))
+
+    def test_export_building(self):
+        request = FakeHttpGetRequest(dict(
+            outputType='csv', adminLevel='admin0', residential='res',
+            timeOfDay='day', lng1='1', lat1='2', lng2='3', lat2='4'
+        ))
+        with mock.patch('exposure.views._export_admission') as ea:
+            ea.return_value = (200, None, None)
+            with mock.patch('exposure.views._stream_building_exposure') as sb:
+                sb.return_value = iter(['a,b\n', '1,2\n'])
+                resp = views.export_building(request)
+                self.assertEqual('a,b\n1,2\n', ''.join(resp))
+
+        self.assertEqual(1, sb.call_count)
+
+    def _wait_for(self, condition):
+        for _ in xrange(500):
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail('Timed out')
+
+    def test_slow_export_is_not_abandoned(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def chunks():
+            calls.append(1)
+            started.set()
+            # A long query, before the first row.
+            release.wait(5)
+            yield 'a'
+
+        first = singleflight.stream('key', chunks)
+        thread = threading.Thread(target=lambda: calls.append(list(first)))
+        thread.start()
+        started.wait(5)
+        path = os.path.join(self.spool_dir, 'key.spool')
+        os.utime(path, (0, 0))
+
+        # Joined, although the spool hasn't changed for a long time.
+        with singleflight._join_or_start('key', 'token', chunks) as fh:
+            self.assertEqual(os.stat(path).st_ino,
+                             os.fstat(fh.fileno()).st_ino)
+            self.assertEqual([1], calls)
+            release.set()
+            thread.join(5)
+            self.assertEqual(['a'], list(singleflight._read_spool(fh)))
+        self.assertEqual([1, ['a']], calls)
+
+    def test_unlink_if_same(self):
+        path = os.path.join(self.spool_dir, 'key.spool')
+        open(path, 'w').close()
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            # Replaced by the spool of another export.
+            os.unlink(path)
+            with open(path, 'w') as fh:
+                fh.write('new')
+            singleflight._unlink_if_same(path, fd)
+            self.assertTrue(os.path.exists(path))
+        finally:
+            os.close(fd)
+
+        fd = os.open(path, os.O_RDONLY)
+        singleflight._unlink_if_same(path, fd)
+        os.close(fd)
+        self.assertFalse(os.path.exists(path))
+
+    def test_cancelled_export(self):
+        def chunks():
+            yield 'a,b\n'
+            raise metrics.ExportCancelled()
+
+        chunks_iter = singleflight.stream('key', chunks)
+        self.assertEqual('a,b\n', chunks_iter.next())
+        self.assertRaises(metrics.ExportCancelled, list, chunks_iter)
+
+    @mock.patch('exposure.singleflight.READER_CHECK_INTERVAL', 0.01)
+    def test_pinned_while_shared(self):
+        release = threading.Event()
+
+        def chunks():
+            yield 'a'
+            release.wait(5)
+            yield 'b'
+
+        record = metrics.ExportRecord('building', {})
+        metrics.activate(record)
+        try:
+            first = singleflight.stream('key', chunks)
+            self.assertEqual('a', first.next())
+        finally:
+            metrics.activate(None)
+        self.assertTrue(record.cancellable)
+
+        second = singleflight.stream('key', chunks)
+        self.assertEqual('a', second.next())
+        self._wait_for(lambda: not record.cancellable)
+        # The first request goes away: the export runs on for the second.
+        first.close()
+        record.cancel()
+        self.assertFalse(record.cancelled)
+        release.set()
+        self.assertEqual(['b'], list(second))
+
+    @mock.patch('exposure.singleflight.READER_CHECK_INTERVAL', 0.01)
+    def test_cancelled_without_readers(self):
+        produced = []
+
+        def chunks():
+            while len(produced) < 1000:
+                produced.append(1)
+                yield 'a'
+                time.sleep(0.01)
+
+        record = metrics.ExportRecord('building', {})
+        metrics.activate(record)
+        try:
+            first = singleflight.stream('key', chunks)
+            self.assertEqual('a', first.next())
+        finally:
+            metrics.activate(None)
+        first.close()
+
+        self._wait_for(lambda: not os.listdir(self.spool_dir))
+        self.assertTrue(record.cancelled)
+        self.assertTrue(len(produced) < 1000)
+
+
+@unittest.skipUnless(gridindex.numpy, 'NumPy is not installed')
+class GridIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.index_dir = os.path.join(self.tmp_dir, 'index')
+        self.patch = mock.patch('exposure.gridindex.GRID_INDEX_DIR',
+                                self.index_dir)
+        self.patch.start()
+        gridindex._loaded = None
+
+        rnd = random.Random(42)
+        ids = range(1, 3001)
+        rnd.shuffle(ids)
+        self.rows = []
+        for i, grid_id in enumerate(ids):
+            if i % 10 == 0:
+                # On the edges of the buckets:
+                lon = 8 + rnd.randint(0, 8) * 0.25
+                lat = 45 + rnd.randint(0, 8) * 0.25
+            else:
+                lon = 8 + rnd.random() * 2
+                lat = 45 + rnd.random() * 2
+            country_id, iso = rnd.choice([(1, 'ITA'), (2, 'CHE')])
+            self.rows.append((grid_id, lon, lat, rnd.random() * 100, iso,
+                              country_id, rnd.choice([-1, 10, 11]), -1, -1))
+        self.rows.append((5000, 180.0, 90.0, 1.0, 'FJI', 3, -1, -1, -1))
+
+    def tearDown(self):
+        self.patch.stop()
+        gridindex._loaded = None
+        shutil.rmtree(self.tmp_dir)
+
+    def _build(self, rows):
+        with mock.patch('exposure.util._stream_query') as sq:
+            sq.return_value = iter(rows)
+            gridindex.build()
+
+    def _expected(self, keep):
+        return sorted(row[:5] for row in self.rows if keep(row))
+
+    def test_bbox(self):
+        self.assertEqual(None, gridindex.get_index())
+        self._build(self.rows)
+        index = gridindex.get_index()
+        self.assertTrue(index is gridindex.get_index())
+
+        for lng1, lat1, lng2, lat2 in [(8.5, 45.25, 9.1, 46.75),
+                                       (9.1, 46.75, 8.5, 45.25),
+                                       (8, 45, 10, 47),
+                                       (8.25, 45.5, 8.25, 45.5),
+                                       (179, 89, 180, 90),
+                                       (-10, -10, -5, -5)]:
+            x1, x2 = sorted([lng1, lng2])
+            y1, y2 = sorted([lat1, lat2])
+            expected = self._expected(
+                lambda row: x1 <= row[1] <= x2 and y1 <= row[2] <= y2
+            )
+            self.assertEqual(expected, list(index.get_population_exposure(
+                lng1, lat1, lng2, lat2
+            )))
+
+    def test_region(self):
+        self._build(self.rows)
+        index = gridindex.get_index()
+        for admin_level, column, region_id in [('admin1', 6, 11),
+                                               ('admin1', 6, 10),
+                                               ('admin1', 6, 12),
+                                               ('admin0', 5, 2),
+                                               ('admin0', 5, 3),
+                                               ('admin3', 8, 1)]:
+            self.assertEqual(
+                self._expected(lambda row: row[column] == region_id),
+                list(index.get_population_exposure(
+                    None, None, None, None,
+                    area=util.region_area(admin_level, region_id)
+                ))
+            )
+        # The region column isn't scanned.
+        with mock.patch.dict(index.columns, gadm_admin_1_id=None):
+            self.assertEqual(
+                self._expected(lambda row: row[6] == 10),
+                list(index.get_population_exposure(
+                    None, None, None, None, area=util.region_area('admin1', 10)
+                ))
+            )
+        self.assertFalse(gridindex.supports(util.parse_polygon(
+            'POLYGON((8 45, 9 45, 9 46, 8 45))'
+        )))
+
+    def test_rebuild(self):
+        self._build(self.rows)
+        index = gridindex.get_index()
+        self._build(self.rows[:10])
+
+        self.assertFalse(index is gridindex.get_index())
+        self.assertEqual(10, len(list(
+            gridindex.get_index().get_population_exposure(-180, -90, 180, 90)
+        )))
+        # The old index can still be read:
+        self.assertEqual(len(self.rows), len(list(
+            index.get_population_exposure(-180, -90, 180, 90)
+        )))
+        self.assertEqual(['index'], os.listdir(self.tmp_dir))
+
+    def test_stream_population_exposure(self):
+        self._build(self.rows)
+        request = FakeHttpGetRequest(dict(lng1='8', lat1='45', lng2='10',
+                                          lat2='47'))
+        with mock.patch('exposure.tilecache.get_exposure') as ge:
+            result = list(views._stream_population_exposure(request, 'csv'))
+
+        self.assertEqual(0, ge.call_count)
+        self.assertEqual(len(self.rows) - 1 + 2, len(result))
+
+        with mock.patch('exposure.gridindex.GRID_INDEX_DIR', None):
+            with mock.patch('exposure.tilecache.get_exposure') as ge:
+                ge.return_value = []
+                list(views._stream_population_exposure(request, 'csv'))
+        self.assertEqual(1, ge.call_count)
+
+
+class ExposureFactsTestCase(unittest.TestCase):
+
+    def test_national_exposure_uses_fact_table(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = True
+            with mock.patch('exposure.util._stream_query') as sq:
+                util._get_national_exposure('8.1', '45.2', '9.1', '46.2',
+                                            'day', [0])
+
+        self.assertEqual((('ged2.exposure_fact_admin0', ), {}), te.call_args)
+        query, args = sq.call_args[0]
+        self.assertIn('FROM ged2.exposure_fact_admin0 AS fact', query)
+        self.assertIn('fact.day_pop_ratio as day_pop_ratio', query)
+        self.assertIn('NULL as night_pop_ratio', query)
+        self.assertNotIn('JOIN', query)
+        self.assertEqual(['8.1', '45.2', '9.1', '46.2'], args)
+
+    def test_subnational_exposure_without_fact_table(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = False
+            with mock.patch('exposure.util._stream_query') as sq:
+                util._get_subnational_exposure('8.1', '45.2', '9.1', '46.2',
+                                               [0, 1], 'admin2')
+
+        query, _ = sq.call_args[0]
+        self.assertIn('grid_point.gadm_admin_2_id,', query)
+        self.assertIn('ON geo_region.gadm_admin_2_id = '
+                      'grid_point.gadm_admin_2_id', query)
+        self.assertIn('dist_group.occupancy_id IN (0, 1)', query)
+
+    def test_build_for_countries(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = True
+            with mock.patch('exposure.util._column_exists') as ce:
+                ce.return_value = False
+                with mock.patch('exposure.util.connections') as conns:
+                    util._build_exposure_facts('admin1', isos=['ITA', 'CHE'])
+
+        calls = conns['geddb'].cursor.return_value.execute.call_args_list
+        self.assertEqual(3, len(calls))
+        self.assertEqual(
+            (('DELETE FROM ged2.exposure_fact_admin1 WHERE iso IN %s',
+              [('ITA', 'CHE')]), {}),
+            calls[0]
+        )
+        insert, args = calls[1][0]
+        self.assertTrue(insert.startswith(
+            'INSERT INTO ged2.exposure_fact_admin1 SELECT'))
+        self.assertTrue(insert.endswith('AND gadm_country.iso IN %s\n'))
+        self.assertEqual([('ITA', 'CHE')], args)
+
+
+class ExportAreaTestCase(unittest.TestCase):
+    """
+    Tests for polygon and region exports.
+    """
+
+    WKT = 'POLYGON((8 45, 9.5 45, 9 46.5, 8 45))'
+
+    def test_parse_wkt(self):
+        self.assertEqual(('wkt', self.WKT, (8.0, 45.0, 9.5, 46.5)),
+                         util.parse_polygon(' %s ' % self.WKT))
+
+    def test_parse_geojson_feature(self):
+        feature = dict(type='Feature', properties={}, geometry=dict(
+            type='MultiPolygon',
+            coordinates=[[[[8, 45], [9, 45], [9, 46], [8, 45]]],
+                         [[[10, 47], [11, 47], [11, 48], [10, 47]]]],
+        ))
+        kind, text, bbox = util.parse_polygon(simplejson.dumps(feature))
+        self.assertEqual('geojson', kind)
+        self.assertEqual(feature['geometry'], simplejson.loads(text))
+        self.assertEqual((8.0, 45.0, 11.0, 48.0), bbox)
+
+    def test_parse_invalid(self):
+        for text in ('POINT(8 45)', 'POLYGON((8 45, 9 45, 8 45))',
+                     'POLYGON((8 45 1, 9 45 1, 9 46 1, 8 45 1))',
+                     'POLYGON((200 45, 9 45, 9 46, 200 45))',
+                     '{"type": "LineString", "coordinates": [[8, 45]]}',
+                     '{"type": "Polygon"', ''):
+            self.assertRaises(ValueError, util.parse_polygon, text)
+
+    def test_region_area(self):
+        self.assertEqual(('region', 'admin1', 42),
+                         util.region_area('admin1', '42'))
+        self.assertRaises(ValueError, util.region_area, 'admin4', '42')
+        self.assertRaises(ValueError, util.region_area, 'admin1', 'x')
+
+    def test_spatial_filter(self):
+        self.assertEqual(
+            ('ST_Intersects(ST_GeomFromText(%s, 4326), grid_point.the_geom)',
+             [self.WKT]),
+            util._spatial_filter('grid_point.id', 'grid_point.the_geom',
+                                 None, None, None, None,
+                                 util.parse_polygon(self.WKT))
+        )
+
+        area = util.region_area('admin2', 42)
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = True
+            sql, args = util._spatial_filter('fact.grid_id', 'fact.the_geom',
+                                             None, None, None, None, area)
+            self.assertEqual(('ged2.exposure_region_grid_point', ),
+                             te.call_args[0])
+            self.assertTrue(sql.startswith('fact.grid_id IN ('))
+            self.assertEqual(['admin2', 42], args)
+
+            te.return_value = False
+            sql, args = util._spatial_filter('fact.grid_id', 'fact.the_geom',
+                                             None, None, None, None, area)
+            self.assertIn('WHERE gadm_admin_2_id = %s', sql)
+            self.assertEqual([42], args)
+
+    def test_national_exposure_in_polygon(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = True
+            with mock.patch('exposure.util._stream_query') as sq:
+                util._get_national_exposure(
+                    None, None, None, None, 'day', [0],
+                    area=util.parse_polygon(self.WKT)
+                )
+
+        query, args = sq.call_args[0]
+        self.assertIn('ST_Intersects(ST_GeomFromText(%s, 4326), '
+                      'fact.the_geom)', query)
+        self.assertNotIn('ST_MakeEnvelope', query)
+        self.assertEqual([self.WKT], args)
+
+    def test_stream_population_in_region(self):
+        request = FakeHttpGetRequest(dict(outputType='csv', regionId='7'))
+        with mock.patch('exposure.util._get_population_exposure') as gpe:
+            gpe.return_value = [[1, 2, 3, 4, 5]]
+            result = list(views._stream_population_exposure(request, 'csv'))
+
+        self.assertEqual(((None, None, None, None),
+                          dict(area=('region', 'admin0', 7))),
+                         gpe.call_args)
+        self.assertEqual('5,4,1,2,3\n', result[2])
+
+    def test_validate_region(self):
+        request = FakeHttpGetRequest(dict(
+            outputType='csv', residential='res', timeOfDay='day',
+            adminLevel='admin1', regionLevel='admin1', regionId='42',
+        ))
+        with mock.patch('exposure.util.area_extent') as ae:
+            ae.return_value = (8.0, 45.0, 10.0, 47.0)
+            with mock.patch('exposure.util._estimate_export_rows') as eer:
+                eer.return_value = 10
+                resp = views.validate_export(request)
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual((('region', 'admin1', 42), ), ae.call_args[0])
+        self.assertEqual(('admin1', 8.0, 45.0, 10.0, 47.0),
+                         eer.call_args[0])
+
+    def test_validate_invalid_area(self):
+        request = FakeHttpGetRequest(dict(polygon='POINT(8 45)'))
+        resp = views.validate_export(request)
+        self.assertEqual(403, resp.status_code)
+
+        request = FakeHttpGetRequest(dict(regionId='42'))
+        with mock.patch('exposure.util.area_extent') as ae:
+            ae.return_value = None
+            resp = views.validate_export(request)
+        self.assertEqual(403, resp.status_code)
+        self.assertEqual('The selected region has no exposure data',
+                         resp.content)
+
+
+class AggregatedExposureTestCase(unittest.TestCase):
+    """
+    Tests for aggregated building exports.
+    """
+
+    def setUp(self):
+        self.request = FakeHttpGetRequest(dict(
+            outputType='csv', residential='both', aggregate='admin2',
+            lng1='8.0', lat1='45.0', lng2='10.0', lat2='47.0',
+        ))
+        self.rows = [(12, 'ITA', 'MUR', 1500.0, 8.5, 45.5, 3),
+                     (12, 'ITA', 'W', 20.0, 8.25, 45.75, 1)]
+
+    def test_query(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = True
+            with mock.patch('exposure.util._stream_query') as sq:
+                util._get_aggregated_exposure('8.0', '45.0', '10.0', '47.0',
+                                              [0], 'admin2')
+
+        query, args = sq.call_args[0]
+        self.assertIn('FROM ged2.exposure_fact_admin2 AS fact', query)
+        self.assertIn('SUM(fact.pop_value * fact.dwelling_fraction) '
+                      'AS population', query)
+        self.assertIn('AND fact.dist_occupancy_id IN (0)\n', query)
+        self.assertIn('GROUP BY 1, 2, 3\n', query)
+        self.assertEqual(['8.0', '45.0', '10.0', '47.0'], args)
+
+    def test_query_without_fact_table(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = False
+            with mock.patch('exposure.util._stream_query') as sq:
+                util._get_aggregated_exposure(
+                    None, None, None, None, [0, 1], 'admin1',
+                    area=util.region_area('admin0', 7)
+                )
+
+        query, args = sq.call_args[0]
+        self.assertIn('    grid_point.gadm_admin_1_id,\n', query)
+        self.assertIn('JOIN ged2.distribution_value', query)
+        self.assertIn('AND dist_group.occupancy_id IN (0, 1)\n', query)
+        self.assertEqual([7], args)
+
+    def test_stream_csv(self):
+        with mock.patch('exposure.util._get_aggregated_exposure') as gae:
+            gae.return_value = self.rows
+            result = list(views._stream_building_exposure(self.request,
+                                                          'csv'))
+
+        self.assertEqual((('8.0', '45.0', '10.0', '47.0', [0, 1], 'admin2'),
+                          dict(taxonomy=None, area=None)), gae.call_args)
+        self.assertEqual(views.BLDG_AGGREGATE_CSV_HEADER, result[1])
+        self.assertEqual(['ITA,12,MUR,1500.0,8.5,45.5,3\n',
+                          'ITA,12,W,20.0,8.25,45.75,1\n'], result[2:])
+
+    def test_stream_nrml(self):
+        with mock.patch('exposure.util._get_aggregated_exposure') as gae:
+            gae.return_value = self.rows
+            result = list(views._stream_building_exposure(self.request,
+                                                          'nrml'))
+
+        self.assertEqual(6, len(result))
+        self.assertEqual(views.NRML_ASSET_FMT % dict(
+            gml_id='12_MUR', pop=1500.0, tax='MUR', lon=8.5, lat=45.5,
+        ), result[3])
+
+    def test_invalid(self):
+        self.request.GET['aggregate'] = 'admin0'
+        self.assertRaises(ValueError, list,
+                          views._stream_building_exposure(self.request, 'csv'))
+        self.request.GET['aggregate'] = 'admin1'
+        self.assertRaises(ValueError, list,
+                          views._stream_building_exposure(self.request, 'npz'))
+
+    def test_admission(self):
+        # Too large for a direct export of all of the grid points, but not
+        # for an aggregated one:
+        self.request.GET['lat2'] = '50.0'
+        with mock.patch('exposure.util._estimate_export_rows') as eer:
+            resp = views.validate_export(self.request)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(0, eer.call_count)
+
+        with mock.patch('exposure.views.MAX_ASYNC_EXPORT_AREA_SQ_DEG', 4):
+            resp = views.validate_export(self.request)
+        self.assertEqual(403, resp.status_code)
+
+
+class TaxonomyFilterTestCase(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(('CR/LFINF', 'MUR'),
+                         util.parse_taxonomy(' MUR, CR/LFINF,,MUR '))
+        self.assertRaises(ValueError, util.parse_taxonomy, ' , ')
+        with mock.patch('exposure.util.MAX_TAXONOMY_PREFIXES', 2):
+            self.assertRaises(ValueError, util.parse_taxonomy, 'A,B,C')
+
+    def test_resolve(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = True
+            with mock.patch('exposure.util.connections') as conns:
+                cursor = conns['geddb'].cursor.return_value
+                cursor.fetchall.return_value = [('MUR', ), ('MUR/LWAL', )]
+                types = util._resolve_taxonomy(('MUR', 'W_X'))
+
+        self.assertEqual(['MUR', 'MUR/LWAL'], types)
+        self.assertEqual((('ged2.exposure_taxonomy', ), {}), te.call_args)
+        query, args = cursor.execute.call_args[0]
+        self.assertIn('FROM ged2.exposure_taxonomy WHERE '
+                      "building_type LIKE %s ESCAPE '\\' OR "
+                      "building_type LIKE %s ESCAPE '\\'", query)
+        self.assertEqual(['MUR%', 'W\\_X%'], args)
+
+    def test_national_exposure(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = True
+            with mock.patch('exposure.util._resolve_taxonomy') as rt:
+                rt.return_value = ['MUR', 'MUR/LWAL']
+                with mock.patch('exposure.util._stream_query') as sq:
+                    util._get_national_exposure('8.1', '45.2', '9.1', '46.2',
+                                                'day', [0], ('MUR', ))
+
+        self.assertEqual(((('MUR', ), ), {}), rt.call_args)
+        query, args = sq.call_args[0]
+        self.assertIn('AND fact.pop_occupancy_id IN (0)\n'
+                      '    AND fact.building_type = ANY(%s)\n', query)
+        self.assertEqual(['8.1', '45.2', '9.1', '46.2', ['MUR', 'MUR/LWAL']],
+                         args)
+
+    def test_subnational_exposure(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = False
+            with mock.patch('exposure.util._resolve_taxonomy') as rt:
+                rt.return_value = ['CR/LFINF']
+                with mock.patch('exposure.util._stream_query') as sq:
+                    util._get_subnational_exposure(
+                        None, None, None, None, [0, 1], 'admin1',
+                        taxonomy=('CR/LFINF', ),
+                        area=util.region_area('admin0', 7)
+                    )
+
+        query, args = sq.call_args[0]
+        self.assertIn('AND dist_value.building_type = ANY(%s)\n', query)
+        self.assertEqual([7, ['CR/LFINF']], args)
+
+    def test_unfiltered(self):
+        self.assertEqual(('', []), util._taxonomy_filter('fact.building_type',
+                                                         None))
+
+    def test_stream_building_exposure(self):
+        request = FakeHttpGetRequest(dict(
+            outputType='csv', residential='res', timeOfDay='day',
+            adminLevel='admin1', lng1='8.1', lat1='45.2', lng2='9.1',
+            lat2='46.2', taxonomy='MUR,CR'
+        ))
+        with mock.patch('exposure.util._get_subnational_exposure') as gse:
+            gse.return_value = []
+            list(views._stream_building_exposure(request, 'csv'))
+
+        self.assertEqual(
+            mock.call('8.1', '45.2', '9.1', '46.2', [0], 'admin1',
+                      ('CR', 'MUR')),
+            gse.call_args
+        )
+
+    def test_admission(self):
+        params = dict(adminLevel='admin0', lng1='8', lat1='45', lng2='9',
+                      lat2='46', taxonomy=',')
+        status, error, _ = views._export_admission(params, 'building')
+        self.assertEqual(403, status)
+        self.assertEqual('No taxonomy given', error)
+
+
+class HilbertOrderTestCase(unittest.TestCase):
+
+    def test_hilbert_index(self):
+        # Each cell has its own key, and the cells of a coarser grid are
+        # runs of consecutive keys.
+        keys = [util._hilbert_index(3, x, y)
+                for x in xrange(8) for y in xrange(8)]
+        self.assertEqual(range(64), sorted(keys))
+        for x in xrange(8):
+            for y in xrange(8):
+                self.assertEqual(util._hilbert_index(2, x >> 1, y >> 1),
+                                 util._hilbert_index(3, x, y) >> 2)
+        # Consecutive keys are neighbouring cells.
+        cells = sorted((util._hilbert_index(3, x, y), x, y)
+                       for x in xrange(8) for y in xrange(8))
+        for (_, x1, y1), (_, x2, y2) in zip(cells, cells[1:]):
+            self.assertEqual(1, abs(x1 - x2) + abs(y1 - y2))
+
+    def test_hilbert_key(self):
+        self.assertEqual(0, util.hilbert_key(-180, -90))
+        self.assertEqual(4 ** util.HILBERT_ORDER - 1,
+                         util.hilbert_key(180, -90))
+
+    def test_ranges_cover_bbox(self):
+        ranges = util._hilbert_ranges('9.1', '46.2', '8.1', '45.2')
+        self.assertTrue(len(ranges) <= util.HILBERT_MAX_CELLS)
+        self.assertEqual(sorted(ranges), ranges)
+        for (_, last), (first, _) in zip(ranges, ranges[1:]):
+            self.assertTrue(last + 1 < first)
+
+        rand = random.Random(42)
+        for _ in xrange(1000):
+            key = util.hilbert_key(rand.uniform(8.1, 9.1),
+                                   rand.uniform(45.2, 46.2))
+            self.assertTrue(any(first <= key <= last
+                                for first, last in ranges))
+        self.assertEqual([(0, 4 ** util.HILBERT_ORDER - 1)],
+                         util._hilbert_ranges(-180, -90, 180, 90))
+
+    def test_national_exposure(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = True
+            with mock.patch('exposure.util._column_exists') as ce:
+                ce.return_value = True
+                with mock.patch('exposure.util._hilbert_ranges') as hr:
+                    hr.return_value = [(10, 19), (40, 79)]
+                    with mock.patch('exposure.util._stream_query') as sq:
+                        sq.return_value = iter([(1, ), (2, ), (3, )])
+                        rows = list(util._get_national_exposure(
+                            '8.1', '45.2', '9.1', '46.2', 'day', [0],
+                            order='spatial'
+                        ))
+
+        self.assertEqual([(1, ), (2, ), (3, )], rows)
+        self.assertEqual((('ged2.exposure_fact_admin0', 'hilbert_key'), {}),
+                         ce.call_args)
+        self.assertEqual((('8.1', '45.2', '9.1', '46.2'), {}), hr.call_args)
+        # One query for all of the key ranges.
+        self.assertEqual(1, sq.call_count)
+        query, args = sq.call_args[0]
+        self.assertIn('AND fact.pop_occupancy_id IN (0)\n'
+                      '    AND (fact.hilbert_key BETWEEN %s AND %s\n'
+                      '        OR fact.hilbert_key BETWEEN %s AND %s)\n'
+                      'ORDER BY fact.hilbert_key, fact.grid_id\n', query)
+        self.assertNotIn('ORDER BY fact.grid_id', query)
+        self.assertEqual(['8.1', '45.2', '9.1', '46.2', 10, 19, 40, 79],
+                         args)
+
+    def test_subnational_exposure_region(self):
+        area = util.region_area('admin0', 7)
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = True
+            with mock.patch('exposure.util._column_exists') as ce:
+                ce.return_value = True
+                with mock.patch('exposure.util.area_extent') as ae:
+                    ae.return_value = (8.0, 45.0, 8.5, 45.5)
+                    with mock.patch('exposure.util._stream_query') as sq:
+                        sq.return_value = iter([])
+                        list(util._get_subnational_exposure(
+                            None, None, None, None, [0, 1], 'admin1',
+                            area=area, order='spatial'
+                        ))
+
+        self.assertEqual(((area, ), {}), ae.call_args)
+        ranges = util._hilbert_ranges(8.0, 45.0, 8.5, 45.5)
+        self.assertTrue(len(ranges) > 1)
+        self.assertEqual(1, sq.call_count)
+        query, args = sq.call_args[0]
+        self.assertEqual(len(ranges), query.count('BETWEEN %s AND %s'))
+        self.assertEqual(['admin0', 7] + [key for key_range in ranges
+                                          for key in key_range], args)
+
+    def test_empty_area(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = True
+            with mock.patch('exposure.util._column_exists') as ce:
+                ce.return_value = True
+                with mock.patch('exposure.util.area_extent') as ae:
+                    ae.return_value = None
+                    with mock.patch('exposure.util._stream_query') as sq:
+                        util._get_subnational_exposure(
+                            None, None, None, None, [0], 'admin1',
+                            area=util.region_area('admin0', 7),
+                            order='spatial'
+                        )
+
+        query, args = sq.call_args[0]
+        self.assertIn('    AND FALSE\nORDER BY fact.hilbert_key', query)
+        self.assertEqual(['admin0', 7], args)
+
+    def test_without_hilbert_keys(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = True
+            with mock.patch('exposure.util._column_exists') as ce:
+                ce.return_value = False
+                with mock.patch('exposure.util._stream_query') as sq:
+                    util._get_subnational_exposure(
+                        '8.1', '45.2', '9.1', '46.2', [0], 'admin2',
+                        order='spatial'
+                    )
+
+        query, args = sq.call_args[0]
+        self.assertIn('AND fact.dist_occupancy_id IN (0)\n'
+                      'ORDER BY fact.grid_id\n', query)
+        self.assertEqual(['8.1', '45.2', '9.1', '46.2'], args)
+
+    def test_build_hilbert_keys(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = True
+            with mock.patch('exposure.util._column_exists') as ce:
+                ce.return_value = False
+                with mock.patch('exposure.util._columns_found', set()):
+                    with mock.patch('exposure.util.connections') as conns:
+                        self.assertTrue(util._build_hilbert_keys('admin2'))
+
+        calls = conns['geddb'].cursor.return_value.execute.call_args_list
+        self.assertEqual(3, len(calls))
+        self.assertIn('CREATE OR REPLACE FUNCTION ged2.exposure_hilbert_key(',
+                      calls[0][0][0])
+        self.assertIn('n bigint := 65536;', calls[0][0][0])
+        self.assertEqual(('ALTER TABLE ged2.exposure_fact_admin2 '
+                          'ADD COLUMN hilbert_key bigint', ), calls[1][0])
+        self.assertIn('CLUSTER ged2.exposure_fact_admin2 USING '
+                      'exposure_fact_admin2_hilbert_key_idx;', calls[2][0][0])
+
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = False
+            self.assertFalse(util._build_hilbert_keys('admin2'))
+
+    def test_build_facts_fills_hilbert_keys(self):
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = True
+            with mock.patch('exposure.util._column_exists') as ce:
+                ce.return_value = True
+                with mock.patch('exposure.util.connections') as conns:
+                    util._build_exposure_facts('admin0')
+
+        calls = conns['geddb'].cursor.return_value.execute.call_args_list
+        self.assertEqual(
+            (('UPDATE ged2.exposure_fact_admin0 SET hilbert_key = '
+              'ged2.exposure_hilbert_key(lon, lat) WHERE hilbert_key IS NULL',
+              ), {}),
+            calls[2]
+        )
+
+    def test_stream_building_exposure(self):
+        request = FakeHttpGetRequest(dict(
+            outputType='csv', residential='res', timeOfDay='day',
+            adminLevel='admin0', lng1='8.1', lat1='45.2', lng2='9.1',
+            lat2='46.2', order='spatial'
+        ))
+        with mock.patch('exposure.tilecache.get_exposure') as tge:
+            with mock.patch('exposure.util._get_national_exposure') as gne:
+                gne.return_value = []
+                list(views._stream_building_exposure(request, 'csv'))
+
+        self.assertFalse(tge.called)
+        self.assertEqual(
+            mock.call('8.1', '45.2', '9.1', '46.2', 'day', [0],
+                      taxonomy=None, area=None, order='spatial'),
+            gne.call_args
+        )
+
+    def test_admission(self):
+        params = dict(adminLevel='admin0', lng1='8', lat1='45', lng2='9',
+                      lat2='46', order='random')
+        status, error, _ = views._export_admission(params, 'building')
+        self.assertEqual(403, status)
+        self.assertEqual("Invalid 'order' selection: 'random'. "
+                         "Expected 'id' or 'spatial'.", error)
+
+
+class BatchExportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.estimate_patch = mock.patch('exposure.util._estimate_export_rows',
+                                         return_value=None)
+        self.estimate_patch.start()
+        self.get_dict = dict(
+            outputType='csv', residential='res', timeOfDay='day',
+            adminLevel='admin0',
+            areas=('[[8.1, 45.2, 9.1, 46.2], '
+                   '"POLYGON((8 45, 9 45, 9 46, 8 45))", '
+                   '{"type": "Polygon", '
+                   '"coordinates": [[[8, 45], [8.5, 46], [9, 45], [8, 45]]]}]')
+        )
+
+    def tearDown(self):
+        self.estimate_patch.stop()
+
+    def test_parse_areas(self):
+        area = batch.parse_areas(self.get_dict['areas'])
+
+        self.assertEqual('batch', area[0])
+        self.assertEqual(('bbox', None, (8.1, 45.2, 9.1, 46.2)), area[1][0])
+        self.assertEqual('wkt', area[1][1][0])
+        self.assertEqual('geojson', area[1][2][0])
+        self.assertEqual((8, 45, 9.1, 46.2), area[2])
+
+        for text in ('', '{}', '[]', '[[1, 2, 3]]', '[[1, 2, 3, 400]]',
+                     '[42]', '["POINT(1 2)"]'):
+            self.assertRaises(ValueError, batch.parse_areas, text)
+        with mock.patch('exposure.util.MAX_BATCH_AREAS', 2):
+            self.assertRaises(ValueError, batch.parse_areas,
+                              self.get_dict['areas'])
+
+    def test_spatial_filter(self):
+        area = util.batch_area([util.bbox_area(8, 45, 9, 46),
+                                util.bbox_area(10, 45, 11, 46)])
+        area_filter, args = util._spatial_filter(
+            'fact.grid_id', 'fact.the_geom', None, None, None, None, area
+        )
+        self.assertEqual(
+            '(ST_intersects(ST_MakeEnvelope(%s, %s, %s, %s, 4326), '
+            'fact.the_geom)\n        OR '
+            'ST_intersects(ST_MakeEnvelope(%s, %s, %s, %s, 4326), '
+            'fact.the_geom))', area_filter
+        )
+        self.assertEqual([8, 45, 9, 46, 10, 45, 11, 46], args)
+
+        members, args = util._area_members('fact.grid_id', 'fact.the_geom',
+                                           area)
+        self.assertEqual(
+            ',\n    (CASE WHEN ST_intersects(ST_MakeEnvelope(%s, %s, %s, %s, '
+            '4326), fact.the_geom) THEN 1 ELSE 0 END\n     + '
+            'CASE WHEN ST_intersects(ST_MakeEnvelope(%s, %s, %s, %s, 4326), '
+            'fact.the_geom) THEN 2 ELSE 0 END) AS areas', members
+        )
+        self.assertEqual([8, 45, 9, 46, 10, 45, 11, 46], args)
+        self.assertEqual(('', []), util._area_members(
+            'fact.grid_id', 'fact.the_geom', util.region_area('admin0', 7)
+        ))
+
+    def test_subnational_exposure(self):
+        area = util.batch_area([util.bbox_area(8, 45, 9, 46),
+                                util.parse_polygon('POLYGON((8 45, 9 45, '
+                                                   '9 46, 8 45))')])
+        with mock.patch('exposure.util._table_exists') as te:
+            te.return_value = True
+            with mock.patch('exposure.util._resolve_taxonomy') as rt:
+                rt.return_value = ['MUR']
+                with mock.patch('exposure.util._stream_query') as sq:
+                    util._get_subnational_exposure(
+                        None, None, None, None, [0], 'admin1',
+                        taxonomy=('MUR', ), area=area
+                    )
+
+        query, args = sq.call_args[0]
+        self.assertIn('    fact.dwelling_fraction,\n    (CASE WHEN ', query)
+        self.assertIn('THEN 2 ELSE 0 END) AS areas\nFROM', query)
+        # One query for all of the areas.
+        self.assertEqual(1, sq.call_count)
+        polygon = 'POLYGON((8 45, 9 45, 9 46, 8 45))'
+        self.assertEqual([8, 45, 9, 46, polygon, 8, 45, 9, 46, polygon,
+                          ['MUR']], args)
+
+    def test_split(self):
+        rows = [(1, 'a', 1), (2, 'b', 3), (3, 'c', 6), (4, 'd', 4),
+                (5, 'e', 2)]
+        with mock.patch('exposure.util.EXPORT_FETCH_SIZE', 1):
+            first, second, third = batch.split(iter(rows), 3)
+            self.assertEqual([(1, 'a'), (2, 'b')], list(first))
+            self.assertEqual([(2, 'b'), (3, 'c'), (5, 'e')], list(second))
+            self.assertEqual([(3, 'c'), (4, 'd')], list(third))
+
+    def test_view(self):
+        request = FakeHttpGetRequest(self.get_dict)
+        rows = [
+            (1, 8.5, 45.5, 10.0, 3, 'ITA', 5, 'MUR', 0.5, 0.4, None, None, 3),
+            (2, 9.05, 46.1, 20.0, 3, 'ITA', 5, 'CR', 0.5, 0.4, None, None, 1),
+        ]
+        with mock.patch('exposure.util._get_national_exposure') as gne:
+            gne.return_value = iter(rows)
+            response = views.export_building_batch(request)
+            archive = zipfile.ZipFile(StringIO.StringIO(response.content))
+
+        self.assertEqual(1, gne.call_count)
+        area = gne.call_args[1]['area']
+        self.assertEqual(3, len(area[1]))
+        self.assertEqual('application/zip', response['Content-Type'])
+        self.assertEqual('attachment; filename="exposure_export.zip"',
+                         response['Content-Disposition'])
+        self.assertEqual(['exposure_export_1.csv', 'exposure_export_2.csv',
+                          'exposure_export_3.csv'], archive.namelist())
+        self.assertEqual(
+            ''.join(views._bldg_csv_admin0_generator(
+                [row[:-1] for row in rows]
+            )),
+            archive.read('exposure_export_1.csv')
+        )
+        self.assertEqual(
+            ''.join(views._bldg_csv_admin0_generator([rows[0][:-1]])),
+            archive.read('exposure_export_2.csv')
+        )
+        self.assertEqual(''.join(views._bldg_csv_admin0_generator([])),
+                         archive.read('exposure_export_3.csv'))
+
+    def test_admission(self):
+        status, error, area = views._batch_admission(self.get_dict)
+        self.assertEqual((200, ''), (status, error))
+        self.assertEqual('batch', area[0])
+
+        params = dict(self.get_dict, aggregate='admin1')
+        self.assertEqual(403, views._batch_admission(params)[0])
+        params = dict(self.get_dict, areas='[]')
+        self.assertEqual((403, 'No export area given', None),
+                         views._batch_admission(params))
+
+        # Each area is checked on its own.
+        params = dict(self.get_dict, areas='[[8, 45, 9, 46], [0, 0, 5, 5]]')
+        with mock.patch('exposure.views._export_area_valid') as eav:
+            eav.side_effect = [(True, ''), (False, 'Too large')]
+            self.assertEqual((403, 'Too large', None),
+                             views._batch_admission(params))
+        self.assertEqual(mock.call(0.0, 0.0, 5.0, 5.0), eav.call_args)
+
+        request = FakeHttpGetRequest(dict(self.get_dict, areas='['))
+        self.assertEqual(403, views.export_building_batch(request).status_code)
+
+    def test_admission_total_rows(self):
+        params = dict(self.get_dict,
+                      areas='[[8, 45, 9, 46], [10, 45, 11, 46]]')
+        with mock.patch('exposure.views.MAX_EXPORT_ROWS', 1000):
+            with mock.patch('exposure.util._estimate_export_rows') as eer:
+                # Each area is allowed on its own ...
+                eer.return_value = 600
+                self.assertEqual(200, views._export_admission(
+                    dict(params, lng1=8, lat1=45, lng2=9, lat2=46),
+                    'building', background=False
+                )[0])
+                # ... but not both of them.
+                status, error, area = views._batch_admission(params)
+
+                eer.return_value = 500
+                self.assertEqual(200, views._batch_admission(params)[0])
+
+        self.assertEqual(403, status)
+        self.assertEqual(
+            'The export areas contain too much exposure data.'
+            '<br />Estimated number of rows: 1200.'
+            '<br />Max allowed number of rows: 1000.', error
+        )
+        self.assertIsNone(area)
+
+
+class TileCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.patches = [
+            mock.patch('exposure.tilecache.TILE_CACHE_DIR', self.cache_dir),
+            mock.patch('exposure.tilecache.TILE_SIZE', 0.5),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+        # Grid points every 0.25 degrees over [0, 2] x [0, 2], with ids
+        # increasing north to south, so that the id order differs from the
+        # tile order.
+        self.points = []
+        for j in range(9):
+            for i in range(9):
+                self.points.append((100 - j * 10 + i, i * 0.25, j * 0.25))
+        self.points.sort()
+
+        def query(lng1, lat1, lng2, lat2, tod):
+            return [pt + (tod, ) for pt in self.points
+                    if lng1 <= pt[1] <= lng2 and lat1 <= pt[2] <= lat2]
+
+        self.query = mock.Mock(side_effect=query)
+        self.query.__name__ = 'query'
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_disabled(self):
+        with mock.patch('exposure.tilecache.TILE_CACHE_DIR', None):
+            tilecache.get_exposure(self.query, '0.1', '0.1', '1.1', '1.1',
+                                   'day')
+        self.assertEqual((('0.1', '0.1', '1.1', '1.1', 'day'), {}),
+                         self.query.call_args)
+
+    def test_compose(self):
+        rows = list(tilecache.get_exposure(self.query, '1.3', '1.5', '0.25',
+                                           '0.4', 'day'))
+
+        expected = self.query(0.25, 0.4, 1.3, 1.5, 'day')
+        self.assertEqual(expected, rows)
+        # One query for the 3 x 4 tiles, plus the direct query above
+        self.assertEqual(2, self.query.call_count)
+        self.assertEqual(((0, 0, 1.5, 2.0, 'day'), {}),
+                         self.query.call_args_list[0])
+        self.assertEqual(12, len(self._tile_files()))
+
+        # Tiles are now cached:
+        self.query.reset_mock()
+        rows = list(tilecache.get_exposure(self.query, '0', '0', '1.5',
+                                           '1.5', 'day'))
+        self.assertEqual(self.query(0, 0, 1.5, 1.5, 'day'), rows)
+        # 4 x 4 tiles, of which 3 x 4 are cached: the last column is
+        # queried.
+        self.assertEqual(1 + 1, self.query.call_count)
+        self.assertEqual(((1.5, 0, 2.0, 2.0, 'day'), {}),
+                         self.query.call_args_list[0])
+
+    def test_different_args_are_cached_separately(self):
+        list(tilecache.get_exposure(self.query, '0.1', '0.1', '0.2', '0.2',
+                                    'day'))
+        rows = list(tilecache.get_exposure(self.query, '0.1', '0.1', '0.3',
+                                           '0.3', 'night'))
+        self.assertEqual([(91, 0.25, 0.25, 'night')], rows)
+        self.assertEqual(2, self.query.call_count)
+
+    def test_too_many_tiles(self):
+        with mock.patch('exposure.tilecache.TILE_CACHE_MAX_TILES', 8):
+            list(tilecache.get_exposure(self.query, '0', '0', '1', '1',
+                                        'day'))
+        self.assertEqual((('0', '0', '1', '1', 'day'), {}),
+                         self.query.call_args)
+        self.assertEqual(1, self.query.call_count)
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def test_evict(self):
+        list(tilecache.get_exposure(self.query, '0', '0', '0.4', '0.4',
+                                    'day'))
+        [first] = os.listdir(self.cache_dir)
+        os.utime(os.path.join(self.cache_dir, first), (0, 0))
+
+        with mock.patch('exposure.tilecache.TILE_CACHE_MAX_BYTES', 1):
+            list(tilecache.get_exposure(self.query, '0.6', '0', '0.9', '0.4',
+                                        'day'))
+        # The least recently used tile is evicted first; the last one too,
+        # since it doesn't fit either.
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def _tile_files(self):
+        return [name for name in os.listdir(self.cache_dir)
+                if name.endswith('.tile')]
+
+    def test_streams_missing_tiles(self):
+        rows = tilecache.get_exposure(self.query, '0', '0', '1.5', '1.5',
+                                      'day')
+        self.assertEqual((40, 0.0, 1.5, 'day'), next(rows))
+        # The tiles are queried at once, but no tile is cached until all
+        # of them have been read.
+        self.assertEqual(1, self.query.call_count)
+        self.assertEqual([], self._tile_files())
+
+        list(rows)
+        self.assertEqual(16, len(self._tile_files()))
+
+    def test_abandoned_tiles_are_not_cached(self):
+        rows = tilecache.get_exposure(self.query, '0', '0', '1.5', '1.5',
+                                      'day')
+        next(rows)
+        rows.close()
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def test_missing_tiles_queried_in_parallel(self):
+        threads = set()
+        query = self.query.side_effect
+
+        def threaded_query(*args):
+            threads.add(threading.current_thread().name)
+            return query(*args)
+
+        self.query.side_effect = threaded_query
+        with mock.patch('exposure.util.EXPORT_QUERY_WORKERS', 3):
+            with mock.patch('exposure.util.PARALLEL_QUERY_MIN_AREA_SQ_DEG',
+                            1):
+                # 1 of the 4 x 4 tiles is cached.
+                list(tilecache.get_exposure(self.query, '0', '0', '0.4',
+                                            '0.4', 'day'))
+                self.query.reset_mock()
+                threads.clear()
+                rows = list(tilecache.get_exposure(self.query, '0', '0',
+                                                   '1.5', '1.5', 'day'))
+
+        self.assertEqual(query(0, 0, 1.5, 1.5, 'day'), rows)
+        # The 2 rectangles of missing tiles are split in 3.
+        self.assertEqual(3, self.query.call_count)
+        self.assertEqual(3, len(threads))
+        self.assertNotIn(threading.current_thread().name, threads)
+        self.assertEqual(16, len(self._tile_files()))
+
+    def test_tile_rectangles(self):
+        self.assertEqual([], tilecache._tile_rectangles([]))
+        # An L shape, and a separate tile:
+        tiles = [(0, 0), (1, 0), (2, 0), (0, 1), (1, 1), (2, 1), (0, 2),
+                 (5, 2)]
+        self.assertEqual([(0, 0, 2, 1), (0, 2, 0, 2), (5, 2, 5, 2)],
+                         tilecache._tile_rectangles(tiles))
+        self.assertEqual(
+            [(0, 2, 0, 2), (5, 2, 5, 2), (0, 0, 1, 1), (2, 0, 2, 1)],
+            tilecache._split_rectangles(tilecache._tile_rectangles(tiles), 4)
+        )
+        self.assertEqual([(0, 0, 0, 0)],
+                         tilecache._split_rectangles([(0, 0, 0, 0)], 4))
+
+    def test_scattered_missing_tiles(self):
+        # Every other tile of the 4 x 4 tiles is cached.
+        for tx in range(4):
+            for ty in range(tx % 2, 4, 2):
+                list(tilecache.get_exposure(
+                    self.query, tx * 0.5 + 0.1, ty * 0.5 + 0.1,
+                    tx * 0.5 + 0.2, ty * 0.5 + 0.2, 'day'
+                ))
+        self.query.reset_mock()
+
+        with mock.patch('exposure.tilecache.TILE_CACHE_MAX_QUERIES', 4):
+            rows = list(tilecache.get_exposure(self.query, '0', '0', '1.5',
+                                               '1.5', 'day'))
+
+        # The 8 missing tiles are queried at once, with the cached ones.
+        self.assertEqual(1, self.query.call_count)
+        self.assertEqual(((0, 0, 2.0, 2.0, 'day'), {}),
+                         self.query.call_args_list[0])
+        self.assertEqual(self.query(0, 0, 1.5, 1.5, 'day'), rows)
+        self.assertEqual(16, len(self._tile_files()))
+
+
+class ExportMetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.params = dict(outputType='csv', lng1='8', lat1='45', lng2='9',
+                           lat2='46', other='not recorded')
+
+    def tearDown(self):
+        metrics.reset()
+
+    def test_instrument(self):
+        def export():
+            # Database time is added to the active record:
+            metrics.current().add_db_time('fetch', 0.5, rows=3)
+            yield 'abc'
+            yield 'de'
+
+        chunks = list(metrics.instrument('population', self.params, export()))
+
+        self.assertEqual(['abc', 'de'], chunks)
+        self.assertEqual(None, metrics.current())
+        [record] = metrics.snapshot()['recent']
+        self.assertEqual('population', record['export'])
+        self.assertEqual('complete', record['status'])
+        self.assertEqual(3, record['rows'])
+        self.assertEqual(5, record['bytes'])
+        self.assertEqual(0.5, record['timings']['fetch'])
+        self.assertEqual('csv', record['outputType'])
+        self.assertFalse(record['background'])
+        self.assertNotIn('other', record)
+
+        totals = metrics.snapshot()['totals']['population']
+        self.assertEqual(1, totals['exports'])
+        self.assertEqual(1, totals['complete'])
+        self.assertEqual(5, totals['bytes'])
+
+    def test_aborted_and_failed(self):
+        chunks = metrics.instrument('building', self.params, iter(['a', 'b']))
+        next(chunks)
+        chunks.close()
+
+        def export():
+            yield 'a'
+            raise RuntimeError('boom')
+
+        with self.assertRaises(RuntimeError):
+            list(metrics.instrument('building', self.params, export()))
+
+        self.assertEqual(['aborted', 'failed'],
+                         [r['status'] for r in metrics.snapshot()['recent']])
+
+    def test_stream_query_records_db_time(self):
+        record = metrics.ExportRecord('population', {})
+        metrics.activate(record)
+        try:
+            with mock.patch('exposure.util.connections') as conns:
+                named_cursor = conns['geddb'].connection.cursor.return_value
+                named_cursor.fetchmany.side_effect = [[(1, ), (2, )], []]
+                list(util._stream_query('SELECT 1', []))
+        finally:
+            metrics.activate(None)
+
+        self.assertEqual(2, record.rows)
+
+    def test_abort_cancels_running_queries(self):
+        pg_conn = mock.Mock()
+
+        def export():
+            # A query running in another thread (see util._parallel_query):
+            metrics.current().query_started(pg_conn)
+            yield 'a'
+            yield 'b'
+
+        chunks = metrics.instrument('building', self.params, export())
+        next(chunks)
+        chunks.close()
+
+        self.assertEqual(1, pg_conn.cancel.call_count)
+        [record] = metrics.snapshot()['recent']
+        self.assertEqual('aborted', record['status'])
+        self.assertEqual(1, record['cancelled_queries'])
+        totals = metrics.snapshot()['totals']['building']
+        self.assertEqual(1, totals['cancelled'])
+
+    def test_deadline(self):
+        pg_conn = mock.Mock()
+
+        def export():
+            record = metrics.current()
+            record.query_started(pg_conn)
+            yield 'a'
+            # Until the query is cancelled:
+            for _ in range(100):
+                if pg_conn.cancel.called:
+                    break
+                time.sleep(0.01)
+            yield 'b'
+
+        with mock.patch('exposure.metrics.EXPORT_DEADLINE', 0.05):
+            chunks = metrics.instrument('building', self.params, export())
+            self.assertEqual('a', next(chunks))
+            self.assertRaises(metrics.ExportCancelled, next, chunks)
+
+            # No deadline for background jobs:
+            self.assertEqual(['a', 'b'], list(metrics.instrument(
+                'building', self.params, iter(['a', 'b']), background=True
+            )))
+
+        self.assertEqual(['timed_out', 'complete'],
+                         [r['status'] for r in metrics.snapshot()['recent']])
+
+    def test_not_cancellable(self):
+        pg_conn = mock.Mock()
+        record = metrics.ExportRecord('building', {})
+        record.cancellable = False
+        record.query_started(pg_conn)
+        record.cancel()
+
+        self.assertFalse(record.cancelled)
+        self.assertEqual(0, pg_conn.cancel.call_count)
+
+    def test_stream_query_cancelled(self):
+        record = metrics.ExportRecord('population', {})
+
+        def fetchmany(size):
+            # The client goes away while the rows are fetched:
+            record.cancel()
+            raise Exception('canceling statement due to user request')
+
+        metrics.activate(record)
+        try:
+            with mock.patch('exposure.util.connections') as conns:
+                pg_conn = conns['geddb'].connection
+                named_cursor = pg_conn.cursor.return_value
+                named_cursor.fetchmany.side_effect = fetchmany
+                self.assertRaises(metrics.ExportCancelled, list,
+                                  util._stream_query('SELECT 1', []))
+                # The connection is released:
+                self.assertEqual(1, conns['geddb'].close.call_count)
+                self.assertEqual(1, pg_conn.cancel.call_count)
+
+                # Queries of the cancelled export don't run:
+                self.assertRaises(metrics.ExportCancelled, list,
+                                  util._stream_query('SELECT 1', []))
+                self.assertEqual(1, named_cursor.execute.call_count)
+        finally:
+            metrics.activate(None)
+
+    def test_view(self):
+        request = FakeHttpGetRequest(dict())
+        request.user.is_staff = False
+        self.assertEqual(403, views.export_metrics(request).status_code)
+
+        request.user.is_staff = True
+        resp = views.export_metrics(request)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(dict(totals={}, recent=[]),
+                         simplejson.loads(resp.content))
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def test_synthetic_rows(self):
+        national = list(benchmark._synthetic_national_rows(3, 'all'))
+        self.assertEqual(3, len(national))
+        self.assertEqual(12, len(national[0]))
+        self.assertNotEqual(None, national[0][9])
+        subnat = list(benchmark._synthetic_subnat_rows(3))
+        self.assertEqual(9, len(subnat[0]))
+
+    def test_all_serializers(self):
+        # Every export generator is benchmarked.
+        generators = set(
+            getattr(module, name) for module in (views, columnar)
+            for name in dir(module) if name.endswith('_generator')
+        )
+        if not columnar.available():
+            generators -= set([columnar.bldg_admin0_generator,
+                               columnar.bldg_subnat_generator,
+                               columnar.pop_generator])
+        self.assertEqual(generators, set(
+            generator for _, generator, _ in benchmark.SERIALIZERS
+        ))
+
+    def test_serializers_run(self):
+        for name, generator, rows_func in benchmark.SERIALIZERS:
+            result = benchmark._run_serializer(generator, rows_func, 10)
+            self.assertTrue(result['bytes'] > 0, name)
+
+    def test_check_regressions(self):
+        baseline = {'pop_csv/10': dict(rows_per_sec=100, peak_memory=100)}
+        results = {'pop_csv/10': dict(rows_per_sec=85, peak_memory=100),
+                   'pop_nrml/10': dict(rows_per_sec=1, peak_memory=1)}
+        self.assertEqual([], benchmark.check_regressions(results, baseline,
+                                                         0.2))
+
+        results['pop_csv/10'].update(rows_per_sec=79, peak_memory=121)
+        self.assertEqual(2, len(benchmark.check_regressions(results,
+                                                            baseline, 0.2)))
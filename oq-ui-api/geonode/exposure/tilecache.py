@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2013, GEM Foundation.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/agpl.html>.
+
+"""
+Disk cache of export query results, partitioned in tiles.
+
+The world is cut into square tiles of :data:`TILE_SIZE` degrees. The result
+of an export query (see :func:`exposure.util._get_national_exposure` and
+friends) for one tile is stored in its own file, so that overlapping exports
+share the tiles they have in common. An export is composed from the tiles
+covering its bounding box: only the missing tiles are queried, the rows of
+the tiles on the edges of the bounding box are clipped to it, and the rows of
+all tiles are merged back in grid point id order, as returned by the
+queries.
+
+The missing tiles are grouped in rectangles of contiguous tiles, and each
+rectangle is queried at once, its rows being split into tiles as they are
+read, so that an export runs at most :data:`TILE_CACHE_MAX_QUERIES` queries
+(or as many as :data:`exposure.util.EXPORT_QUERY_WORKERS`, when they run in
+parallel, as the strips of :func:`exposure.util.get_exposure`). The rows of
+the missing tiles are streamed as they are queried, and the tiles of a
+rectangle are written to the cache once all of its rows have been read.
+
+Each tile file is a sequence of records, each holding a 4-byte length
+followed by a zlib-compressed pickle of a batch of rows. Files are evicted
+in least recently used order once they take more than
+:data:`TILE_CACHE_MAX_BYTES`.
+
+The cache is disabled unless :data:`TILE_CACHE_DIR` is set. It must be
+cleared (see the `clear_exposure_tile_cache` management command) whenever
+the GED data changes.
+"""
+
+import cPickle
+import hashlib
+import heapq
+import math
+import os
+import shutil
+import struct
+import uuid
+import zlib
+
+from django.conf import settings
+
+from exposure import metrics
+from exposure import util
+
+#: Directory of the tile cache. `None` disables the cache.
+TILE_CACHE_DIR = getattr(settings, 'EXPOSURE_TILE_CACHE_DIR', None)
+#: Size (in degrees) of the tiles. Use a power of two fraction of a degree,
+#: so that tile edges are exact in floating point.
+TILE_SIZE = getattr(settings, 'EXPOSURE_TILE_SIZE', 0.25)
+#: Total size (in bytes) of the tile files above which the least recently
+#: used ones are deleted.
+TILE_CACHE_MAX_BYTES = getattr(settings, 'EXPOSURE_TILE_CACHE_MAX_BYTES',
+                               2 ** 30)
+#: Exports covering more tiles than this bypass the cache, since each tile
+#: file is open while the export is composed.
+TILE_CACHE_MAX_TILES = getattr(settings, 'EXPOSURE_TILE_CACHE_MAX_TILES', 256)
+
+#: Maximum number of queries run for the missing tiles of an export. If the
+#: missing tiles make more rectangles than this, all of the tiles of the
+#: export are queried again, at once.
+TILE_CACHE_MAX_QUERIES = getattr(settings, 'EXPOSURE_TILE_CACHE_MAX_QUERIES',
+                                 8)
+
+#: Version of the tile file format, part of the cache keys.
+_FORMAT_VERSION = 1
+_RECORD_HEADER = struct.Struct('<I')
+_TILE_SUFFIX = '.tile'
+
+
+def enabled():
+    """
+    :returns:
+        `True` if the tile cache is configured.
+    """
+    return TILE_CACHE_DIR is not None
+
+
+def get_exposure(query_func, lng1, lat1, lng2, lat2, *args):
+    """
+    Get the rows of an export query for a bounding box, through the tile
+    cache.
+
+    If the cache is disabled, or the bounding box covers too many tiles, the
+    query is run directly on the bounding box (see
+    :func:`exposure.util.get_exposure`).
+
+    :param query_func:
+        The export query function, for example
+        :func:`exposure.util._get_national_exposure`. Its first four
+        arguments must be the bounding box, and the rows it returns must be
+        ordered by grid point id, with the id, longitude and latitude as the
+        first three columns.
+    :param lng1, lat1, lng2, lat2:
+        The bounding box.
+    :param args:
+        The other arguments of `query_func`. Together with the name of the
+        function, they identify the cached results.
+    :returns:
+        An iterator over the result rows.
+    """
+    if not enabled():
+        return util.get_exposure(query_func, lng1, lat1, lng2, lat2, *args)
+
+    x1, y1, x2, y2 = util._snap_to_cells(lng1, lat1, lng2, lat2, TILE_SIZE)
+    if (x2 - x1 + 1) * (y2 - y1 + 1) > TILE_CACHE_MAX_TILES:
+        return util.get_exposure(query_func, lng1, lat1, lng2, lat2, *args)
+
+    bbox = _normalize_bbox(lng1, lat1, lng2, lat2)
+    return _compose(query_func, args, bbox, x1, y1, x2, y2)
+
+
+def clear():
+    """
+    Delete all of the cached tiles.
+    """
+    if enabled() and os.path.isdir(TILE_CACHE_DIR):
+        shutil.rmtree(TILE_CACHE_DIR, ignore_errors=True)
+
+
+def _normalize_bbox(lng1, lat1, lng2, lat2):
+    lng1, lat1, lng2, lat2 = [float(x) for x in (lng1, lat1, lng2, lat2)]
+    return (min(lng1, lng2), min(lat1, lat2), max(lng1, lng2),
+            max(lat1, lat2))
+
+
+def _compose(query_func, args, bbox, x1, y1, x2, y2):
+    # Open the cached tiles first: once open, a tile can't be lost to the
+    # eviction run by another export.
+    tiles = []
+    missing = []
+    try:
+        for tx in xrange(x1, x2 + 1):
+            for ty in xrange(y1, y2 + 1):
+                fh = _open_tile(query_func, args, tx, ty)
+                if fh is None:
+                    missing.append((tx, ty))
+                else:
+                    tiles.append((tx, ty, fh))
+
+        rectangles = _tile_rectangles(missing)
+        if len(rectangles) > TILE_CACHE_MAX_QUERIES:
+            # Scattered missing tiles: query them all at once, with the
+            # cached ones.
+            for _, _, fh in tiles:
+                fh.close()
+            tiles = []
+            rectangles = [(x1, y1, x2, y2)]
+
+        streams = [_tile_rows(_read_tile(fh), tx, ty, bbox)
+                   for tx, ty, fh in tiles]
+        stop = None
+        if rectangles:
+            missing_streams, stop = _query_rectangles(query_func, args,
+                                                      bbox, rectangles)
+            streams.extend(missing_streams)
+        try:
+            for row in _merge(streams):
+                yield row
+        finally:
+            if stop is not None:
+                stop.set()
+    finally:
+        for _, _, fh in tiles:
+            fh.close()
+
+
+def _tile_rectangles(tiles):
+    """
+    Group tiles in rectangles of contiguous tiles: the runs of consecutive
+    tiles of each row of tiles, merged with the same runs of the rows below.
+
+    :param tiles:
+        A list of (x, y) tiles.
+    :returns:
+        A list of (x1, y1, x2, y2) rectangles of tiles (bounds included).
+    """
+    runs = []
+    for tx, ty in sorted(tiles, key=lambda tile: (tile[1], tile[0])):
+        if runs and runs[-1][1] == ty and runs[-1][2] == tx - 1:
+            runs[-1][2] = tx
+        else:
+            runs.append([tx, ty, tx])
+
+    rectangles = []
+    # The rectangle which a run extends, by the bounds of the run.
+    last = dict()
+    for tx1, ty, tx2 in runs:
+        rectangle = last.get((tx1, tx2))
+        if rectangle is not None and rectangle[3] == ty - 1:
+            rectangle[3] = ty
+        else:
+            rectangle = [tx1, ty, tx2, ty]
+            rectangles.append(rectangle)
+            last[(tx1, tx2)] = rectangle
+    return [tuple(rectangle) for rectangle in rectangles]
+
+
+def _split_rectangles(rectangles, count):
+    """
+    Split the largest rectangles of tiles in halves, along their longest
+    side, until there are `count` rectangles, or they are all single tiles.
+    """
+    rectangles = list(rectangles)
+    while len(rectangles) < count:
+        area, i = max(((x2 - x1 + 1) * (y2 - y1 + 1), i)
+                      for i, (x1, y1, x2, y2) in enumerate(rectangles))
+        if area == 1:
+            break
+        x1, y1, x2, y2 = rectangles.pop(i)
+        if x2 - x1 >= y2 - y1:
+            middle = (x1 + x2) // 2
+            rectangles.extend([(x1, y1, middle, y2), (middle + 1, y1, x2, y2)])
+        else:
+            middle = (y1 + y2) // 2
+            rectangles.extend([(x1, y1, x2, middle), (x1, middle + 1, x2, y2)])
+    return rectangles
+
+
+def _query_rectangles(query_func, args, bbox, rectangles):
+    """
+    Query the rectangles of tiles missing from the cache, caching the tiles
+    as their rows are read.
+
+    The rectangles are split between :data:`exposure.util.EXPORT_QUERY_WORKERS`
+    threads, as the strips of a parallel query (see
+    :func:`exposure.util.get_exposure`), if they cover enough area.
+
+    :returns:
+        A pair of the list of the iterators over the rows, and the event to
+        set to stop the query threads (or `None`).
+    """
+    workers = util.EXPORT_QUERY_WORKERS
+    area = sum((x2 - x1 + 1) * (y2 - y1 + 1)
+               for x1, y1, x2, y2 in rectangles) * TILE_SIZE ** 2
+    if workers > 1 and area >= util.PARALLEL_QUERY_MIN_AREA_SQ_DEG:
+        rectangles = _split_rectangles(rectangles, workers)
+        if len(rectangles) > 1:
+            groups = [rectangles[i::workers]
+                      for i in xrange(min(workers, len(rectangles)))]
+            return util._query_threads([
+                (_query_rectangle_group, (query_func, args, bbox, group),
+                 None)
+                for group in groups
+            ])
+    return [_query_rectangle_group(query_func, args, bbox, rectangles)], None
+
+
+def _query_rectangle_group(query_func, args, bbox, rectangles):
+    """
+    :returns:
+        An iterator over the rows of `rectangles` within `bbox`, in grid
+        point id order.
+    """
+    return _merge([_query_rectangle(query_func, args, bbox, rectangle)
+                   for rectangle in rectangles])
+
+
+def _query_rectangle(query_func, args, bbox, rectangle):
+    """
+    :returns:
+        An iterator over the rows of a rectangle of tiles within `bbox`, in
+        grid point id order. The tiles are cached once all of the rows have
+        been read.
+    """
+    x1, y1, x2, y2 = rectangle
+    rows = query_func(x1 * TILE_SIZE, y1 * TILE_SIZE, (x2 + 1) * TILE_SIZE,
+                      (y2 + 1) * TILE_SIZE, *args)
+    rows = _cache_tiles(query_func, args, rectangle, rows)
+    if _rectangle_within(rectangle, bbox):
+        return rows
+    return _clip(rows, bbox)
+
+
+def _tile_rows(rows, tx, ty, bbox):
+    if _tile_within(tx, ty, bbox):
+        return rows
+    return _clip(rows, bbox)
+
+
+def _merge(streams):
+    # Decorate with the grid id for the merge; the stream index breaks ties
+    # without comparing the rows themselves.
+    streams = [((row[0], i, row) for row in rows)
+               for i, rows in enumerate(streams)]
+    for _, _, row in heapq.merge(*streams):
+        yield row
+
+
+def _tile_within(tx, ty, bbox):
+    return _rectangle_within((tx, ty, tx, ty), bbox)
+
+
+def _rectangle_within(rectangle, bbox):
+    x1, y1, x2, y2 = rectangle
+    lng1, lat1, lng2, lat2 = bbox
+    return (lng1 <= x1 * TILE_SIZE and (x2 + 1) * TILE_SIZE <= lng2
+            and lat1 <= y1 * TILE_SIZE and (y2 + 1) * TILE_SIZE <= lat2)
+
+
+def _clip(rows, bbox):
+    # Same as the `ST_intersects` of the queries: edges are included.
+    lng1, lat1, lng2, lat2 = bbox
+    for row in rows:
+        if lng1 <= row[1] <= lng2 and lat1 <= row[2] <= lat2:
+            yield row
+
+
+def _tile_path(query_func, args, tx, ty):
+    key = repr((_FORMAT_VERSION, TILE_SIZE, query_func.__name__, args,
+                tx, ty))
+    return os.path.join(TILE_CACHE_DIR,
+                        hashlib.sha1(key).hexdigest() + _TILE_SUFFIX)
+
+
+def _open_tile(query_func, args, tx, ty):
+    """
+    Open the file of a cached tile.
+
+    :returns:
+        The open file, or `None` if the tile is not cached.
+    """
+    path = _tile_path(query_func, args, tx, ty)
+    try:
+        fh = open(path, 'rb')
+    except IOError:
+        return None
+    # Mark the tile as recently used.
+    os.utime(path, None)
+    return fh
+
+
+def _cache_tiles(query_func, args, rectangle, rows):
+    """
+    Yield the rows of a rectangle of tiles, writing the rows of each tile to
+    the cache at the same time. The tiles are only cached if all of the rows
+    are read.
+
+    The query includes the edges of the rectangle. Points on its upper
+    edges belong to the neighbouring tiles, and are skipped, so that no row
+    is cached twice.
+    """
+    if not os.path.isdir(TILE_CACHE_DIR):
+        try:
+            os.makedirs(TILE_CACHE_DIR)
+        except OSError:
+            # Created concurrently.
+            pass
+
+    x1, y1, x2, y2 = rectangle
+    writers = dict()
+    try:
+        for row in rows:
+            tx = int(math.floor(row[1] / TILE_SIZE))
+            ty = int(math.floor(row[2] / TILE_SIZE))
+            if not (x1 <= tx <= x2 and y1 <= ty <= y2):
+                continue
+            row = tuple(row)
+            writer = writers.get((tx, ty))
+            if writer is None:
+                writer = writers[(tx, ty)] = _TileWriter(
+                    _tile_path(query_func, args, tx, ty)
+                )
+            writer.append(row)
+            yield row
+
+        # Empty tiles are cached too.
+        for tx in xrange(x1, x2 + 1):
+            for ty in xrange(y1, y2 + 1):
+                if (tx, ty) not in writers:
+                    writers[(tx, ty)] = _TileWriter(
+                        _tile_path(query_func, args, tx, ty)
+                    )
+                writers[(tx, ty)].commit()
+    finally:
+        for writer in writers.itervalues():
+            writer.discard()
+    _evict()
+
+
+class _TileWriter(object):
+    """
+    Write the rows of a tile to a temporary file first, so that a partially
+    written tile is never read, and move it to the tile file on
+    :meth:`commit`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        self._fh = open(self._tmp_path, 'wb')
+        self._batch = []
+
+    def append(self, row):
+        self._batch.append(row)
+        if len(self._batch) == util.EXPORT_FETCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self._batch:
+            return
+        data = zlib.compress(
+            cPickle.dumps(self._batch, cPickle.HIGHEST_PROTOCOL)
+        )
+        self._fh.write(_RECORD_HEADER.pack(len(data)))
+        self._fh.write(data)
+        self._batch = []
+
+    def commit(self):
+        self._flush()
+        self._fh.close()
+        os.rename(self._tmp_path, self.path)
+
+    def discard(self):
+        """
+        Delete the temporary file, unless it was committed.
+        """
+        self._fh.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+def _read_tile(fh):
+    while True:
+        header = fh.read(_RECORD_HEADER.size)
+        if not header:
+            return
+        [length] = _RECORD_HEADER.unpack(header)
+        batch = cPickle.loads(zlib.decompress(fh.read(length)))
+        record = metrics.current()
+        if record is not None:
+            record.add_cached_rows(len(batch))
+        for row in batch:
+            yield row
+
+
+def _evict():
+    """
+    Delete the least recently used tiles, until the cache fits in
+    :data:`TILE_CACHE_MAX_BYTES`.
+    """
+    evict(TILE_CACHE_DIR, TILE_CACHE_MAX_BYTES, _TILE_SUFFIX)
+
+
+def evict(directory, max_bytes, suffix):
+    """
+    Delete the least recently used (by modification time) files of a cache
+    directory, until they take at most `max_bytes`.
+
+    :param str suffix:
+        Only the files with this suffix are part of the cache.
+    """
+    files = []
+    total = 0
+    for name in os.listdir(directory):
+        if not name.endswith(suffix):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Evicted concurrently.
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+
+    files.sort()
+    for _, size, path in files:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
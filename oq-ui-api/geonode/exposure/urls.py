@@ -18,10 +18,17 @@
 
 from django.conf.urls.defaults import patterns
 from django.conf.urls.defaults import url
+from exposure.views import download_export_job
 from exposure.views import export_building
+from exposure.views import export_building_batch
+from exposure.views import export_job_status
+from exposure.views import export_metrics
 from exposure.views import export_population
 from exposure.views import get_exposure_building_form
 from exposure.views import get_exposure_population_form
+from exposure.views import population_tile
+from exposure.views import population_total
+from exposure.views import submit_export_job
 from exposure.views import validate_export
 
 
@@ -30,6 +37,14 @@ urlpatterns = patterns(
     url(r'^validate_export', validate_export),
     url(r'^get_exposure_building_form', get_exposure_building_form),
     url(r'^get_exposure_population_form', get_exposure_population_form),
+    url(r'^export_building_batch', export_building_batch),
     url(r'^export_building', export_building),
     url(r'^export_population', export_population),
+    url(r'^export_job/submit', submit_export_job),
+    url(r'^export_job/status', export_job_status),
+    url(r'^export_job/download', download_export_job),
+    url(r'^export_metrics', export_metrics),
+    url(r'^population_total', population_total),
+    url(r'^population_tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.(?:mvt|pbf)$',
+        population_tile),
 )
@@ -16,23 +16,131 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/agpl.html>.
 
+import collections
+import heapq
+import itertools
+import math
+import Queue
+import re
+import sys
+import threading
+import time
+import uuid
+
+from django.conf import settings
 from django.db import connections
 from django.http import HttpResponse
+from django.utils import simplejson
+
+from exposure import metrics
 
 SIGN_IN_REQUIRED = ('You must be signed into the OpenQuake Platform to use '
                     'this feature.')
 
+#: Number of rows fetched per round trip from the server-side cursors used to
+#: stream export query results. Larger values mean fewer round trips to the
+#: GED database, at the expense of holding more rows in the web worker.
+EXPORT_FETCH_SIZE = getattr(settings, 'EXPOSURE_EXPORT_FETCH_SIZE', 2000)
+
+#: Minimum size (in bytes) of the chunks handed to the WSGI server when
+#: streaming an export. See :func:`coalesce`.
+EXPORT_CHUNK_SIZE = getattr(settings, 'EXPOSURE_EXPORT_CHUNK_SIZE', 64 * 1024)
+
+#: Number of `geddb` connections used to run each export query in parallel,
+#: one per sub-box of the bounding box (see :func:`get_exposure`). 1 runs a
+#: single query.
+EXPORT_QUERY_WORKERS = getattr(settings, 'EXPOSURE_EXPORT_QUERY_WORKERS', 1)
+#: Bounding boxes smaller than this (in square degrees) are queried in one
+#: go, since splitting them isn't worth the extra connections.
+PARALLEL_QUERY_MIN_AREA_SQ_DEG = getattr(
+    settings, 'EXPOSURE_PARALLEL_QUERY_MIN_AREA_SQ_DEG', 1
+)
+
+#: Table holding the admin level availability for each cell of a regular
+#: lon/lat grid. Built by the `build_admin_level_index` management command.
+ADMIN_LEVEL_INDEX_TABLE = 'ged2.exposure_admin_level_cell'
+#: Cell size (in degrees) of the admin level availability index.
+ADMIN_LEVEL_CELL_SIZE = 0.1
+#: Number of bounding boxes for which the available admin levels are
+#: remembered in each process.
+ADMIN_LEVEL_CACHE_SIZE = getattr(settings, 'EXPOSURE_ADMIN_LEVEL_CACHE_SIZE',
+                                 1024)
+
+#: Table holding the number of exported rows per cell of a regular lon/lat
+#: grid, for each type of export. Built by the `build_exposure_cell_counts`
+#: management command, and used to estimate the size of exports.
+CELL_COUNT_TABLE = 'ged2.exposure_cell_count'
+#: Cell size (in degrees) of the cell count table.
+CELL_COUNT_CELL_SIZE = 0.1
+
+#: Table holding the population of the grid points, summed over the cells
+#: of regular lon/lat grids of decreasing cell sizes. Built by the
+#: `build_population_pyramid` management command, and used to compute
+#: population totals (see :func:`population_total`).
+POPULATION_PYRAMID_TABLE = 'ged2.exposure_population_pyramid'
+#: Cell sizes (in degrees) of the levels of the population pyramid, from the
+#: coarsest to the finest. The grid points themselves are the last level.
+POPULATION_PYRAMID_CELL_SIZES = (1.0, 0.25, 0.05)
+
+#: Table mapping each GADM region (country or admin level 1 to 3 region) to
+#: its grid points. Built by the `build_exposure_region_index` management
+#: command, and used to export the exposure of a region.
+REGION_INDEX_TABLE = 'ged2.exposure_region_grid_point'
+#: Column of `ged2.grid_point` holding the region id of each admin level.
+REGION_COLUMN_MAP = {
+    'admin0': 'gadm_country_id',
+    'admin1': 'gadm_admin_1_id',
+    'admin2': 'gadm_admin_2_id',
+    'admin3': 'gadm_admin_3_id',
+}
+
+
+class LRUCache(object):
+    """
+    A small, thread-safe, in-process mapping which holds at most `max_size`
+    items, discarding the least recently used ones first.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            # re-insert, to mark the item as the most recently used
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
 
 class allowed_methods(object):
     def __init__(self, methods):
         self.methods = methods
 
     def __call__(self, func):
-        def wrapped(request):
+        def wrapped(request, *args, **kwargs):
             if not request.method in self.methods:
                 return HttpResponse(status=405)
             else:
-                return func(request)
+                return func(request, *args, **kwargs)
         return wrapped
 
 
@@ -51,16 +159,109 @@ def sign_in_required(func):
     In this way, the wrapped view can be used a bit more generically by any
     client (and not just a Django application).
     """
-    def wrapped(request):
+    def wrapped(request, *args, **kwargs):
         if not request.user.is_authenticated():
             return HttpResponse(content=SIGN_IN_REQUIRED,
                                 content_type="text/plain",
                                 status=401)
         else:
-            return func(request)
+            return func(request, *args, **kwargs)
     return wrapped
 
 
+class ExportRequest(object):
+    """
+    Stand-in for the :class:`django.http.HttpRequest` expected by the export
+    generators, to run an export outside of a view (as a background job, or
+    to build a bundle): they only need the request parameters.
+
+    :param params:
+        The parameters of the export, as a `dict`.
+    """
+
+    def __init__(self, params):
+        self.GET = params
+
+
+def coalesce(iterable, chunk_size=None):
+    """
+    Join the strings produced by ``iterable`` into larger chunks.
+
+    The export generators yield one small string per row. Passed straight to
+    the :class:`~django.http.HttpResponse`, that means one write (and flush)
+    per row on the WSGI server side. This generator buffers the strings and
+    yields them in chunks of at least ``chunk_size`` bytes instead (except for
+    the last one, which holds whatever is left).
+
+    :param iterable:
+        An iterable of strings.
+    :param int chunk_size:
+        Defaults to :data:`EXPORT_CHUNK_SIZE`.
+    """
+    if chunk_size is None:
+        chunk_size = EXPORT_CHUNK_SIZE
+
+    buf = []
+    buf_len = 0
+    for text in iterable:
+        buf.append(text)
+        buf_len += len(text)
+        if buf_len >= chunk_size:
+            yield ''.join(buf)
+            buf = []
+            buf_len = 0
+    if buf:
+        yield ''.join(buf)
+
+
+def batches(iterable, size):
+    """
+    Split ``iterable`` into lists of ``size`` items (except for the last one,
+    which holds whatever is left).
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def number_format(decimals):
+    """
+    :param decimals:
+        A number of decimals, or `None`.
+    :returns:
+        The %-format of a number with that many decimals, or of the `str` of
+        the number if `decimals` is `None`.
+    """
+    if decimals is None:
+        return '%s'
+    return '%%.%df' % decimals
+
+
+def format_numbers(values, decimals):
+    """
+    Format a batch of numbers (see :func:`number_format`) with a single
+    %-operation, which is faster than formatting them one at a time.
+
+    Only the NRML admin level 0 blocks use it (see
+    :func:`exposure.views._bldg_nrml_admin0_block`), for the populations
+    computed with NumPy. The CSV exports format each row with a single
+    %-template instead: splitting their rows into columns to format them
+    with this function is slower than the row templates.
+
+    :returns:
+        The list of the formatted numbers.
+    """
+    if decimals is None:
+        return map(str, values)
+    if not values:
+        return []
+    text = (number_format(decimals) + '\n') * len(values) % tuple(values)
+    return text.split('\n')[:-1]
+
+
 #: Convert a Python list (containing numbers, such as record IDs as integers)
 #: to the format required for a SQL query.
 num_list_to_sql_array = lambda a_list: (
@@ -68,16 +269,103 @@ num_list_to_sql_array = lambda a_list: (
 )
 
 
+#: Join the geographic region of each admin level (`gr0` to `gr3`) to the
+#: grid points of a query on `ged2.grid_point AS grid`. Data is available at
+#: a given admin level for a grid point if the matching region id is not NULL.
+ADMIN_LEVEL_AVAILABILITY_JOINS = """\
+      LEFT JOIN ged2.geographic_region gr0
+        ON gr0.gadm_country_id=grid.gadm_country_id
+      LEFT JOIN ged2.geographic_region gr1
+        ON gr1.gadm_admin_1_id=grid.gadm_admin_1_id
+      LEFT JOIN ged2.geographic_region gr2
+        ON gr2.gadm_admin_2_id=grid.gadm_admin_2_id
+      LEFT JOIN ged2.geographic_region gr3
+        ON gr3.gadm_admin_3_id=grid.gadm_admin_3_id
+"""
+
+_ADMIN_LEVEL_CACHE = LRUCache(ADMIN_LEVEL_CACHE_SIZE)
+#: Tables found by :func:`_table_exists`.
+_tables_found = set()
+
+
+def _snap_to_cells(lng1, lat1, lng2, lat2, cell_size):
+    """
+    Snap a bounding box outwards to the cells of a regular grid of
+    `cell_size` degrees.
+
+    :returns:
+        A tuple of the (x1, y1, x2, y2) integer indices of the lower left and
+        upper right cells covered by the bounding box.
+    """
+    lng1, lat1, lng2, lat2 = [float(x) for x in (lng1, lat1, lng2, lat2)]
+    return (int(math.floor(min(lng1, lng2) / cell_size)),
+            int(math.floor(min(lat1, lat2) / cell_size)),
+            int(math.floor(max(lng1, lng2) / cell_size)),
+            int(math.floor(max(lat1, lat2) / cell_size)))
+
+
+def _table_exists(table):
+    """
+    Check if one of the tables built by the exposure management commands
+    exists in the GED database. Once a table has been found, it is assumed
+    to stay there.
+
+    :param str table:
+        Schema-qualified table name.
+    """
+    if table not in _tables_found:
+        schema, table_name = table.split('.')
+        cursor = connections['geddb'].cursor()
+        cursor.execute(
+            'SELECT 1 FROM pg_tables WHERE schemaname = %s AND tablename = %s',
+            [schema, table_name]
+        )
+        if cursor.fetchall():
+            _tables_found.add(table)
+    return table in _tables_found
+
+
+def _admin_level_index_exists():
+    """
+    Check if the admin level index table has been built.
+    """
+    return _table_exists(ADMIN_LEVEL_INDEX_TABLE)
+
+
 def _get_available_admin_levels(lng1, lat1, lng2, lat2):
     """
     Given a geographical bounding box, get the admin levels for which there is
     grid data.
 
+    If the admin level index has been built (see
+    :func:`_build_admin_level_index`), the bounding box is snapped to the
+    index cells and the answer is looked up there, and remembered for the
+    next requests covering the same cells. Otherwise, the availability is
+    computed from the grid points.
+
     :returns:
         A list containing any or none of the following values: [0, 1, 2, 3],
         representing admin 0 (national) and admin 1, 2, and 3 (sub-national),
         respectively.
     """
+    if not _admin_level_index_exists():
+        return _query_available_admin_levels(lng1, lat1, lng2, lat2)
+
+    cells = _snap_to_cells(lng1, lat1, lng2, lat2, ADMIN_LEVEL_CELL_SIZE)
+    admin_levels = _ADMIN_LEVEL_CACHE.get(cells)
+    if admin_levels is None:
+        admin_levels = _query_admin_level_index(*cells)
+        _ADMIN_LEVEL_CACHE.set(cells, admin_levels)
+    return list(admin_levels)
+
+
+def _query_available_admin_levels(lng1, lat1, lng2, lat2):
+    """
+    Compute the available admin levels for a bounding box from the grid
+    points it contains.
+
+    See :func:`_get_available_admin_levels`.
+    """
     query = """
 SELECT BOOL_AND(a0) as has_a0,
        BOOL_AND(a1) AS has_a1,
@@ -89,18 +377,11 @@ FROM (
            gr2.id IS NOT NULL AS a2,
            gr3.id IS NOT NULL AS a3
       FROM ged2.grid_point grid
-      LEFT JOIN ged2.geographic_region gr0
-        ON gr0.gadm_country_id=grid.gadm_country_id
-      LEFT JOIN ged2.geographic_region gr1
-        ON gr1.gadm_admin_1_id=grid.gadm_admin_1_id
-      LEFT JOIN ged2.geographic_region gr2
-        ON gr2.gadm_admin_2_id=grid.gadm_admin_2_id
-      LEFT JOIN ged2.geographic_region gr3
-        ON gr3.gadm_admin_3_id=grid.gadm_admin_3_id
+%(joins)s
      WHERE grid.the_geom && ST_MakeEnvelope
-        (%s, %s, %s, %s, 4326)
+        (%%s, %%s, %%s, %%s, 4326)
 ) inner_query
-"""
+""" % dict(joins=ADMIN_LEVEL_AVAILABILITY_JOINS)
     cursor = connections['geddb'].cursor()
     cursor.execute(query, [lng1, lat1, lng2, lat2])
 
@@ -109,35 +390,307 @@ FROM (
     return admin_levels
 
 
-def _get_national_exposure(lng1, lat1, lng2, lat2, tod, occupancy):
+def _query_admin_level_index(x1, y1, x2, y2):
     """
-    :param lng1, lat1, lng2, lat2:
-        Lat/lon of the selected bounding box.
-    :param tod_select:
-        'day', 'night', 'transit', 'all', or 'off'
-    :param occupancy:
-        List. [0], [1], or [0, 1]. 0 represents residential, 1 represents
-        non-residential.
+    Look up the available admin levels for a range of cells in the admin
+    level index.
+
+    :param x1, y1, x2, y2:
+        Indices of the lower left and upper right cells (inclusive), as
+        returned by :func:`_snap_to_cells`.
+    :returns:
+        A tuple of the available admin levels. See
+        :func:`_get_available_admin_levels`.
     """
-    tod_map = {
-        'day': 'pop_alloc.day_pop_ratio',
-        'night': 'pop_alloc.night_pop_ratio',
-        'transit': 'pop_alloc.transit_pop_ratio',
-    }
     query = """\
-SELECT
-    grid_point.id,
-    ST_X(grid_point.the_geom) AS lon,
-    ST_Y(grid_point.the_geom) AS lat,
-    grid_point.pop_value,
-    grid_point.gadm_country_id,
-    gadm_country.iso,
-    dist_group.study_region_id,
-    dist_value.building_type,
-    dist_value.dwelling_fraction,
-    %(day)s as day_pop_ratio,
-    %(night)s as night_pop_ratio,
-    %(transit)s as transit_pop_ratio
+SELECT BOOL_AND(has_a0), BOOL_AND(has_a1), BOOL_AND(has_a2), BOOL_AND(has_a3)
+FROM %s
+WHERE cell_x BETWEEN %%s AND %%s
+  AND cell_y BETWEEN %%s AND %%s
+""" % ADMIN_LEVEL_INDEX_TABLE
+    cursor = connections['geddb'].cursor()
+    cursor.execute(query, [x1, x2, y1, y2])
+
+    [admin_level_bools] = cursor.fetchall()
+    return tuple(i for i, b in enumerate(admin_level_bools) if b)
+
+
+def _build_admin_level_index():
+    """
+    (Re)build the admin level index table from the GED grid points.
+
+    For each cell of :data:`ADMIN_LEVEL_CELL_SIZE` degrees containing grid
+    points, the index records if admin level 0, 1, 2 and 3 data is available
+    for all of those points. The new table is built next to the old one and
+    swapped in at the end, so the index stays usable while it is rebuilt.
+
+    Must be run again whenever the GED grid data is reloaded.
+    """
+    table = ADMIN_LEVEL_INDEX_TABLE
+    new_table = '%s_new' % table
+    query = """\
+DROP TABLE IF EXISTS %(new_table)s;
+CREATE TABLE %(new_table)s AS
+SELECT floor(ST_X(grid.the_geom) / %(cell_size)s)::integer AS cell_x,
+       floor(ST_Y(grid.the_geom) / %(cell_size)s)::integer AS cell_y,
+       BOOL_AND(gr0.id IS NOT NULL) AS has_a0,
+       BOOL_AND(gr1.id IS NOT NULL) AS has_a1,
+       BOOL_AND(gr2.id IS NOT NULL) AS has_a2,
+       BOOL_AND(gr3.id IS NOT NULL) AS has_a3
+  FROM ged2.grid_point grid
+%(joins)s
+ GROUP BY 1, 2;
+ALTER TABLE %(new_table)s ADD PRIMARY KEY (cell_x, cell_y);
+DROP TABLE IF EXISTS %(table)s;
+ALTER TABLE %(new_table)s RENAME TO %(table_name)s;
+"""
+    query %= dict(table=table, new_table=new_table,
+                  table_name=table.split('.')[1],
+                  cell_size=ADMIN_LEVEL_CELL_SIZE,
+                  joins=ADMIN_LEVEL_AVAILABILITY_JOINS)
+    cursor = connections['geddb'].cursor()
+    cursor.execute(query)
+    _ADMIN_LEVEL_CACHE.clear()
+
+
+def _stream_query(query, args, fetch_size=None):
+    """
+    Execute a query against the GED database using a named (server-side)
+    cursor and yield the resulting rows one by one.
+
+    Rows are pulled from the database in batches of ``fetch_size``, so only
+    one batch at a time is held in memory, no matter how many rows the query
+    returns.
+
+    :param str query:
+        SQL query. Must be a single ``SELECT`` statement (no trailing
+        semicolon), since it is wrapped in a ``DECLARE ... CURSOR``.
+    :param list args:
+        Query parameters.
+    :param int fetch_size:
+        Number of rows to fetch per round trip. Defaults to
+        :data:`EXPORT_FETCH_SIZE`.
+    :raises exposure.metrics.ExportCancelled:
+        If the export running in this thread is cancelled (see
+        :meth:`exposure.metrics.ExportRecord.cancel`). The connection is
+        then closed.
+    """
+    if fetch_size is None:
+        fetch_size = EXPORT_FETCH_SIZE
+
+    # Database timings and running queries of the export running in this
+    # thread, if any.
+    record = metrics.current()
+
+    conn = connections['geddb']
+    # Django connects lazily; make sure the underlying psycopg2 connection
+    # exists before asking it for a named cursor.
+    conn.cursor()
+    pg_conn = conn.connection
+    cursor = pg_conn.cursor(name='exposure_%s' % uuid.uuid4().hex)
+    if record is not None:
+        # The query can be cancelled from now on.
+        try:
+            record.query_started(pg_conn)
+        except metrics.ExportCancelled:
+            cursor.close()
+            raise
+    try:
+        start = time.time()
+        cursor.execute(query, args)
+        if record is not None:
+            record.add_db_time('plan', time.time() - start)
+        while True:
+            if record is not None and record.cancelled:
+                raise metrics.ExportCancelled()
+            start = time.time()
+            rows = cursor.fetchmany(fetch_size)
+            if record is not None:
+                record.add_db_time('fetch', time.time() - start, len(rows))
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    except Exception:
+        if record is not None and record.cancelled:
+            # psycopg2 raises QueryCanceledError.
+            raise metrics.ExportCancelled()
+        raise
+    finally:
+        if record is not None:
+            record.query_done(pg_conn)
+        if record is not None and record.cancelled:
+            # The transaction of a cancelled query is aborted: release the
+            # connection (and its cursor) right away. Django reconnects on
+            # the next query.
+            conn.close()
+        else:
+            cursor.close()
+
+
+def get_exposure(query_func, lng1, lat1, lng2, lat2, *args, **kwargs):
+    """
+    Run an export query, in parallel on sub-boxes of the bounding box if it
+    is large enough (see :data:`EXPORT_QUERY_WORKERS`).
+
+    The bounding box is split into vertical strips, each queried in its own
+    thread, on its own `geddb` connection. The rows of the strips are merged
+    back in grid point id order, so the result is the same as the one of a
+    single query.
+
+    :param query_func:
+        The export query function, for example
+        :func:`_get_national_exposure`. Its first four arguments must be the
+        bounding box, and the rows it returns must be ordered by grid point
+        id, with the id and longitude as the first two columns.
+    :param lng1, lat1, lng2, lat2:
+        The bounding box.
+    :param args:
+        The other arguments of `query_func`.
+    :param int workers:
+        Number of sub-boxes (and connections) to use. Defaults to
+        :data:`EXPORT_QUERY_WORKERS`.
+    :returns:
+        An iterator over the result rows.
+    """
+    workers = kwargs.get('workers') or EXPORT_QUERY_WORKERS
+    area = abs(float(lng2) - float(lng1)) * abs(float(lat2) - float(lat1))
+    if workers <= 1 or area < PARALLEL_QUERY_MIN_AREA_SQ_DEG:
+        return query_func(lng1, lat1, lng2, lat2, *args)
+    return _parallel_query(query_func, lng1, lat1, lng2, lat2, args, workers)
+
+
+class _QueryError(object):
+    """
+    Wraps the exception raised in a query thread, to raise it again in the
+    merging thread.
+    """
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+#: Marks the end of the rows of a query thread.
+_QUERY_DONE = object()
+
+
+def _parallel_query(query_func, lng1, lat1, lng2, lat2, args, workers):
+    lng1, lat1, lng2, lat2 = [float(x) for x in (lng1, lat1, lng2, lat2)]
+    lng1, lng2 = min(lng1, lng2), max(lng1, lng2)
+    width = (lng2 - lng1) / workers
+    edges = [lng1 + i * width for i in range(workers)] + [lng2]
+
+    queries = []
+    for i in range(workers):
+        # Each strip includes its west edge; the east edge belongs to the
+        # next strip, except for the last one, so that no row is returned
+        # twice. The query itself includes both edges.
+        if i == workers - 1:
+            keep = None
+        else:
+            keep = (lambda east: lambda row: row[1] < east)(edges[i + 1])
+        queries.append((query_func, (edges[i], lat1, edges[i + 1], lat2)
+                        + args, keep))
+
+    strips, stop = _query_threads(queries)
+    try:
+        streams = [((row[0], i, row) for row in strip)
+                   for i, strip in enumerate(strips)]
+        for _, _, row in heapq.merge(*streams):
+            yield row
+    finally:
+        # Let the query threads finish, also if the export is abandoned.
+        stop.set()
+
+
+def _query_threads(queries):
+    """
+    Run export queries, each in its own thread (and database connection).
+
+    :param queries:
+        A list of (query function, arguments, keep) triples. The rows of
+        `query_func(*args)` for which `keep(row)` is true (all of them if
+        `keep` is `None`) are returned.
+    :returns:
+        A pair of the list of the iterators over the rows of each query,
+        and an event to set to stop the threads, once the rows are not read
+        anymore.
+    """
+    # Database timings are added to the record of the export from the query
+    # threads.
+    record = metrics.current()
+    stop = threading.Event()
+    queues = []
+    for query_func, query_args, keep in queries:
+        # Bound the queues, so that fast queries can't run ahead of the
+        # merge and buffer a whole export in memory.
+        queue = Queue.Queue(maxsize=2)
+        thread = threading.Thread(
+            target=_query_strip,
+            args=(query_func, query_args, keep, queue, stop, record),
+        )
+        thread.daemon = True
+        thread.start()
+        queues.append(queue)
+    return [_read_strip(queue) for queue in queues], stop
+
+
+def _query_strip(query_func, query_args, keep, queue, stop, record):
+    """
+    Run an export query on a strip of the bounding box, putting the rows in
+    `queue` in batches.
+    """
+    metrics.activate(record)
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    rows = None
+    try:
+        batch = []
+        rows = query_func(*query_args)
+        for row in rows:
+            if keep is None or keep(row):
+                batch.append(row)
+            if len(batch) >= EXPORT_FETCH_SIZE:
+                if not put(batch):
+                    return
+                batch = []
+        if batch and not put(batch):
+            return
+        put(_QUERY_DONE)
+    except Exception:
+        put(_QueryError(sys.exc_info()))
+    finally:
+        # Stop the query (closing its cursor) before closing the connection
+        # it runs on: it is left open when the rows are not read anymore.
+        close = getattr(rows, 'close', None)
+        if close is not None:
+            close()
+        # Each thread has its own database connection.
+        connections['geddb'].close()
+
+
+def _read_strip(queue):
+    while True:
+        item = queue.get()
+        if item is _QUERY_DONE:
+            return
+        if isinstance(item, _QueryError):
+            raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+        for row in item:
+            yield row
+
+
+#: Joins resolving the population allocation and building distribution of
+#: each grid point at the national level (admin 0).
+NATIONAL_JOINS = """\
 FROM ged2.grid_point AS grid_point
 
 JOIN ged2.gadm_country AS gadm_country
@@ -152,64 +705,15 @@ JOIN ged2.distribution_group AS dist_group
     ON dist_group.study_region_id = study_region.id
 JOIN ged2.distribution_value AS dist_value
     ON dist_value.distribution_group_id = dist_group.id
-
-WHERE
+"""
+NATIONAL_CONDITIONS = """\
     grid_point.pop_value > 0
-    AND ST_intersects(ST_MakeEnvelope(%%s, %%s, %%s, %%s, 4326),
-                      grid_point.the_geom)
     AND grid_point.is_urban = pop_alloc.is_urban
-    AND grid_point.is_urban = dist_group.is_urban
-    AND dist_group.occupancy_id IN %(occ)s
-    AND pop_alloc.occupancy_id IN %(occ)s
-ORDER BY grid_point.id
-"""
-    args = dict(day='NULL', night='NULL', transit='NULL',
-                occ=num_list_to_sql_array(occupancy))
-    if tod == 'day':
-        args['day'] = tod_map['day']
-    elif tod == 'night':
-        args['night'] = tod_map['night']
-    elif tod == 'transit':
-        args['transit'] = tod_map['transit']
-    elif tod == 'all':
-        args['day'] = tod_map['day']
-        args['night'] = tod_map['night']
-        args['transit'] = tod_map['transit']
-
-    query %= args
-    cursor = connections['geddb'].cursor()
-    cursor.execute(query, [lng1, lat1, lng2, lat2])
-
-    return cursor.fetchall()
-
-
-def _get_subnational_exposure(lng1, lat1, lng2, lat2, occupancy, admin_level):
-    """
-    :param lng1, lat1, lng2, lat2:
-        Lat/lon of the selected bounding box.
-    :param occupancy:
-        List. [0], [1], or [0, 1]. 0 represents residential, 1 represents
-        non-residential.
-    :param admin_level:
-        'admin1', 'admin2', or 'admin3'
-    """
-    admin_level_column_map = {
-        'admin1': 'gadm_admin_1_id',
-        'admin2': 'gadm_admin_2_id',
-        'admin3': 'gadm_admin_3_id',
-    }
+    AND grid_point.is_urban = dist_group.is_urban"""
 
-    query = """\
-SELECT
-    grid_point.id,
-    ST_X(grid_point.the_geom) AS lon,
-    ST_Y(grid_point.the_geom) AS lat,
-    grid_point.pop_value,
-    grid_point.%(admin_level_id)s,
-    gadm_country.iso,
-    dist_group.study_region_id,
-    dist_value.building_type,
-    dist_value.dwelling_fraction
+#: Same as `NATIONAL_JOINS`, at a sub-national level. `admin_level_id` is the
+#: `grid_point` column of the admin level.
+SUBNATIONAL_JOINS = """\
 FROM ged2.grid_point AS grid_point
 
 JOIN ged2.gadm_country AS gadm_country
@@ -222,49 +726,1502 @@ JOIN ged2.distribution_group AS dist_group
     ON dist_group.study_region_id = study_region.id
 JOIN ged2.distribution_value AS dist_value
     ON dist_value.distribution_group_id = dist_group.id
-
-WHERE
-    grid_point.pop_value > 0
-    AND ST_intersects(ST_MakeEnvelope(%%s, %%s, %%s, %%s, 4326),
-                      grid_point.the_geom)
-    AND grid_point.is_urban = dist_group.is_urban
-    AND dist_group.occupancy_id IN %(occ)s
-ORDER BY grid_point.id
 """
-    query %= dict(admin_level_id=admin_level_column_map.get(admin_level),
-                  occ=num_list_to_sql_array(occupancy))
-    cursor = connections['geddb'].cursor()
-    cursor.execute(query, [lng1, lat1, lng2, lat2])
+SUBNATIONAL_CONDITIONS = """\
+    grid_point.pop_value > 0
+    AND grid_point.is_urban = dist_group.is_urban"""
 
-    return cursor.fetchall()
+ADMIN_LEVEL_COLUMN_MAP = {
+    'admin1': 'gadm_admin_1_id',
+    'admin2': 'gadm_admin_2_id',
+    'admin3': 'gadm_admin_3_id',
+}
 
+#: Denormalized exposure tables, by admin level, with the joins of
+#: `NATIONAL_JOINS` or `SUBNATIONAL_JOINS` already resolved. Built by the
+#: `build_exposure_facts` management command. When present, the building
+#: exposure exports read from these instead of joining the GED tables.
+EXPOSURE_FACT_TABLES = {
+    'admin0': 'ged2.exposure_fact_admin0',
+    'admin1': 'ged2.exposure_fact_admin1',
+    'admin2': 'ged2.exposure_fact_admin2',
+    'admin3': 'ged2.exposure_fact_admin3',
+}
 
-def _get_population_exposure(lng1, lat1, lng2, lat2):
+
+#: Number of vertices above which a polygon is refused, to bound the cost of
+#: the intersection tests.
+MAX_POLYGON_VERTICES = getattr(settings, 'EXPOSURE_MAX_POLYGON_VERTICES',
+                               10000)
+#: Maximum number of areas of a batch export. Each area is a bit of the
+#: `areas` column of the batch export queries, which is a 64-bit integer.
+MAX_BATCH_AREAS = min(getattr(settings, 'EXPOSURE_MAX_BATCH_AREAS', 20), 62)
+
+_WKT_POLYGON_RE = re.compile(r'^\s*(MULTI)?POLYGON\s*\(', re.IGNORECASE)
+_WKT_SEPARATORS_RE = re.compile(r'[(),]')
+
+
+def parse_polygon(text):
     """
-    Get population-only exposure data (no building/taxonomy information).
+    Parse the polygon of a polygon export.
 
-    :param lng1, lat1, lng2, lat2:
-        Bounding box coordinates.
+    :param str text:
+        A WKT `POLYGON` or `MULTIPOLYGON`, or a GeoJSON `Polygon` or
+        `MultiPolygon` geometry (or a `Feature` holding one), in WGS84
+        lon/lat.
+    :returns:
+        The area to pass to the export queries (see :func:`_spatial_filter`
+        and :func:`area_extent`).
+    :raises ValueError:
+        If `text` isn't a valid polygon.
     """
-    query = """\
-SELECT
-    grid_point.id,
-    ST_X(grid_point.the_geom) AS lon,
-    ST_Y(grid_point.the_geom) AS lat,
-    grid_point.pop_value,
-    gadm_country.iso
-FROM ged2.grid_point AS grid_point
+    text = text.strip()
+    if text.startswith('{'):
+        try:
+            geometry = simplejson.loads(text)
+        except ValueError:
+            raise ValueError('Invalid GeoJSON polygon')
+        if isinstance(geometry, dict) and geometry.get('type') == 'Feature':
+            geometry = geometry.get('geometry')
+        if (not isinstance(geometry, dict)
+                or geometry.get('type') not in ('Polygon', 'MultiPolygon')):
+            raise ValueError('The GeoJSON geometry must be a Polygon or a '
+                             'MultiPolygon')
+        try:
+            coords = list(_flatten_coordinates(geometry['coordinates']))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Invalid GeoJSON polygon')
+        kind, text = 'geojson', simplejson.dumps(geometry)
+    else:
+        match = _WKT_POLYGON_RE.match(text)
+        if match is None:
+            raise ValueError('The WKT geometry must be a POLYGON or a '
+                             'MULTIPOLYGON')
+        coords = []
+        for position in _WKT_SEPARATORS_RE.split(text[match.end():]):
+            position = position.split()
+            if not position:
+                continue
+            if len(position) != 2:
+                raise ValueError('Only 2D WKT polygons are supported')
+            coords.append((float(position[0]), float(position[1])))
+        kind = 'wkt'
 
-JOIN ged2.gadm_country AS gadm_country
-    ON grid_point.gadm_country_id = gadm_country.id
+    # A ring has at least 4 points, the first one repeated at the end.
+    if len(coords) < 4:
+        raise ValueError('A polygon needs at least 4 points')
+    if len(coords) > MAX_POLYGON_VERTICES:
+        raise ValueError('Polygons may have at most %s points'
+                         % MAX_POLYGON_VERTICES)
+    lngs = [c[0] for c in coords]
+    lats = [c[1] for c in coords]
+    if (min(lngs) < -180 or max(lngs) > 180
+            or min(lats) < -90 or max(lats) > 90):
+        raise ValueError('Polygon coordinates must be WGS84 lon/lat')
+    return (kind, text, (min(lngs), min(lats), max(lngs), max(lats)))
+
+
+def _flatten_coordinates(coordinates):
+    """
+    Yield the (lon, lat) positions of nested GeoJSON coordinates.
+    """
+    if coordinates and isinstance(coordinates[0], (int, long, float)):
+        if len(coordinates) < 2:
+            raise ValueError('Invalid position')
+        yield float(coordinates[0]), float(coordinates[1])
+    else:
+        for item in coordinates:
+            for position in _flatten_coordinates(item):
+                yield position
+
+
+def region_area(admin_level, region_id):
+    """
+    :param str admin_level:
+        'admin0' (`region_id` is a GADM country id), or 'admin1' to 'admin3'.
+    :param region_id:
+        The GADM id of the region.
+    :returns:
+        The area to pass to the export queries to export a region (see
+        :func:`_spatial_filter` and :func:`area_extent`).
+    :raises ValueError:
+        If the admin level or the region id isn't valid.
+    """
+    if admin_level not in REGION_COLUMN_MAP:
+        raise ValueError('Invalid region admin level')
+    try:
+        region_id = int(region_id)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid region id')
+    return ('region', admin_level, region_id)
 
-WHERE
-    grid_point.pop_value > 0
-    AND ST_intersects(ST_MakeEnvelope(%s, %s, %s, %s, 4326),
-                      grid_point.the_geom)
-ORDER BY grid_point.id;
-"""
-    cursor = connections['geddb'].cursor()
-    cursor.execute(query, [lng1, lat1, lng2, lat2])
 
+def bbox_area(lng1, lat1, lng2, lat2):
+    """
+    :returns:
+        The area to pass to the export queries to export a bounding box, as
+        part of a batch (see :func:`batch_area`).
+    :raises ValueError:
+        If the coordinates are not valid.
+    """
+    try:
+        lng1, lat1, lng2, lat2 = [float(x) for x in (lng1, lat1, lng2, lat2)]
+    except (TypeError, ValueError):
+        raise ValueError('Invalid bounding box')
+    lng1, lng2 = sorted([lng1, lng2])
+    lat1, lat2 = sorted([lat1, lat2])
+    if lng1 < -180 or lng2 > 180 or lat1 < -90 or lat2 > 90:
+        raise ValueError('Bounding box coordinates must be WGS84 lon/lat')
+    return ('bbox', None, (lng1, lat1, lng2, lat2))
+
+
+def batch_area(areas):
+    """
+    :param areas:
+        A list of bounding boxes and polygons, as returned by
+        :func:`bbox_area` and :func:`parse_polygon`.
+    :returns:
+        The area to pass to the export queries to export all of the `areas`
+        at once. Each grid point is read once, with the set of areas it
+        belongs to (see :func:`_area_members`).
+    :raises ValueError:
+        If there are no areas, or too many.
+    """
+    if not areas:
+        raise ValueError('No export area given')
+    if len(areas) > MAX_BATCH_AREAS:
+        raise ValueError('Batches may have at most %s areas'
+                         % MAX_BATCH_AREAS)
+    extents = [area[2] for area in areas]
+    return ('batch', tuple(areas), (min(e[0] for e in extents),
+                                    min(e[1] for e in extents),
+                                    max(e[2] for e in extents),
+                                    max(e[3] for e in extents)))
+
+
+def _get_countries(isos=None):
+    """
+    :param isos:
+        Optional list of ISO country codes. By default, all countries.
+    :returns:
+        A list of the (GADM id, ISO code) of the countries, in ISO code
+        order.
+    """
+    query = 'SELECT id, iso FROM ged2.gadm_country'
+    args = []
+    if isos:
+        query += ' WHERE iso IN %s'
+        args.append(tuple(isos))
+    query += ' ORDER BY iso'
+    cursor = connections['geddb'].cursor()
+    cursor.execute(query, args)
+    return cursor.fetchall()
+
+
+def _spatial_filter(id_column, geom_column, lng1, lat1, lng2, lat2,
+                    area=None):
+    """
+    Build the spatial condition of an export query.
+
+    Polygons are passed as a single query parameter, so the geometry is the
+    same constant for each row: PostGIS prepares it once (building its edge
+    index) and reuses it for all of the intersection tests. Regions are
+    looked up in the region index (see :data:`REGION_INDEX_TABLE`), or
+    directly in the grid points if the index hasn't been built.
+
+    :param str id_column, geom_column:
+        The grid point id and geometry columns of the query.
+    :param lng1, lat1, lng2, lat2:
+        The bounding box to export, when `area` is `None`.
+    :param area:
+        `None`, a polygon returned by :func:`parse_polygon`, or a region
+        returned by :func:`region_area`.
+    :returns:
+        A pair of the SQL condition (with `%s` placeholders) and its query
+        arguments.
+    """
+    if area is None:
+        return ('ST_intersects(ST_MakeEnvelope(%%s, %%s, %%s, %%s, 4326), %s)'
+                % geom_column, [lng1, lat1, lng2, lat2])
+
+    kind = area[0]
+    if kind == 'wkt':
+        return ('ST_Intersects(ST_GeomFromText(%%s, 4326), %s)'
+                % geom_column, [area[1]])
+    elif kind == 'geojson':
+        return ('ST_Intersects(ST_SetSRID(ST_GeomFromGeoJSON(%%s), 4326), %s)'
+                % geom_column, [area[1]])
+    elif kind == 'bbox':
+        return _spatial_filter(id_column, geom_column, *area[2])
+    elif kind == 'batch':
+        filters, args = [], []
+        for member in area[1]:
+            member_filter, member_args = _spatial_filter(
+                id_column, geom_column, None, None, None, None, member
+            )
+            filters.append(member_filter)
+            args.extend(member_args)
+        return '(%s)' % '\n        OR '.join(filters), args
+    elif kind == 'region':
+        _, admin_level, region_id = area
+        if _table_exists(REGION_INDEX_TABLE):
+            return ("""%s IN (
+        SELECT grid_id FROM %s
+        WHERE admin_level = %%s AND region_id = %%s)"""
+                    % (id_column, REGION_INDEX_TABLE),
+                    [admin_level, region_id])
+        return ("""%s IN (
+        SELECT id FROM ged2.grid_point WHERE %s = %%s)"""
+                % (id_column, REGION_COLUMN_MAP[admin_level]), [region_id])
+    raise ValueError('Unknown export area %r' % (kind, ))
+
+
+def _area_members(id_column, geom_column, area):
+    """
+    Build the `areas` column of a batch export query: a bit mask of the
+    areas of the batch (see :func:`batch_area`) each row belongs to, bit `i`
+    being set for the `i`-th area.
+
+    :returns:
+        A pair of the SQL of the column, to add to the ones of the query
+        (with `%s` placeholders), and its query arguments. Both are empty
+        unless `area` is a batch.
+    """
+    if area is None or area[0] != 'batch':
+        return '', []
+    cases, args = [], []
+    for i, member in enumerate(area[1]):
+        member_filter, member_args = _spatial_filter(
+            id_column, geom_column, None, None, None, None, member
+        )
+        cases.append('CASE WHEN %s THEN %d ELSE 0 END'
+                     % (member_filter, 1 << i))
+        args.extend(member_args)
+    return ',\n    (%s) AS areas' % '\n     + '.join(cases), args
+
+
+def area_extent(area):
+    """
+    :param area:
+        A polygon or a region, as returned by :func:`parse_polygon` or
+        :func:`region_area`.
+    :returns:
+        The bounding box (lng1, lat1, lng2, lat2) of the polygon, or of the
+        grid points of the region (`None` if it has none).
+    """
+    if area[0] != 'region':
+        return area[2]
+
+    area_filter, area_args = _spatial_filter('grid_point.id',
+                                             'grid_point.the_geom',
+                                             None, None, None, None, area)
+    query = """\
+SELECT ST_XMin(extent), ST_YMin(extent), ST_XMax(extent), ST_YMax(extent)
+FROM (
+    SELECT ST_Extent(grid_point.the_geom)::geometry AS extent
+    FROM ged2.grid_point AS grid_point
+    WHERE %s
+) AS region
+""" % area_filter
+    cursor = connections['geddb'].cursor()
+    cursor.execute(query, area_args)
+    [extent] = cursor.fetchall()
+    if extent[0] is None:
+        return None
+    return tuple(extent)
+
+
+def _build_region_index():
+    """
+    (Re)build the region index table (see :data:`REGION_INDEX_TABLE`).
+
+    The table holds one (admin level, region id, grid point id) row per grid
+    point and admin level, clustered on its primary key, so that the grid
+    points of a region are read from consecutive index pages. As for the
+    admin level index, the new table is swapped in at the end.
+    """
+    table = REGION_INDEX_TABLE
+    new_table = '%s_new' % table
+    selects = []
+    for admin_level, column in sorted(REGION_COLUMN_MAP.items()):
+        selects.append("""\
+SELECT '%(admin_level)s'::varchar(8) AS admin_level,
+       %(column)s AS region_id,
+       id AS grid_id
+  FROM ged2.grid_point
+ WHERE %(column)s IS NOT NULL""" % dict(admin_level=admin_level,
+                                         column=column))
+
+    query = """\
+DROP TABLE IF EXISTS %(new_table)s;
+CREATE TABLE %(new_table)s AS
+%(selects)s;
+ALTER TABLE %(new_table)s
+    ADD CONSTRAINT %(new_table_name)s_pkey
+    PRIMARY KEY (admin_level, region_id, grid_id);
+CLUSTER %(new_table)s USING %(new_table_name)s_pkey;
+ANALYZE %(new_table)s;
+DROP TABLE IF EXISTS %(table)s;
+ALTER TABLE %(new_table)s RENAME TO %(table_name)s;
+ALTER INDEX %(schema)s.%(new_table_name)s_pkey
+    RENAME TO %(table_name)s_pkey;
+"""
+    query %= dict(table=table, new_table=new_table,
+                  selects='\nUNION ALL\n'.join(selects),
+                  schema=table.split('.')[0],
+                  table_name=table.split('.')[1],
+                  new_table_name=new_table.split('.')[1])
+    cursor = connections['geddb'].cursor()
+    cursor.execute(query)
+
+
+#: Distinct GEM taxonomy strings of the building types, with an index for
+#: prefix lookups. Built by the `build_exposure_taxonomy` management command.
+#: When absent, taxonomy filters are resolved against the distribution
+#: values themselves.
+TAXONOMY_TABLE = 'ged2.exposure_taxonomy'
+#: Maximum number of taxonomy prefixes of a taxonomy filter.
+MAX_TAXONOMY_PREFIXES = 100
+
+_LIKE_SPECIAL_RE = re.compile(r'[\\%_]')
+
+
+def parse_taxonomy(text):
+    """
+    Parse the taxonomy filter of a building export.
+
+    :param str text:
+        A comma separated list of GEM taxonomy strings. Each one selects the
+        building types it is a prefix of: 'MUR' selects all the masonry
+        types, 'CR/LFINF' only the reinforced concrete types with an infilled
+        frame.
+    :returns:
+        The sorted tuple of the distinct prefixes.
+    :raises ValueError:
+        If no prefix, or too many of them, are given.
+    """
+    prefixes = set(p.strip() for p in text.split(','))
+    prefixes.discard('')
+    if not prefixes:
+        raise ValueError('No taxonomy given')
+    if len(prefixes) > MAX_TAXONOMY_PREFIXES:
+        raise ValueError('Too many taxonomies (maximum: %s)'
+                         % MAX_TAXONOMY_PREFIXES)
+    return tuple(sorted(prefixes))
+
+
+def _resolve_taxonomy(prefixes):
+    """
+    :param prefixes:
+        Taxonomy prefixes (see :func:`parse_taxonomy`).
+    :returns:
+        The sorted list of the building types matching any of the prefixes.
+    """
+    if _table_exists(TAXONOMY_TABLE):
+        source = TAXONOMY_TABLE
+    else:
+        source = 'ged2.distribution_value'
+    conditions = ' OR '.join(["building_type LIKE %s ESCAPE '\\'"]
+                             * len(prefixes))
+    # Prefix patterns can use the text_pattern_ops index of the lookup table.
+    patterns = [_LIKE_SPECIAL_RE.sub(r'\\\g<0>', p) + '%' for p in prefixes]
+    cursor = connections['geddb'].cursor()
+    cursor.execute('SELECT DISTINCT building_type FROM %s WHERE %s'
+                   ' ORDER BY 1' % (source, conditions), patterns)
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _taxonomy_filter(column, taxonomy):
+    """
+    :param column:
+        The building type column of an export query.
+    :param taxonomy:
+        Taxonomy prefixes (see :func:`parse_taxonomy`), or `None`.
+    :returns:
+        A pair of the SQL condition (to append to the `WHERE` clause, empty
+        if `taxonomy` is `None`) and its query arguments. The matching
+        building types are resolved first, so that the condition is a plain
+        equality, which PostgreSQL applies to the distribution values before
+        joining them.
+    """
+    if taxonomy is None:
+        return '', []
+    return ('\n    AND %s = ANY(%%s)' % column,
+            [_resolve_taxonomy(taxonomy)])
+
+
+def _build_taxonomy():
+    """
+    (Re)build the taxonomy lookup table (see :data:`TAXONOMY_TABLE`). As for
+    the admin level index, the new table is swapped in at the end.
+    """
+    table = TAXONOMY_TABLE
+    new_table = '%s_new' % table
+    query = """\
+DROP TABLE IF EXISTS %(new_table)s;
+CREATE TABLE %(new_table)s AS
+SELECT DISTINCT building_type
+FROM ged2.distribution_value
+WHERE building_type IS NOT NULL;
+CREATE INDEX %(new_table_name)s_building_type_idx
+    ON %(new_table)s (building_type text_pattern_ops);
+ANALYZE %(new_table)s;
+DROP TABLE IF EXISTS %(table)s;
+ALTER TABLE %(new_table)s RENAME TO %(table_name)s;
+ALTER INDEX %(schema)s.%(new_table_name)s_building_type_idx
+    RENAME TO %(table_name)s_building_type_idx;
+""" % dict(table=table, new_table=new_table,
+           schema=table.split('.')[0],
+           table_name=table.split('.')[1],
+           new_table_name=new_table.split('.')[1])
+
+    cursor = connections['geddb'].cursor()
+    cursor.execute(query)
+
+
+#: Export orders: by grid point id (the default), or along a Hilbert curve
+#: (see :func:`hilbert_key`), which keeps nearby grid points together.
+EXPORT_ORDERS = ('id', 'spatial')
+#: Bits per axis of the Hilbert curve of the exposure tables: the world is
+#: split into 2 ** HILBERT_ORDER columns and rows of cells.
+HILBERT_ORDER = 16
+#: Column of the Hilbert keys of the exposure tables, added by the
+#: `cluster_exposure_facts` management command.
+HILBERT_KEY_COLUMN = 'hilbert_key'
+#: Maximum number of curve cells covering the bounding box of a spatially
+#: ordered export (each one is a key range, see :func:`_hilbert_ranges`).
+HILBERT_MAX_CELLS = 256
+#: Same as :func:`hilbert_key`, in the GED database.
+HILBERT_KEY_FUNCTION = 'ged2.exposure_hilbert_key'
+
+#: Columns found by :func:`_column_exists`.
+_columns_found = set()
+
+
+def _hilbert_cell(lng, lat):
+    """
+    :returns:
+        The column and row of the curve cell of a point.
+    """
+    n = 1 << HILBERT_ORDER
+    x = int(math.floor((float(lng) + 180) / 360 * n))
+    y = int(math.floor((float(lat) + 90) / 180 * n))
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def _hilbert_index(order, x, y):
+    """
+    :returns:
+        The position of the cell (`x`, `y`) along the Hilbert curve of a
+        2 ** `order` by 2 ** `order` grid.
+    """
+    n = 1 << order
+    d = 0
+    s = n >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return d
+
+
+def hilbert_key(lng, lat):
+    """
+    :returns:
+        The Hilbert key of a point: the position of its cell along the
+        Hilbert curve covering the world (see :data:`HILBERT_ORDER`). Points
+        with close keys are close to each other.
+    """
+    x, y = _hilbert_cell(lng, lat)
+    return _hilbert_index(HILBERT_ORDER, x, y)
+
+
+def _hilbert_ranges(lng1, lat1, lng2, lat2):
+    """
+    Cover a bounding box with ranges of Hilbert keys.
+
+    The cells of a coarser grid are runs of consecutive keys along the
+    curve. The finest grid whose cells overlapping the bounding box are at
+    most :data:`HILBERT_MAX_CELLS` is used, and the runs of neighbouring
+    cells are merged.
+
+    :returns:
+        A list of (first key, last key) pairs, in increasing key order.
+    """
+    lng1, lng2 = sorted([float(lng1), float(lng2)])
+    lat1, lat2 = sorted([float(lat1), float(lat2)])
+    x1, y1 = _hilbert_cell(lng1, lat1)
+    x2, y2 = _hilbert_cell(lng2, lat2)
+
+    level = 0
+    while level < HILBERT_ORDER:
+        shift = HILBERT_ORDER - level - 1
+        cells = (((x2 >> shift) - (x1 >> shift) + 1)
+                 * ((y2 >> shift) - (y1 >> shift) + 1))
+        if cells > HILBERT_MAX_CELLS:
+            break
+        level += 1
+
+    shift = HILBERT_ORDER - level
+    size = 1 << (2 * shift)
+    indices = sorted(
+        _hilbert_index(level, x, y)
+        for x in xrange(x1 >> shift, (x2 >> shift) + 1)
+        for y in xrange(y1 >> shift, (y2 >> shift) + 1)
+    )
+    ranges = []
+    for index in indices:
+        if ranges and ranges[-1][1] == index * size - 1:
+            ranges[-1][1] = (index + 1) * size - 1
+        else:
+            ranges.append([index * size, (index + 1) * size - 1])
+    return [tuple(key_range) for key_range in ranges]
+
+
+def _column_exists(table, column):
+    """
+    Same as :func:`_table_exists`, for a column added to one of the tables
+    built by the exposure management commands.
+    """
+    if (table, column) not in _columns_found:
+        schema, table_name = table.split('.')
+        cursor = connections['geddb'].cursor()
+        cursor.execute(
+            'SELECT 1 FROM information_schema.columns WHERE table_schema = %s'
+            ' AND table_name = %s AND column_name = %s',
+            [schema, table_name, column]
+        )
+        if cursor.fetchall():
+            _columns_found.add((table, column))
+    return (table, column) in _columns_found
+
+
+def _spatial_key_ranges(fact_table, lng1, lat1, lng2, lat2, area=None):
+    """
+    :returns:
+        The Hilbert key ranges to scan to export a bounding box (or `area`)
+        from an exposure table in spatial order, or `None` if the table has
+        no Hilbert keys (the export is then ordered by grid point id).
+    """
+    if not _column_exists(fact_table, HILBERT_KEY_COLUMN):
+        return None
+    if area is not None:
+        extent = area_extent(area)
+        if extent is None:
+            # Nothing to export.
+            return []
+        lng1, lat1, lng2, lat2 = extent
+    return _hilbert_ranges(lng1, lat1, lng2, lat2)
+
+
+def _fact_order(key_ranges):
+    """
+    :returns:
+        The end of the `WHERE` clause and the `ORDER BY` clause of an export
+        query on an exposure table, in spatial order if `key_ranges` is not
+        `None`. The rows are then restricted to the Hilbert key ranges, in a
+        single condition ORing a `BETWEEN %s AND %s` per range, whose bounds
+        are the last arguments of the query (see :func:`_key_range_args`).
+    """
+    if key_ranges is None:
+        return '\nORDER BY fact.grid_id'
+    if not key_ranges:
+        condition = 'FALSE'
+    else:
+        condition = '(%s)' % '\n        OR '.join(
+            ['fact.%s BETWEEN %%%%s AND %%%%s' % HILBERT_KEY_COLUMN]
+            * len(key_ranges)
+        )
+    return ('\n    AND %s\nORDER BY fact.%s, fact.grid_id'
+            % (condition, HILBERT_KEY_COLUMN))
+
+
+def _key_range_args(key_ranges):
+    """
+    :returns:
+        The query arguments of the Hilbert key ranges of
+        :func:`_fact_order`.
+    """
+    return [key for key_range in key_ranges or [] for key in key_range]
+
+
+def _build_hilbert_keys(admin_level):
+    """
+    Add Hilbert keys (see :func:`hilbert_key`) to the exposure table of an
+    admin level (see :data:`EXPOSURE_FACT_TABLES`), and cluster the table in
+    key order, so that spatially ordered exports read consecutive pages.
+
+    :returns:
+        `False` if the table has not been built.
+    """
+    table = EXPOSURE_FACT_TABLES[admin_level]
+    if not _table_exists(table):
+        return False
+    table_name = table.split('.')[1]
+    cursor = connections['geddb'].cursor()
+    # The same computation as _hilbert_index.
+    cursor.execute("""\
+CREATE OR REPLACE FUNCTION %(function)s(lon double precision,
+                                        lat double precision)
+RETURNS bigint AS $$
+DECLARE
+    n bigint := %(n)s;
+    x bigint := LEAST(GREATEST(floor((lon + 180) / 360 * n)::bigint, 0),
+                      n - 1);
+    y bigint := LEAST(GREATEST(floor((lat + 90) / 180 * n)::bigint, 0),
+                      n - 1);
+    s bigint := n / 2;
+    rx bigint;
+    ry bigint;
+    t bigint;
+    d bigint := 0;
+BEGIN
+    WHILE s > 0 LOOP
+        rx := CASE WHEN x & s > 0 THEN 1 ELSE 0 END;
+        ry := CASE WHEN y & s > 0 THEN 1 ELSE 0 END;
+        d := d + s * s * ((3 * rx) # ry);
+        IF ry = 0 THEN
+            IF rx = 1 THEN
+                x := n - 1 - x;
+                y := n - 1 - y;
+            END IF;
+            t := x;
+            x := y;
+            y := t;
+        END IF;
+        s := s / 2;
+    END LOOP;
+    RETURN d;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+""" % dict(function=HILBERT_KEY_FUNCTION, n=1 << HILBERT_ORDER))
+
+    if not _column_exists(table, HILBERT_KEY_COLUMN):
+        cursor.execute('ALTER TABLE %s ADD COLUMN %s bigint'
+                       % (table, HILBERT_KEY_COLUMN))
+        _columns_found.add((table, HILBERT_KEY_COLUMN))
+    cursor.execute("""\
+UPDATE %(table)s SET %(column)s = %(function)s(lon, lat);
+DROP INDEX IF EXISTS %(schema)s.%(table_name)s_%(column)s_idx;
+CREATE INDEX %(table_name)s_%(column)s_idx
+    ON %(table)s (%(column)s, grid_id);
+CLUSTER %(table)s USING %(table_name)s_%(column)s_idx;
+ANALYZE %(table)s;
+""" % dict(table=table, table_name=table_name, schema=table.split('.')[0],
+           column=HILBERT_KEY_COLUMN, function=HILBERT_KEY_FUNCTION))
+    return True
+
+
+def _get_national_exposure(lng1, lat1, lng2, lat2, tod, occupancy,
+                           taxonomy=None, area=None, order='id'):
+    """
+    :param lng1, lat1, lng2, lat2:
+        Lat/lon of the selected bounding box.
+    :param tod_select:
+        'day', 'night', 'transit', 'all', or 'off'
+    :param occupancy:
+        List. [0], [1], or [0, 1]. 0 represents residential, 1 represents
+        non-residential.
+    :param taxonomy:
+        Optional taxonomy prefixes of the building types to export (see
+        :func:`parse_taxonomy`).
+    :param area:
+        Optional polygon or region to export instead of the bounding box
+        (see :func:`_spatial_filter`).
+    :param order:
+        One of :data:`EXPORT_ORDERS`. Spatial order needs the Hilbert keys
+        of the exposure table (see :func:`_build_hilbert_keys`); without
+        them, rows are ordered by grid point id.
+    :returns:
+        An iterator over the result rows (see :func:`_stream_query`).
+    """
+    fact_table = EXPOSURE_FACT_TABLES['admin0']
+    key_ranges = None
+    if _table_exists(fact_table):
+        if order == 'spatial':
+            key_ranges = _spatial_key_ranges(fact_table, lng1, lat1, lng2,
+                                             lat2, area)
+        tod_map = {
+            'day': 'fact.day_pop_ratio',
+            'night': 'fact.night_pop_ratio',
+            'transit': 'fact.transit_pop_ratio',
+        }
+        area_filter, area_args = _spatial_filter(
+            'fact.grid_id', 'fact.the_geom', lng1, lat1, lng2, lat2, area
+        )
+        taxonomy_filter, taxonomy_args = _taxonomy_filter(
+            'fact.building_type', taxonomy
+        )
+        members, members_args = _area_members('fact.grid_id',
+                                               'fact.the_geom', area)
+        query = """\
+SELECT
+    fact.grid_id,
+    fact.lon,
+    fact.lat,
+    fact.pop_value,
+    fact.gadm_country_id,
+    fact.iso,
+    fact.study_region_id,
+    fact.building_type,
+    fact.dwelling_fraction,
+    %%(day)s as day_pop_ratio,
+    %%(night)s as night_pop_ratio,
+    %%(transit)s as transit_pop_ratio%%(members)s
+FROM %s AS fact
+WHERE
+    %%(area)s
+    AND fact.dist_occupancy_id IN %%(occ)s
+    AND fact.pop_occupancy_id IN %%(occ)s%%(taxonomy)s%s
+""" % (fact_table, _fact_order(key_ranges))
+    else:
+        tod_map = {
+            'day': 'pop_alloc.day_pop_ratio',
+            'night': 'pop_alloc.night_pop_ratio',
+            'transit': 'pop_alloc.transit_pop_ratio',
+        }
+        area_filter, area_args = _spatial_filter(
+            'grid_point.id', 'grid_point.the_geom', lng1, lat1, lng2, lat2,
+            area
+        )
+        taxonomy_filter, taxonomy_args = _taxonomy_filter(
+            'dist_value.building_type', taxonomy
+        )
+        members, members_args = _area_members('grid_point.id',
+                                               'grid_point.the_geom', area)
+        query = """\
+SELECT
+    grid_point.id,
+    ST_X(grid_point.the_geom) AS lon,
+    ST_Y(grid_point.the_geom) AS lat,
+    grid_point.pop_value,
+    grid_point.gadm_country_id,
+    gadm_country.iso,
+    dist_group.study_region_id,
+    dist_value.building_type,
+    dist_value.dwelling_fraction,
+    %%(day)s as day_pop_ratio,
+    %%(night)s as night_pop_ratio,
+    %%(transit)s as transit_pop_ratio%%(members)s
+%s
+WHERE
+%s
+    AND %%(area)s
+    AND dist_group.occupancy_id IN %%(occ)s
+    AND pop_alloc.occupancy_id IN %%(occ)s%%(taxonomy)s
+ORDER BY grid_point.id
+""" % (NATIONAL_JOINS, NATIONAL_CONDITIONS)
+
+    args = dict(day='NULL', night='NULL', transit='NULL', area=area_filter,
+                occ=num_list_to_sql_array(occupancy),
+                taxonomy=taxonomy_filter, members=members)
+    if tod == 'day':
+        args['day'] = tod_map['day']
+    elif tod == 'night':
+        args['night'] = tod_map['night']
+    elif tod == 'transit':
+        args['transit'] = tod_map['transit']
+    elif tod == 'all':
+        args['day'] = tod_map['day']
+        args['night'] = tod_map['night']
+        args['transit'] = tod_map['transit']
+
+    query %= args
+    return _stream_query(query, members_args + area_args + taxonomy_args
+                         + _key_range_args(key_ranges))
+
+
+def _get_subnational_exposure(lng1, lat1, lng2, lat2, occupancy, admin_level,
+                              taxonomy=None, area=None, order='id'):
+    """
+    :param lng1, lat1, lng2, lat2:
+        Lat/lon of the selected bounding box.
+    :param occupancy:
+        List. [0], [1], or [0, 1]. 0 represents residential, 1 represents
+        non-residential.
+    :param admin_level:
+        'admin1', 'admin2', or 'admin3'
+    :param taxonomy:
+        Optional taxonomy prefixes of the building types to export (see
+        :func:`parse_taxonomy`).
+    :param area:
+        Optional polygon or region to export instead of the bounding box
+        (see :func:`_spatial_filter`).
+    :param order:
+        One of :data:`EXPORT_ORDERS` (see :func:`_get_national_exposure`).
+    :returns:
+        An iterator over the result rows (see :func:`_stream_query`).
+    """
+    admin_level_id = ADMIN_LEVEL_COLUMN_MAP.get(admin_level)
+    fact_table = EXPOSURE_FACT_TABLES.get(admin_level)
+    key_ranges = None
+
+    if fact_table is not None and _table_exists(fact_table):
+        if order == 'spatial':
+            key_ranges = _spatial_key_ranges(fact_table, lng1, lat1, lng2,
+                                             lat2, area)
+        area_filter, area_args = _spatial_filter(
+            'fact.grid_id', 'fact.the_geom', lng1, lat1, lng2, lat2, area
+        )
+        taxonomy_filter, taxonomy_args = _taxonomy_filter(
+            'fact.building_type', taxonomy
+        )
+        members, members_args = _area_members('fact.grid_id',
+                                               'fact.the_geom', area)
+        query = """\
+SELECT
+    fact.grid_id,
+    fact.lon,
+    fact.lat,
+    fact.pop_value,
+    fact.admin_id,
+    fact.iso,
+    fact.study_region_id,
+    fact.building_type,
+    fact.dwelling_fraction%%(members)s
+FROM %s AS fact
+WHERE
+    %%(area)s
+    AND fact.dist_occupancy_id IN %%(occ)s%%(taxonomy)s%s
+""" % (fact_table, _fact_order(key_ranges))
+    else:
+        area_filter, area_args = _spatial_filter(
+            'grid_point.id', 'grid_point.the_geom', lng1, lat1, lng2, lat2,
+            area
+        )
+        taxonomy_filter, taxonomy_args = _taxonomy_filter(
+            'dist_value.building_type', taxonomy
+        )
+        members, members_args = _area_members('grid_point.id',
+                                               'grid_point.the_geom', area)
+        query = """\
+SELECT
+    grid_point.id,
+    ST_X(grid_point.the_geom) AS lon,
+    ST_Y(grid_point.the_geom) AS lat,
+    grid_point.pop_value,
+    grid_point.%%(admin_level_id)s,
+    gadm_country.iso,
+    dist_group.study_region_id,
+    dist_value.building_type,
+    dist_value.dwelling_fraction%%(members)s
+%s
+WHERE
+%s
+    AND %%(area)s
+    AND dist_group.occupancy_id IN %%(occ)s%%(taxonomy)s
+ORDER BY grid_point.id
+""" % (SUBNATIONAL_JOINS, SUBNATIONAL_CONDITIONS)
+    query %= dict(admin_level_id=admin_level_id, area=area_filter,
+                  occ=num_list_to_sql_array(occupancy),
+                  taxonomy=taxonomy_filter, members=members)
+    return _stream_query(query, members_args + area_args + taxonomy_args
+                         + _key_range_args(key_ranges))
+
+
+def _get_aggregated_exposure(lng1, lat1, lng2, lat2, occupancy, admin_level,
+                             taxonomy=None, area=None):
+    """
+    Get the building exposure of an admin level, summed by region and
+    building type.
+
+    :param lng1, lat1, lng2, lat2:
+        Lat/lon of the selected bounding box.
+    :param occupancy:
+        List. [0], [1], or [0, 1]. 0 represents residential, 1 represents
+        non-residential.
+    :param admin_level:
+        'admin1', 'admin2', or 'admin3'
+    :param taxonomy:
+        Optional taxonomy prefixes of the building types to export (see
+        :func:`parse_taxonomy`).
+    :param area:
+        Optional polygon or region to export instead of the bounding box
+        (see :func:`_spatial_filter`).
+    :returns:
+        An iterator over the result rows (see :func:`_stream_query`): the
+        region id, ISO code, building type, population, population-weighted
+        longitude and latitude, and number of grid points. Rows are ordered
+        by region id and building type.
+    """
+    admin_level_id = ADMIN_LEVEL_COLUMN_MAP[admin_level]
+    fact_table = EXPOSURE_FACT_TABLES[admin_level]
+
+    if _table_exists(fact_table):
+        columns = dict(grid_id='fact.grid_id', geom='fact.the_geom',
+                       lon='fact.lon', lat='fact.lat',
+                       pop_value='fact.pop_value', admin_id='fact.admin_id',
+                       iso='fact.iso', building_type='fact.building_type',
+                       dwelling_fraction='fact.dwelling_fraction',
+                       occupancy_id='fact.dist_occupancy_id')
+        source = """\
+FROM %s AS fact
+WHERE
+    """ % fact_table
+    else:
+        columns = dict(grid_id='grid_point.id', geom='grid_point.the_geom',
+                       lon='ST_X(grid_point.the_geom)',
+                       lat='ST_Y(grid_point.the_geom)',
+                       pop_value='grid_point.pop_value',
+                       admin_id='grid_point.%s' % admin_level_id,
+                       iso='gadm_country.iso',
+                       building_type='dist_value.building_type',
+                       dwelling_fraction='dist_value.dwelling_fraction',
+                       occupancy_id='dist_group.occupancy_id')
+        source = """\
+%s
+WHERE
+%s
+    AND """ % (SUBNATIONAL_JOINS % dict(admin_level_id=admin_level_id),
+               SUBNATIONAL_CONDITIONS)
+
+    area_filter, area_args = _spatial_filter(
+        columns['grid_id'], columns['geom'], lng1, lat1, lng2, lat2, area
+    )
+    taxonomy_filter, taxonomy_args = _taxonomy_filter(
+        columns['building_type'], taxonomy
+    )
+    query = """\
+SELECT
+    %(admin_id)s,
+    %(iso)s,
+    %(building_type)s,
+    SUM(%(pop_value)s * %(dwelling_fraction)s) AS population,
+    COALESCE(
+        SUM(%(pop_value)s * %(dwelling_fraction)s * %(lon)s)
+        / NULLIF(SUM(%(pop_value)s * %(dwelling_fraction)s), 0),
+        AVG(%(lon)s)) AS lon,
+    COALESCE(
+        SUM(%(pop_value)s * %(dwelling_fraction)s * %(lat)s)
+        / NULLIF(SUM(%(pop_value)s * %(dwelling_fraction)s), 0),
+        AVG(%(lat)s)) AS lat,
+    COUNT(DISTINCT %(grid_id)s) AS grid_points
+""" % columns
+    query += source + area_filter + """
+    AND %(occupancy_id)s IN %(occ)s%(taxonomy)s
+GROUP BY 1, 2, 3
+ORDER BY 1, 3
+""" % dict(columns, occ=num_list_to_sql_array(occupancy),
+           taxonomy=taxonomy_filter)
+    return _stream_query(query, area_args + taxonomy_args)
+
+
+def _get_population_exposure(lng1, lat1, lng2, lat2, area=None):
+    """
+    Get population-only exposure data (no building/taxonomy information).
+
+    :param lng1, lat1, lng2, lat2:
+        Bounding box coordinates.
+    :param area:
+        Optional polygon or region to export instead of the bounding box
+        (see :func:`_spatial_filter`).
+    :returns:
+        An iterator over the result rows (see :func:`_stream_query`).
+    """
+    query = """\
+SELECT
+    grid_point.id,
+    ST_X(grid_point.the_geom) AS lon,
+    ST_Y(grid_point.the_geom) AS lat,
+    grid_point.pop_value,
+    gadm_country.iso
+FROM ged2.grid_point AS grid_point
+
+JOIN ged2.gadm_country AS gadm_country
+    ON grid_point.gadm_country_id = gadm_country.id
+
+WHERE
+    grid_point.pop_value > 0
+    AND %s
+ORDER BY grid_point.id
+"""
+    area_filter, area_args = _spatial_filter(
+        'grid_point.id', 'grid_point.the_geom', lng1, lat1, lng2, lat2, area
+    )
+    return _stream_query(query % area_filter, area_args)
+
+
+def _build_exposure_facts(admin_level, isos=None):
+    """
+    (Re)build the denormalized exposure table of an admin level (see
+    :data:`EXPOSURE_FACT_TABLES`), creating it if needed.
+
+    :param str admin_level:
+        'admin0', 'admin1', 'admin2', or 'admin3'
+    :param isos:
+        Optional list of ISO country codes. If given, only the rows of those
+        countries are refreshed; otherwise the whole table is.
+    """
+    table = EXPOSURE_FACT_TABLES[admin_level]
+    if admin_level == 'admin0':
+        select = """\
+SELECT
+    grid_point.id AS grid_id,
+    grid_point.the_geom,
+    ST_X(grid_point.the_geom) AS lon,
+    ST_Y(grid_point.the_geom) AS lat,
+    grid_point.pop_value,
+    grid_point.gadm_country_id,
+    gadm_country.iso,
+    dist_group.study_region_id,
+    dist_value.building_type,
+    dist_value.dwelling_fraction,
+    dist_group.occupancy_id AS dist_occupancy_id,
+    pop_alloc.occupancy_id AS pop_occupancy_id,
+    pop_alloc.day_pop_ratio,
+    pop_alloc.night_pop_ratio,
+    pop_alloc.transit_pop_ratio
+%s
+WHERE
+%s
+""" % (NATIONAL_JOINS, NATIONAL_CONDITIONS)
+    else:
+        select = """\
+SELECT
+    grid_point.id AS grid_id,
+    grid_point.the_geom,
+    ST_X(grid_point.the_geom) AS lon,
+    ST_Y(grid_point.the_geom) AS lat,
+    grid_point.pop_value,
+    grid_point.%(admin_level_id)s AS admin_id,
+    gadm_country.iso,
+    dist_group.study_region_id,
+    dist_value.building_type,
+    dist_value.dwelling_fraction,
+    dist_group.occupancy_id AS dist_occupancy_id
+%(joins)s
+WHERE
+%(conditions)s
+""" % dict(admin_level_id=ADMIN_LEVEL_COLUMN_MAP[admin_level],
+           joins=SUBNATIONAL_JOINS % dict(
+               admin_level_id=ADMIN_LEVEL_COLUMN_MAP[admin_level]),
+           conditions=SUBNATIONAL_CONDITIONS)
+
+    cursor = connections['geddb'].cursor()
+    if not _table_exists(table):
+        table_name = table.split('.')[1]
+        cursor.execute("""\
+CREATE TABLE %(table)s AS %(select)s    AND false;
+CREATE INDEX %(table_name)s_geom_idx ON %(table)s USING GIST (the_geom);
+CREATE INDEX %(table_name)s_iso_idx ON %(table)s (iso);
+CREATE INDEX %(table_name)s_building_type_idx ON %(table)s (building_type);
+""" % dict(table=table, table_name=table_name, select=select))
+
+    if isos:
+        iso_filter = '    AND gadm_country.iso IN %s\n'
+        args = [tuple(isos)]
+        cursor.execute('DELETE FROM %s WHERE iso IN %%s' % table, args)
+    else:
+        iso_filter = ''
+        args = []
+        cursor.execute('DELETE FROM %s' % table)
+    cursor.execute('INSERT INTO %s %s%s' % (table, select, iso_filter), args)
+    if _column_exists(table, HILBERT_KEY_COLUMN):
+        # New rows are appended: run `cluster_exposure_facts` again to put
+        # them back in key order.
+        cursor.execute('UPDATE %s SET %s = %s(lon, lat) WHERE %s IS NULL'
+                       % (table, HILBERT_KEY_COLUMN, HILBERT_KEY_FUNCTION,
+                          HILBERT_KEY_COLUMN))
+    cursor.execute('ANALYZE %s' % table)
+
+
+def _build_cell_counts():
+    """
+    (Re)build the cell count table (see :data:`CELL_COUNT_TABLE`).
+
+    For each cell of :data:`CELL_COUNT_CELL_SIZE` degrees, the table holds
+    the number of rows returned by :func:`_get_population_exposure`
+    ('population'), :func:`_get_national_exposure` ('admin0') and
+    :func:`_get_subnational_exposure` ('admin1' to 'admin3') for the grid
+    points of the cell, by occupancy. As for the admin level index, the new
+    table is swapped in at the end.
+    """
+    table = CELL_COUNT_TABLE
+    new_table = '%s_new' % table
+    cell_columns = """\
+    floor(ST_X(grid_point.the_geom) / %(cell_size)s)::integer,
+    floor(ST_Y(grid_point.the_geom) / %(cell_size)s)::integer""" % dict(
+        cell_size=CELL_COUNT_CELL_SIZE
+    )
+
+    queries = ["""\
+DROP TABLE IF EXISTS %(new_table)s;
+CREATE TABLE %(new_table)s (
+    cell_x integer NOT NULL,
+    cell_y integer NOT NULL,
+    export varchar(16) NOT NULL,
+    dist_occupancy_id integer,
+    pop_occupancy_id integer,
+    n_rows bigint NOT NULL
+);
+INSERT INTO %(new_table)s
+SELECT
+%(cell_columns)s,
+    'population', NULL, NULL, count(*)
+FROM ged2.grid_point AS grid_point
+WHERE grid_point.pop_value > 0
+GROUP BY 1, 2;
+INSERT INTO %(new_table)s
+SELECT
+%(cell_columns)s,
+    'admin0', dist_group.occupancy_id, pop_alloc.occupancy_id, count(*)
+%(national_joins)s
+WHERE
+%(national_conditions)s
+GROUP BY 1, 2, 4, 5;
+""" % dict(new_table=new_table, cell_columns=cell_columns,
+           national_joins=NATIONAL_JOINS,
+           national_conditions=NATIONAL_CONDITIONS)]
+
+    for admin_level, admin_level_id in sorted(ADMIN_LEVEL_COLUMN_MAP.items()):
+        queries.append("""\
+INSERT INTO %(new_table)s
+SELECT
+%(cell_columns)s,
+    '%(admin_level)s', dist_group.occupancy_id, NULL, count(*)
+%(joins)s
+WHERE
+%(conditions)s
+GROUP BY 1, 2, 4;
+""" % dict(new_table=new_table, cell_columns=cell_columns,
+           admin_level=admin_level,
+           joins=SUBNATIONAL_JOINS % dict(admin_level_id=admin_level_id),
+           conditions=SUBNATIONAL_CONDITIONS))
+
+    queries.append("""\
+CREATE INDEX %(new_table_name)s_idx ON %(new_table)s (export, cell_x, cell_y);
+DROP TABLE IF EXISTS %(table)s;
+ALTER TABLE %(new_table)s RENAME TO %(table_name)s;
+ALTER INDEX %(schema)s.%(new_table_name)s_idx RENAME TO %(table_name)s_idx;
+""" % dict(table=table, new_table=new_table,
+           schema=table.split('.')[0],
+           table_name=table.split('.')[1],
+           new_table_name=new_table.split('.')[1]))
+
+    cursor = connections['geddb'].cursor()
+    cursor.execute(''.join(queries))
+
+
+def _estimate_export_rows(export, lng1, lat1, lng2, lat2, occupancy=None):
+    """
+    Estimate the number of rows an export query would return, from the cell
+    count table.
+
+    Cells only partly covered by the bounding box contribute in proportion
+    to the covered part of their area, assuming that rows are evenly spread
+    within a cell.
+
+    :param str export:
+        'population' (see :func:`_get_population_exposure`), or 'admin0' to
+        'admin3' (see :func:`_get_national_exposure` and
+        :func:`_get_subnational_exposure`).
+    :param occupancy:
+        For building exports, the list of occupancies, as for the export
+        queries.
+    :returns:
+        The estimated number of rows, or `None` if the cell count table has
+        not been built. Population exports are counted exactly with the
+        population pyramid (see :func:`population_total`), if it has been
+        built.
+    """
+    if export == 'population' and _table_exists(POPULATION_PYRAMID_TABLE):
+        # Exact, and as fast.
+        return population_total(lng1, lat1, lng2, lat2)['grid_points']
+    if not _table_exists(CELL_COUNT_TABLE):
+        return None
+
+    lng1, lat1, lng2, lat2 = [float(x) for x in (lng1, lat1, lng2, lat2)]
+    x1, y1, x2, y2 = _snap_to_cells(lng1, lat1, lng2, lat2,
+                                    CELL_COUNT_CELL_SIZE)
+    query = """\
+SELECT COALESCE(SUM(
+    n_rows
+    * (LEAST(%%(lng2)s, (cell_x + 1) * %(size)s)
+       - GREATEST(%%(lng1)s, cell_x * %(size)s)) / %(size)s
+    * (LEAST(%%(lat2)s, (cell_y + 1) * %(size)s)
+       - GREATEST(%%(lat1)s, cell_y * %(size)s)) / %(size)s
+), 0)
+FROM %(table)s
+WHERE export = %%(export)s
+  AND cell_x BETWEEN %%(x1)s AND %%(x2)s
+  AND cell_y BETWEEN %%(y1)s AND %%(y2)s
+"""
+    if export == 'admin0':
+        query += """\
+  AND dist_occupancy_id IN %(occ)s
+  AND pop_occupancy_id IN %(occ)s
+"""
+    elif export != 'population':
+        query += """\
+  AND dist_occupancy_id IN %(occ)s
+"""
+    query %= dict(size=CELL_COUNT_CELL_SIZE, table=CELL_COUNT_TABLE,
+                  occ=num_list_to_sql_array(occupancy or []))
+
+    cursor = connections['geddb'].cursor()
+    cursor.execute(query, dict(export=export,
+                               lng1=min(lng1, lng2), lng2=max(lng1, lng2),
+                               lat1=min(lat1, lat2), lat2=max(lat1, lat2),
+                               x1=x1, y1=y1, x2=x2, y2=y2))
+    [(n_rows, )] = cursor.fetchall()
+    return int(round(n_rows))
+
+
+def _build_population_pyramid():
+    """
+    (Re)build the population pyramid table (see
+    :data:`POPULATION_PYRAMID_TABLE`).
+
+    For each level of the pyramid, and each cell of that level containing
+    populated grid points, the table holds the population and the number of
+    those grid points. As for the admin level index, the new table is
+    swapped in at the end.
+    """
+    table = POPULATION_PYRAMID_TABLE
+    new_table = '%s_new' % table
+    queries = ["""\
+DROP TABLE IF EXISTS %(new_table)s;
+CREATE TABLE %(new_table)s (
+    level smallint NOT NULL,
+    cell_x integer NOT NULL,
+    cell_y integer NOT NULL,
+    population double precision NOT NULL,
+    grid_points bigint NOT NULL
+);
+""" % dict(new_table=new_table)]
+
+    for level, cell_size in enumerate(POPULATION_PYRAMID_CELL_SIZES):
+        queries.append("""\
+INSERT INTO %(new_table)s
+SELECT
+    %(level)s,
+    %(cell_x)s::integer,
+    %(cell_y)s::integer,
+    SUM(grid_point.pop_value),
+    COUNT(*)
+FROM ged2.grid_point AS grid_point
+WHERE grid_point.pop_value > 0
+GROUP BY 2, 3;
+""" % dict(new_table=new_table, level=level,
+           cell_x=_pyramid_cell_column('x', cell_size),
+           cell_y=_pyramid_cell_column('y', cell_size)))
+
+    queries.append("""\
+ALTER TABLE %(new_table)s
+    ADD CONSTRAINT %(new_table_name)s_pkey
+    PRIMARY KEY (level, cell_x, cell_y);
+DROP TABLE IF EXISTS %(table)s;
+ALTER TABLE %(new_table)s RENAME TO %(table_name)s;
+ALTER INDEX %(schema)s.%(new_table_name)s_pkey
+    RENAME TO %(table_name)s_pkey;
+""" % dict(table=table, new_table=new_table,
+           schema=table.split('.')[0],
+           table_name=table.split('.')[1],
+           new_table_name=new_table.split('.')[1]))
+
+    cursor = connections['geddb'].cursor()
+    cursor.execute(''.join(queries))
+
+
+def _pyramid_cell_column(axis, cell_size):
+    # The same expression is used to build the pyramid and to exclude the
+    # grid points of the pyramid cells from the native query, so that both
+    # agree on the cell of each grid point.
+    return 'floor(ST_%s(grid_point.the_geom) / %r)' % (axis.upper(),
+                                                       cell_size)
+
+
+def _pyramid_blocks(lng1, lat1, lng2, lat2, level=0):
+    """
+    Cover a bounding box with blocks of whole pyramid cells, taking the
+    largest cells first.
+
+    :returns:
+        A pair of lists: the blocks of cells, as (level, x1, y1, x2, y2)
+        cell index ranges, and the rectangles (lng1, lat1, lng2, lat2) of the
+        bounding box left uncovered, to be read at the native resolution.
+    """
+    if level == len(POPULATION_PYRAMID_CELL_SIZES):
+        return [], [(lng1, lat1, lng2, lat2)]
+
+    cell_size = POPULATION_PYRAMID_CELL_SIZES[level]
+    x1 = int(math.ceil(lng1 / cell_size))
+    y1 = int(math.ceil(lat1 / cell_size))
+    x2 = int(math.floor(lng2 / cell_size)) - 1
+    y2 = int(math.floor(lat2 / cell_size)) - 1
+    if x1 > x2 or y1 > y2:
+        return _pyramid_blocks(lng1, lat1, lng2, lat2, level + 1)
+
+    blocks = [(level, x1, y1, x2, y2)]
+    rest = []
+    left, right = x1 * cell_size, (x2 + 1) * cell_size
+    bottom, top = y1 * cell_size, (y2 + 1) * cell_size
+    # The left and right strips take the corners. Flat strips are kept: the
+    # points on the edges of the block may be outside of its cells, because
+    # of floating point rounding (or, on the upper edges, because they are
+    # in the next cells).
+    for rect in ((lng1, lat1, left, lat2), (right, lat1, lng2, lat2),
+                 (left, lat1, right, bottom), (left, top, right, lat2)):
+        if rect[0] <= rect[2] and rect[1] <= rect[3]:
+            rect_blocks, rect_rest = _pyramid_blocks(*rect, level=level + 1)
+            blocks.extend(rect_blocks)
+            rest.extend(rect_rest)
+    return blocks, rest
+
+
+def population_total(lng1, lat1, lng2, lat2):
+    """
+    Compute the population of a bounding box.
+
+    The bounding box is covered by blocks of whole cells of the population
+    pyramid (see :data:`POPULATION_PYRAMID_TABLE`), and only the grid points
+    of what is left around the edges are read, through the spatial index.
+    Without the pyramid, all of the grid points of the bounding box are
+    read.
+
+    :param lng1, lat1, lng2, lat2:
+        The bounding box.
+    :returns:
+        A `dict` with the 'population' and the number of populated
+        'grid_points' of the bounding box.
+    """
+    lng1, lat1, lng2, lat2 = [float(x) for x in (lng1, lat1, lng2, lat2)]
+    bbox = (min(lng1, lng2), min(lat1, lat2), max(lng1, lng2),
+            max(lat1, lat2))
+    if _table_exists(POPULATION_PYRAMID_TABLE):
+        blocks, rest = _pyramid_blocks(*bbox)
+    else:
+        blocks, rest = [], [bbox]
+
+    args = []
+    if blocks:
+        cells = []
+        for level, x1, y1, x2, y2 in blocks:
+            cells.append('(level = %s AND cell_x BETWEEN %s AND %s'
+                         ' AND cell_y BETWEEN %s AND %s)')
+            args.extend([level, x1, x2, y1, y2])
+        pyramid_query = """\
+SELECT COALESCE(SUM(population), 0) AS population,
+       COALESCE(SUM(grid_points), 0) AS grid_points
+FROM %s
+WHERE %s""" % (POPULATION_PYRAMID_TABLE, '\n   OR '.join(cells))
+    else:
+        pyramid_query = 'SELECT 0 AS population, 0 AS grid_points'
+
+    if rest:
+        # Edges are included, as for the export queries (`&&` also works
+        # with the flat rectangles). Points on the edges of a block are in
+        # one of its cells: those are excluded.
+        conditions = ['(%s)' % '\n        OR '.join(
+            ['grid_point.the_geom && ST_MakeEnvelope(%s, %s, %s, %s, 4326)']
+            * len(rest)
+        )]
+        for rect in rest:
+            args.extend(rect)
+        for level, x1, y1, x2, y2 in blocks:
+            cell_size = POPULATION_PYRAMID_CELL_SIZES[level]
+            conditions.append(
+                'NOT (%s BETWEEN %%s AND %%s AND %s BETWEEN %%s AND %%s)'
+                % (_pyramid_cell_column('x', cell_size),
+                   _pyramid_cell_column('y', cell_size))
+            )
+            args.extend([x1, x2, y1, y2])
+        native_query = """\
+SELECT COALESCE(SUM(grid_point.pop_value), 0) AS population,
+       COUNT(*) AS grid_points
+FROM ged2.grid_point AS grid_point
+WHERE grid_point.pop_value > 0
+    AND %s""" % '\n    AND '.join(conditions)
+    else:
+        native_query = 'SELECT 0 AS population, 0 AS grid_points'
+
+    query = """\
+SELECT pyramid.population + native.population,
+       pyramid.grid_points + native.grid_points
+FROM (
+%s
+) AS pyramid, (
+%s
+) AS native
+""" % (pyramid_query, native_query)
+    cursor = connections['geddb'].cursor()
+    cursor.execute(query, args)
+    [(population, grid_points)] = cursor.fetchall()
+    return dict(population=float(population), grid_points=int(grid_points))
+
+
+def _get_population_density(lng1, lat1, lng2, lat2, cell_size=None):
+    """
+    Get the population of the grid points of a bounding box, for maps.
+
+    :param lng1, lat1, lng2, lat2:
+        The bounding box.
+    :param cell_size:
+        If given, the population is summed over the cells of a grid of this
+        size (in degrees). The sums are computed from the finest level of
+        the population pyramid (see :data:`POPULATION_PYRAMID_TABLE`) which
+        isn't finer than the grid, if there is one, or from the grid points.
+    :returns:
+        A list of (lon, lat, population, grid points, grid point id) rows,
+        one per grid point or per cell. Cells are located at the
+        population-weighted centre of their points, and have no id.
+    """
+    lng1, lat1, lng2, lat2 = [float(x) for x in (lng1, lat1, lng2, lat2)]
+    bbox = [min(lng1, lng2), min(lat1, lat2), max(lng1, lng2),
+            max(lat1, lat2)]
+
+    if cell_size is None:
+        query = """\
+SELECT ST_X(grid_point.the_geom), ST_Y(grid_point.the_geom),
+       grid_point.pop_value, 1, grid_point.id
+FROM ged2.grid_point AS grid_point
+WHERE grid_point.pop_value > 0
+    AND grid_point.the_geom && ST_MakeEnvelope(%s, %s, %s, %s, 4326)
+"""
+        args = bbox
+    else:
+        levels = [(size, level) for level, size
+                  in enumerate(POPULATION_PYRAMID_CELL_SIZES)
+                  if size <= cell_size]
+        if levels and _table_exists(POPULATION_PYRAMID_TABLE):
+            pyramid_size, level = max(levels)
+            source = """\
+    SELECT (cell_x + 0.5) * %(size)r AS lon, (cell_y + 0.5) * %(size)r AS lat,
+           population, grid_points
+    FROM %(table)s
+    WHERE level = %%s
+        AND cell_x BETWEEN %%s AND %%s
+        AND cell_y BETWEEN %%s AND %%s""" % dict(
+                size=pyramid_size, table=POPULATION_PYRAMID_TABLE
+            )
+            x1, y1, x2, y2 = _snap_to_cells(*(bbox + [pyramid_size]))
+            args = [level, x1, x2, y1, y2]
+        else:
+            source = """\
+    SELECT ST_X(grid_point.the_geom) AS lon, ST_Y(grid_point.the_geom) AS lat,
+           grid_point.pop_value AS population, 1 AS grid_points
+    FROM ged2.grid_point AS grid_point
+    WHERE grid_point.pop_value > 0
+        AND grid_point.the_geom && ST_MakeEnvelope(%s, %s, %s, %s, 4326)"""
+            args = bbox
+        query = """\
+SELECT COALESCE(SUM(population * lon) / NULLIF(SUM(population), 0),
+                AVG(lon)),
+       COALESCE(SUM(population * lat) / NULLIF(SUM(population), 0),
+                AVG(lat)),
+       SUM(population), SUM(grid_points), NULL
+FROM (
+%s
+) AS source
+GROUP BY floor(lon / %r), floor(lat / %r)
+""" % (source, cell_size, cell_size)
+
+    cursor = connections['geddb'].cursor()
+    cursor.execute(query, args)
     return cursor.fetchall()
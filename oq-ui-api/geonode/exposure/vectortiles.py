@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2013, GEM Foundation.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/agpl.html>.
+
+"""
+Mapbox Vector Tiles (version 2 of the specification) of the population of
+the GED grid points, for maps.
+
+Tiles are addressed in the usual z/x/y scheme of Web Mercator tiles, and
+hold one layer, :data:`LAYER_NAME`, of point features with a 'population'
+and a 'grid_points' attribute. From :data:`VECTOR_TILE_NATIVE_ZOOM`, each
+feature is a grid point (and its id is the grid point id). At lower zooms,
+the grid points are summed over the cells of a grid of
+:data:`VECTOR_TILE_GRID` x :data:`VECTOR_TILE_GRID` cells per tile (see
+:func:`exposure.util._get_population_density`).
+
+The protocol buffer encoding is written here, since a tile only needs a few
+of its messages.
+
+Generated tiles are kept in a disk cache, if :data:`VECTOR_TILE_CACHE_DIR`
+is set. It must be cleared (see the `clear_exposure_tile_cache` management
+command) whenever the GED data changes.
+"""
+
+import math
+import os
+import shutil
+import struct
+import uuid
+
+from django.conf import settings
+
+from exposure import tilecache
+from exposure import util
+
+#: Directory of the vector tile cache. `None` disables the cache.
+VECTOR_TILE_CACHE_DIR = getattr(settings, 'EXPOSURE_VECTOR_TILE_CACHE_DIR',
+                                None)
+#: Total size (in bytes) of the cached tiles above which the least recently
+#: used ones are deleted.
+VECTOR_TILE_CACHE_MAX_BYTES = getattr(
+    settings, 'EXPOSURE_VECTOR_TILE_CACHE_MAX_BYTES', 2 ** 30
+)
+#: Zoom level from which tiles hold the individual grid points.
+VECTOR_TILE_NATIVE_ZOOM = getattr(settings, 'EXPOSURE_VECTOR_TILE_NATIVE_ZOOM',
+                                  9)
+#: Number of cells, along each axis of a tile, over which the grid points
+#: are summed below :data:`VECTOR_TILE_NATIVE_ZOOM`.
+VECTOR_TILE_GRID = 128
+#: Highest zoom level served.
+MAX_ZOOM = 18
+
+LAYER_NAME = 'population'
+#: Size of the tile coordinate space.
+EXTENT = 4096
+
+_TILE_SUFFIX = '.mvt'
+#: Version of the generated tiles, part of the cache keys.
+_FORMAT_VERSION = 1
+_MAX_LATITUDE = 85.0511287798
+
+# Protocol buffer wire types.
+_VARINT = 0
+_FIXED64 = 1
+_BYTES = 2
+_DOUBLE = struct.Struct('<d')
+
+_POINT = 1
+_MOVE_TO_ONE = (1 << 3) | 1
+
+
+def valid_tile(z, x, y):
+    """
+    :returns:
+        `True` if (z, x, y) are the coordinates of a tile.
+    """
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_bounds(z, x, y):
+    """
+    :returns:
+        The bounding box (lng1, lat1, lng2, lat2) of a tile, in degrees.
+    """
+    n = 2.0 ** z
+    return (x / n * 360 - 180, _tile_latitude(y + 1, n),
+            (x + 1) / n * 360 - 180, _tile_latitude(y, n))
+
+
+def _tile_latitude(y, n):
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+
+def get_tile(z, x, y):
+    """
+    Get a tile, from the cache if it's enabled and has the tile.
+
+    :returns:
+        The content of the tile.
+    """
+    if VECTOR_TILE_CACHE_DIR is None:
+        return _make_tile(z, x, y)
+
+    path = os.path.join(VECTOR_TILE_CACHE_DIR, '%s_%s_%s_%s%s' % (
+        _FORMAT_VERSION, z, x, y, _TILE_SUFFIX
+    ))
+    try:
+        with open(path, 'rb') as fh:
+            data = fh.read()
+    except IOError:
+        pass
+    else:
+        # Mark the tile as recently used.
+        os.utime(path, None)
+        return data
+
+    data = _make_tile(z, x, y)
+    _write_tile(path, data)
+    tilecache.evict(VECTOR_TILE_CACHE_DIR, VECTOR_TILE_CACHE_MAX_BYTES,
+                    _TILE_SUFFIX)
+    return data
+
+
+def clear():
+    """
+    Delete all of the cached tiles.
+    """
+    if VECTOR_TILE_CACHE_DIR is not None:
+        shutil.rmtree(VECTOR_TILE_CACHE_DIR, ignore_errors=True)
+
+
+def _write_tile(path, data):
+    if not os.path.isdir(VECTOR_TILE_CACHE_DIR):
+        try:
+            os.makedirs(VECTOR_TILE_CACHE_DIR)
+        except OSError:
+            # Created concurrently.
+            pass
+
+    # As for the export tile cache, a partially written tile is never read.
+    tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    try:
+        with open(tmp_path, 'wb') as fh:
+            fh.write(data)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _make_tile(z, x, y):
+    lng1, lat1, lng2, lat2 = tile_bounds(z, x, y)
+    if z >= VECTOR_TILE_NATIVE_ZOOM:
+        cell_size = None
+    else:
+        cell_size = (lng2 - lng1) / VECTOR_TILE_GRID
+    rows = util._get_population_density(lng1, lat1, lng2, lat2,
+                                        cell_size=cell_size)
+
+    n = 2.0 ** z
+    features = []
+    for lon, lat, population, grid_points, grid_id in rows:
+        px, py = _tile_pixel(lon, lat, n, x, y)
+        # Cells of the bounding box may have their centre on a neighbouring
+        # tile.
+        if 0 <= px <= EXTENT and 0 <= py <= EXTENT:
+            features.append((grid_id, px, py,
+                             dict(population=float(population),
+                                  grid_points=int(grid_points))))
+    return encode_tile(LAYER_NAME, features)
+
+
+def _tile_pixel(lon, lat, n, x, y):
+    lat = max(-_MAX_LATITUDE, min(_MAX_LATITUDE, lat))
+    lat_rad = math.radians(lat)
+    tile_x = (lon + 180) / 360 * n
+    tile_y = ((1 - math.log(math.tan(lat_rad) + 1 / math.cos(lat_rad))
+               / math.pi) / 2 * n)
+    return (int(round((tile_x - x) * EXTENT)),
+            int(round((tile_y - y) * EXTENT)))
+
+
+def encode_tile(layer_name, features):
+    """
+    Encode a tile of one layer of point features.
+
+    :param layer_name:
+        The name of the layer.
+    :param features:
+        A list of (id, x, y, attributes) features. The id may be `None`, x and
+        y are tile coordinates (see :data:`EXTENT`), and the attributes are a
+        `dict` of `float` (encoded as doubles) or `int` (encoded as unsigned
+        integers) values.
+    :returns:
+        The tile, as a `str`.
+    """
+    keys = {}
+    values = {}
+    encoded_features = []
+    for feature_id, x, y, attributes in features:
+        tags = []
+        for key, value in sorted(attributes.iteritems()):
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault((type(value), value), len(values)))
+        message = []
+        if feature_id is not None:
+            message.append(_field(1, _VARINT) + _varint(feature_id))
+        message.append(_bytes_field(2, ''.join(_varint(t) for t in tags)))
+        message.append(_field(3, _VARINT) + _varint(_POINT))
+        message.append(_bytes_field(4, ''.join([
+            _varint(_MOVE_TO_ONE), _varint(_zigzag(x)), _varint(_zigzag(y))
+        ])))
+        encoded_features.append(_bytes_field(2, ''.join(message)))
+
+    layer = [_field(15, _VARINT) + _varint(2), _bytes_field(1, layer_name)]
+    layer.extend(encoded_features)
+    for key in sorted(keys, key=keys.get):
+        layer.append(_bytes_field(3, key))
+    for value_type, value in sorted(values, key=values.get):
+        if value_type is float:
+            value = _field(3, _FIXED64) + _DOUBLE.pack(value)
+        else:
+            value = _field(5, _VARINT) + _varint(value)
+        layer.append(_bytes_field(4, value))
+    layer.append(_field(5, _VARINT) + _varint(EXTENT))
+    return _bytes_field(3, ''.join(layer))
+
+
+def _varint(value):
+    data = []
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            data.append(chr(byte | 0x80))
+        else:
+            data.append(chr(byte))
+            return ''.join(data)
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _field(number, wire_type):
+    return _varint((number << 3) | wire_type)
+
+
+def _bytes_field(number, data):
+    return _field(number, _BYTES) + _varint(len(data)) + data
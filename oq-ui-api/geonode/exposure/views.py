@@ -16,14 +16,35 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/agpl.html>.
 
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django.conf import settings
+from django.core.servers.basehttp import FileWrapper
 from django.db import connections
 from django.http import HttpResponse
+from django.http import HttpResponseNotFound
 from django.shortcuts import render_to_response
 from django.template import RequestContext
+from django.utils import simplejson
 from django.views.decorators.http import condition
 
+from exposure import batch
+from exposure import bundles
+from exposure import columnar
+from exposure import compression
 from exposure import forms
+from exposure import gridindex
+from exposure import jobs
+from exposure import metrics
+from exposure import singleflight
+from exposure import tilecache
 from exposure import util
+from exposure import vectortiles
 
 COPYRIGHT_HEADER = """\
  Version 1.0 released on 31.01.2013
@@ -58,6 +79,9 @@ BLDG_ADMIN_0_CSV_HEADER = ('ISO, pop_calculated_value, pop_cell_ID, lon, lat, '
 BLDG_SUBNAT_CSV_HEADER = ('ISO, pop_calculated_value, pop_cell_ID, lon, lat, '
                            'study_region, gadm_level_id, GEM_taxonomy\n')
 
+BLDG_AGGREGATE_CSV_HEADER = ('ISO, gadm_level_id, GEM_taxonomy, '
+                             'pop_calculated_value, lon, lat, pop_cells\n')
+
 POP_CSV_HEADER = ('ISO, population_value, pop_cell_ID, lon, lat\n')
 
 XML_HEADER = "<?xml version='1.0' encoding='utf-8'?> \n"
@@ -90,8 +114,48 @@ NRML_FOOTER = """
 </nrml>
 """
 
-#: The maximum bounding box area which can be exported.
+#: The maximum bounding box area which can be exported. Only used if the
+#: size of the export cannot be estimated (see :func:`_export_admission`).
 MAX_EXPORT_AREA_SQ_DEG = 4  # 2 * 2 degrees, for example
+#: The maximum bounding box area which can be exported by a background export
+#: job (see :mod:`exposure.jobs`). By default, the whole globe. Set it to
+#: `MAX_EXPORT_AREA_SQ_DEG` to disable background exports.
+MAX_ASYNC_EXPORT_AREA_SQ_DEG = getattr(
+    settings, 'EXPOSURE_MAX_ASYNC_EXPORT_AREA_SQ_DEG', 360 * 180
+)
+#: The maximum estimated number of rows which can be exported directly.
+MAX_EXPORT_ROWS = getattr(settings, 'EXPOSURE_MAX_EXPORT_ROWS', 1000000)
+#: The maximum estimated number of rows which can be exported by a background
+#: export job.
+MAX_ASYNC_EXPORT_ROWS = getattr(settings, 'EXPOSURE_MAX_ASYNC_EXPORT_ROWS',
+                                100000000)
+
+#: Number of decimals of the population values of the CSV and NRML exports,
+#: for example 2. `None` keeps the `str` of the values (12 significant
+#: digits), which is slower to produce and longer.
+POPULATION_DECIMALS = getattr(settings, 'EXPOSURE_POPULATION_DECIMALS', None)
+#: Same as :data:`POPULATION_DECIMALS`, for the longitudes and latitudes, for
+#: example 5 (about one metre).
+COORDINATE_DECIMALS = getattr(settings, 'EXPOSURE_COORDINATE_DECIMALS', None)
+
+#: Approximate size (in bytes) of the output for one row of the export
+#: queries, by export and output type. Used to estimate the size of exports.
+_BYTES_PER_ROW = {
+    ('population', 'csv'): 50,
+    ('population', 'nrml'): 200,
+    ('population', 'npz'): 36,
+    ('admin0', 'csv'): 85,
+    ('admin0', 'nrml'): 240,
+    ('admin0', 'npz'): 80,
+    ('subnational', 'csv'): 80,
+    ('subnational', 'nrml'): 210,
+    ('subnational', 'npz'): 56,
+}
+#: Approximate size (in bytes) of each <occupancy> of an admin level 0 NRML
+#: asset.
+_NRML_OCCUPANCY_BYTES = 70
+#: Number of times of day exported, for each 'timeOfDay' selection.
+_TOD_COUNT = {'day': 1, 'night': 1, 'transit': 1, 'all': 3, 'off': 0}
 
 
 @util.allowed_methods(('GET', ))
@@ -103,7 +167,10 @@ def get_exposure_building_form(request):
     lat2 = request.GET['lat2']
     lng2 = request.GET['lng2']
 
-    valid, error = _export_area_valid(lat1, lng1, lat2, lng2)
+    # Areas which are too large for a direct download can still be exported
+    # by a background job (see `validate_export`).
+    valid, error = _export_area_valid(lat1, lng1, lat2, lng2,
+                                      max_area=MAX_ASYNC_EXPORT_AREA_SQ_DEG)
     if not valid:
         return HttpResponse(content=error,
                             content_type="text/html",
@@ -135,7 +202,8 @@ def get_exposure_population_form(request):
     lat2 = request.GET['lat2']
     lng2 = request.GET['lng2']
 
-    valid, error = _export_area_valid(lat1, lng1, lat2, lng2)
+    valid, error = _export_area_valid(lat1, lng1, lat2, lng2,
+                                      max_area=MAX_ASYNC_EXPORT_AREA_SQ_DEG)
     if not valid:
         return HttpResponse(content=error,
                             content_type="text/html",
@@ -152,17 +220,20 @@ def get_exposure_population_form(request):
                               context_instance=RequestContext(request))
 
 
-def _export_area_valid(lat1, lng1, lat2, lng2):
+def _export_area_valid(lat1, lng1, lat2, lng2, max_area=None):
     """
     Simple validation to check the bounding box size.
 
-    If the area is too large, return False and an error message.
+    If the area is larger than `max_area` (by default,
+    `MAX_EXPORT_AREA_SQ_DEG`), return False and an error message.
     Else, (True, '').
     """
+    if max_area is None:
+        max_area = MAX_EXPORT_AREA_SQ_DEG
     width = abs(float(lng2) - float(lng1))
     height = abs(float(lat2) - float(lat1))
     area = width * height
-    if area > MAX_EXPORT_AREA_SQ_DEG:
+    if area > max_area:
         msg = (
             'Bounding box (lat1=%(lat1)s, lng1=%(lng1)s),'
             ' (lat2=%(lat2)s, lng2=%(lng2)s) exceeds the max allowed size.'
@@ -170,34 +241,289 @@ def _export_area_valid(lat1, lng1, lat2, lng2):
             '<br />Max allowed selection area: %(max_area)s square degrees.'
         )
         msg %= dict(lat1=lat1, lng1=lng1, lat2=lat2, lng2=lng2,
-                    area=area, max_area=MAX_EXPORT_AREA_SQ_DEG)
+                    area=area, max_area=max_area)
         return False, msg
     return True, ''
 
 
-def validate_export(request):
+def _get_occupancy(res_select):
     """
-    Check that the given export parameters are okay, and if the export should
-    be allowed.
+    :param str res_select:
+        'res', 'non-res', or 'both'
+    :returns:
+        The list of occupancies for the export queries: [0] (residential),
+        [1] (non-residential), or [0, 1].
+    """
+    if res_select == 'res':
+        return [0]
+    elif res_select == 'non-res':
+        return [1]
+    elif res_select == 'both':
+        return [0, 1]
+    else:
+        msg = ("Invalid 'residential' selection: '%s'."
+               " Expected 'res', 'non-res', or 'both'."
+               % res_select)
+        raise ValueError(msg)
+
 
-    At the moment, we just check that the selected area is not too large to
-    export. If the area is too large, throw back a 403 response (forbidden).
-    Otherwise, return a 200 (OK).
+def _get_export_area(params):
     """
-    lat1 = request.GET['lat1']
-    lng1 = request.GET['lng1']
-    lat2 = request.GET['lat2']
-    lng2 = request.GET['lng2']
+    :param params:
+        The parameters of the export view, as a `dict`.
+    :returns:
+        The polygon ('polygon' parameter, WKT or GeoJSON) or the GADM region
+        ('regionLevel', by default 'admin0', and 'regionId' parameters) to
+        export, or `None` to export the bounding box. See
+        :func:`exposure.util._spatial_filter`.
+    :raises ValueError:
+        If the polygon or the region is not valid.
+    """
+    if params.get('polygon'):
+        return util.parse_polygon(params['polygon'])
+    if params.get('regionId'):
+        return util.region_area(params.get('regionLevel', 'admin0'),
+                                params['regionId'])
+    return None
 
-    valid, error = _export_area_valid(lat1, lng1, lat2, lng2)
-    if not valid:
+
+def _get_taxonomy(params):
+    """
+    :param params:
+        The parameters of the export view, as a `dict`.
+    :returns:
+        The taxonomy prefixes of the building types to export ('taxonomy'
+        parameter, see :func:`exposure.util.parse_taxonomy`), or `None` to
+        export all of them.
+    :raises ValueError:
+        If the taxonomy filter is not valid.
+    """
+    if 'taxonomy' in params:
+        return util.parse_taxonomy(params['taxonomy'])
+    return None
+
+
+def _get_export_order(params):
+    """
+    :param params:
+        The parameters of the export view, as a `dict`.
+    :returns:
+        The order of the exported rows ('order' parameter, one of
+        :data:`exposure.util.EXPORT_ORDERS`), 'id' by default.
+    :raises ValueError:
+        If the order is not valid.
+    """
+    order = params.get('order', 'id')
+    if order not in util.EXPORT_ORDERS:
+        raise ValueError("Invalid 'order' selection: '%s'. Expected %s."
+                         % (order, ' or '.join("'%s'" % name for name
+                                               in util.EXPORT_ORDERS)))
+    return order
+
+
+def _get_compression(params):
+    """
+    :param params:
+        The parameters of the export view, as a `dict`.
+    :returns:
+        The compression of the export ('compress' parameter): 'zip', or `None`
+        if the export is not wrapped in an archive.
+    :raises ValueError:
+        If the compression is not supported.
+    """
+    compress = params.get('compress') or None
+    if compress not in (None, 'zip'):
+        raise ValueError(
+            "Unrecognized compression '%s', only 'zip' is supported"
+            % compress
+        )
+    return compress
+
+
+def _get_export_bbox(params, area):
+    """
+    :returns:
+        The bounding box (lng1, lat1, lng2, lat2) of an export: the one given
+        in `params`, or the extent of its `area` (see
+        :func:`_get_export_area`).
+    :raises ValueError:
+        If the area is a region without exposure data.
+    """
+    if area is None:
+        return params['lng1'], params['lat1'], params['lng2'], params['lat2']
+    extent = util.area_extent(area)
+    if extent is None:
+        raise ValueError('The selected region has no exposure data')
+    return extent
+
+
+def _estimate_export(params, export_type, bbox):
+    """
+    Estimate the size of an export, from the precomputed row counts (see
+    :func:`exposure.util._estimate_export_rows`).
+
+    Polygon and region exports are estimated on their bounding box, which
+    overestimates them.
+
+    :param params:
+        The parameters of the export view, as a `dict`.
+    :param str export_type:
+        'building' or 'population'.
+    :param bbox:
+        The bounding box of the export (see :func:`_get_export_bbox`).
+    :returns:
+        A `dict` with the estimated number of 'rows' and size in 'bytes'
+        (`None` if the output type is not known), or `None` if the export
+        cannot be estimated.
+    """
+    lng1, lat1, lng2, lat2 = bbox
+    output_type = params.get('outputType')
+
+    if export_type == 'population':
+        export = 'population'
+        occupancy = None
+        size_key = ('population', output_type)
+    else:
+        export = params.get('adminLevel')
+        if export not in ('admin0', 'admin1', 'admin2', 'admin3'):
+            return None
+        # Without a selection, estimate the largest export.
+        occupancy = _get_occupancy(params.get('residential', 'both'))
+        size_key = ('admin0' if export == 'admin0' else 'subnational',
+                    output_type)
+
+    rows = util._estimate_export_rows(export, lng1, lat1, lng2, lat2,
+                                      occupancy=occupancy)
+    if rows is None:
+        return None
+
+    row_size = _BYTES_PER_ROW.get(size_key)
+    if row_size is not None and export == 'admin0':
+        # Admin level 0 exports have a CSV row, or a NRML <occupancy>, for
+        # each time of day.
+        tod_count = _TOD_COUNT.get(params.get('timeOfDay'), 0)
+        if output_type == 'csv':
+            row_size *= max(tod_count, 1)
+        elif output_type == 'nrml':
+            row_size += tod_count * _NRML_OCCUPANCY_BYTES
+
+    return dict(rows=rows,
+                bytes=rows * row_size if row_size is not None else None)
+
+
+def _export_admission(params, export_type, background=True):
+    """
+    Decide if an export should be allowed.
+
+    The decision is based on the estimated number of rows of the export
+    (see :func:`_estimate_export`), so that a small area with a lot of
+    exposure data can be refused while a large but sparse one is allowed. If
+    the export cannot be estimated, only the bounding box area is checked.
+
+    :param params:
+        The parameters of the export view, as a `dict`.
+    :param str export_type:
+        'building' or 'population'.
+    :param bool background:
+        `True` if the export may be run as a background job.
+    :returns:
+        A triple of the HTTP status (200 if the export can be run directly,
+        202 if it can be run as a background job, 403 otherwise), an error
+        message (empty unless the status is 403) and the estimate (or `None`).
+    """
+    try:
+        bbox = _get_export_bbox(params, _get_export_area(params))
+        _get_taxonomy(params)
+        _get_export_order(params)
+        _get_compression(params)
+        if export_type == 'building':
+            _get_occupancy(params.get('residential', 'both'))
+    except ValueError as e:
+        return 403, str(e), None
+    lng1, lat1, lng2, lat2 = bbox
+
+    if params.get('aggregate'):
+        # Aggregated exports are small whatever the area, so they are run
+        # directly up to the area limit of background exports.
+        valid, error = _export_area_valid(
+            lat1, lng1, lat2, lng2, max_area=MAX_ASYNC_EXPORT_AREA_SQ_DEG
+        )
+        if valid:
+            return 200, '', None
+        return 403, error, None
+
+    estimate = _estimate_export(params, export_type, bbox)
+    if estimate is None:
+        valid, error = _export_area_valid(lat1, lng1, lat2, lng2)
+        if valid:
+            return 200, '', None
+        if background:
+            valid, error = _export_area_valid(
+                lat1, lng1, lat2, lng2, max_area=MAX_ASYNC_EXPORT_AREA_SQ_DEG
+            )
+            if valid:
+                return 202, '', None
+        return 403, error, None
+
+    rows = estimate['rows']
+    if rows <= MAX_EXPORT_ROWS:
+        return 200, '', estimate
+    max_rows = MAX_EXPORT_ROWS
+    if background:
+        if rows <= MAX_ASYNC_EXPORT_ROWS:
+            return 202, '', estimate
+        max_rows = MAX_ASYNC_EXPORT_ROWS
+    msg = (
+        'Bounding box (lat1=%(lat1)s, lng1=%(lng1)s),'
+        ' (lat2=%(lat2)s, lng2=%(lng2)s) contains too much exposure data.'
+        '<br />Estimated number of rows: %(rows)s.'
+        '<br />Max allowed number of rows: %(max_rows)s.'
+    )
+    msg %= dict(lat1=lat1, lng1=lng1, lat2=lat2, lng2=lng2, rows=rows,
+                max_rows=max_rows)
+    return 403, msg, estimate
+
+
+def validate_export(request):
+    """
+    Check that the given export parameters are okay, and if the export should
+    be allowed (see :func:`_export_admission`).
+
+    The 'exportType' parameter ('building' or 'population') selects the
+    export to validate; if it is not given, it is 'building' if an
+    'adminLevel' or an 'aggregate' level is given, 'population' otherwise.
+
+    If the export is small enough to be exported directly, return a 200
+    (OK). If it is too large for that, but can be exported by a background
+    job (see :func:`submit_export_job`), return a 202 (Accepted). Both
+    responses are a JSON object, with a 'message', and the estimated number
+    of 'rows' and size in 'bytes' of the export (`null` if unknown).
+    Otherwise, throw back a 403 response (forbidden).
+    """
+    params = dict(request.GET.items())
+    export_type = params.get('exportType')
+    if export_type is None:
+        export_type = ('building'
+                       if 'adminLevel' in params or 'aggregate' in params
+                       else 'population')
+
+    status, error, estimate = _export_admission(params, export_type)
+    if status == 403:
         return HttpResponse(content=error,
                             content_type="text/html",
                             status=403)
+
+    if status == 202:
+        message = ('Export is allowed with the given parameters, as a '
+                   'background export job')
     else:
-        return HttpResponse(
-            content='Export is allowed with the given parameters'
-        )
+        message = 'Export is allowed with the given parameters'
+    result = dict(message=message, rows=None, bytes=None)
+    if estimate is not None:
+        result.update(estimate)
+    return HttpResponse(content=simplejson.dumps(result),
+                        content_type='application/json',
+                        status=status)
 
 
 @condition(etag_func=None)
@@ -211,45 +537,207 @@ def export_building(request):
         A "GET" :class:`django.http.HttpRequest` object containing the
         following parameters::
 
-            * 'outputType' ('csv' or 'nrml')
+            * 'outputType' ('csv', 'nrml' or 'npz')
             * 'timeOfDay' ('day', 'night', 'transit', 'all', 'off')
             * 'adminLevel' ('admin0', 'admin1', 'admin2', or 'admin3')
             * 'lng1'
             * 'lat1'
             * 'lng2'
             * 'lat2'
+            * 'polygon' (optional, a WKT or GeoJSON polygon)
+            * 'regionLevel' and 'regionId' (optional, a GADM region)
+            * 'aggregate' (optional, 'admin1', 'admin2', or 'admin3')
+            * 'taxonomy' (optional, comma separated GEM taxonomy prefixes)
+            * 'order' (optional, 'id' or 'spatial')
+            * 'compress' (optional, 'zip')
+
+        A 'polygon' or a 'regionId' is exported instead of the bounding box
+        (see :func:`_get_export_area`). Whole-country exports may be served
+        from pre-generated bundles (see :mod:`exposure.bundles`).
+
+        With 'aggregate', one 'csv' or 'nrml' row is exported for each region
+        of that admin level and building type, instead of one for each grid
+        point (see :func:`_stream_aggregated_exposure`); 'adminLevel' and
+        'timeOfDay' are not needed.
+
+        With 'taxonomy', only the building types starting with one of the
+        given taxonomy strings are exported (see
+        :func:`exposure.util.parse_taxonomy`).
+
+        Rows are ordered by grid point id, or with 'order=spatial', along a
+        Hilbert curve, which reads the clustered exposure tables
+        sequentially (see :func:`exposure.util._build_hilbert_keys`).
+        Aggregated exports are always ordered by region.
+
+        Unless 'compress' is given, the response is gzip-compressed if the
+        client accepts it. See :func:`_export_response`.
     """
-    lng1 = request.GET['lng1']
-    lat1 = request.GET['lat1']
-    lng2 = request.GET['lng2']
-    lat2 = request.GET['lat2']
+    bundle = bundles.find(request.GET)
+    if (bundle is not None and not request.GET.get('compress')
+            and _accepts_gzip(request)):
+        response = _bundle_response(bundle)
+        if response is not None:
+            return response
+
+    status, error, _ = _export_admission(dict(request.GET.items()),
+                                         'building', background=False)
+    if status != 200:
+        return HttpResponse(content=error,
+                            content_type="text/html",
+                            status=403)
 
-    valid, error = _export_area_valid(lat1, lng1, lat2, lng2)
-    if not valid:
+    output_type = request.GET['outputType']
+    mimetype, filename = _output_type_info(output_type)
+
+    # Identical exports running at the same time are run once.
+    response_data = metrics.instrument(
+        'building', request.GET,
+        singleflight.stream(
+            singleflight.export_key('building', request.GET),
+            lambda: util.coalesce(
+                _stream_building_exposure(request, output_type)
+            )
+        )
+    )
+    return _export_response(request, response_data, mimetype, filename,
+                            compressible=(output_type != 'npz'))
+
+
+@condition(etag_func=None)
+@util.allowed_methods(('GET', ))
+@util.sign_in_required
+def export_building_batch(request):
+    """
+    Perform a streaming export of the building exposure of several areas, as
+    a zip archive with one file for each area.
+
+    :param request:
+        A "GET" :class:`django.http.HttpRequest` object with the parameters
+        of :func:`export_building`, except for the bounding box, 'polygon',
+        'regionLevel', 'regionId', 'aggregate' and 'compress', and with::
+
+            * 'areas' (a JSON list of bounding boxes and polygons, see
+              :func:`exposure.batch.parse_areas`)
+
+        All of the areas are read with a single query, so the grid points
+        where they overlap are read once. Each area must be allowed on its
+        own (see :func:`_batch_admission`).
+    """
+    status, error, area = _batch_admission(dict(request.GET.items()))
+    if status != 200:
         return HttpResponse(content=error,
                             content_type="text/html",
                             status=403)
 
+    response = HttpResponse(
+        metrics.instrument(
+            'building', request.GET,
+            compression.zip_stream(_stream_building_batch(request, area))
+        ),
+        mimetype='application/zip'
+    )
+    response['Content-Disposition'] = ('attachment; '
+                                       'filename="exposure_export.zip"')
+    return response
+
+
+def _batch_admission(params):
+    """
+    Decide if a batch export should be allowed: each of its areas must be
+    allowed as a direct export of its bounding box (see
+    :func:`_export_admission`), and the estimated number of rows of all of
+    the areas must not exceed :data:`MAX_EXPORT_ROWS`. Overlapping areas
+    are estimated separately, so the total is an upper bound.
+
+    :param params:
+        The parameters of the batch export view, as a `dict`.
+    :returns:
+        A triple of the HTTP status (200 or 403), an error message (empty
+        unless the status is 403) and the batch area (see
+        :func:`exposure.batch.parse_areas`).
+    """
+    if params.get('aggregate'):
+        return 403, 'Batch exports cannot be aggregated', None
+    try:
+        area = batch.parse_areas(params.get('areas', ''))
+    except ValueError as e:
+        return 403, str(e), None
+
+    area_params = dict(params)
+    for name in ('polygon', 'regionLevel', 'regionId'):
+        area_params.pop(name, None)
+    rows = 0
+    for member in area[1]:
+        (area_params['lng1'], area_params['lat1'],
+         area_params['lng2'], area_params['lat2']) = member[2]
+        status, error, estimate = _export_admission(area_params, 'building',
+                                                    background=False)
+        if status != 200:
+            return 403, error, None
+        if estimate is not None:
+            rows += estimate['rows']
+    if rows > MAX_EXPORT_ROWS:
+        msg = (
+            'The export areas contain too much exposure data.'
+            '<br />Estimated number of rows: %(rows)s.'
+            '<br />Max allowed number of rows: %(max_rows)s.'
+        )
+        return 403, msg % dict(rows=rows, max_rows=MAX_EXPORT_ROWS), None
+    return 200, '', area
+
+
+def _stream_building_batch(request, area):
+    """
+    Stream the building exposure of the areas of a batch export.
+
+    :param request:
+        A :class:`django.http.request.HttpRequest` object.
+    :param area:
+        The area of the batch, as returned by
+        :func:`exposure.batch.parse_areas`.
+    :returns:
+        An iterator over the (file name, iterable of strings) pairs of each
+        area, to be written to a zip archive one after the other (see
+        :func:`exposure.batch.split`).
+    """
     output_type = request.GET['outputType']
-    content_disp = None
-    mimetype = None
+    tod_select = request.GET['timeOfDay']
+    admin_select = request.GET['adminLevel']
+    occupancy = _get_occupancy(request.GET['residential'])
+    taxonomy = _get_taxonomy(request.GET)
+    order = _get_export_order(request.GET)
+    _, filename = _output_type_info(output_type)
 
-    if output_type == "csv":
-        content_disp = 'attachment; filename="exposure_export.csv"'
-        mimetype = 'text/csv'
-    elif output_type == "nrml":
-        content_disp = 'attachment; filename="exposure_export.xml"'
-        mimetype = 'text/plain'
+    if admin_select == 'admin0':
+        exposure_data = util._get_national_exposure(
+            None, None, None, None, tod_select, occupancy,
+            taxonomy=taxonomy, area=area, order=order
+        )
+        generators = dict(csv=_bldg_csv_admin0_generator,
+                          nrml=_bldg_nrml_admin0_generator,
+                          npz=columnar.bldg_admin0_generator)
+    elif admin_select in ('admin1', 'admin2', 'admin3'):
+        exposure_data = util._get_subnational_exposure(
+            None, None, None, None, occupancy, admin_select,
+            taxonomy=taxonomy, area=area, order=order
+        )
+        generators = dict(csv=_bldg_csv_subnat_generator,
+                          nrml=_bldg_nrml_subnat_generator,
+                          npz=columnar.bldg_subnat_generator)
     else:
-        raise ValueError(
-            "Unrecognized output type '%s', only 'nrml' and 'csv' are "
-            "supported" % output_type
+        msg = (
+            "Invalid 'adminLevel' selection: '%s'."
+            " Expected 'admin0', 'admin1', 'admin2', or 'admin3'."
+            % admin_select
         )
+        raise ValueError(msg)
 
-    response_data = _stream_building_exposure(request, output_type)
-    response = HttpResponse(response_data, mimetype=mimetype)
-    response['Content-Disposition'] = content_disp
-    return response
+    name, extension = filename.rsplit('.', 1)
+    generator = generators[output_type]
+    area_data = batch.split(exposure_data, len(area[1]))
+    for i, rows in enumerate(area_data):
+        yield ('%s_%d.%s' % (name, i + 1, extension),
+               util.coalesce(generator(rows)))
 
 
 @condition(etag_func=None)
@@ -263,45 +751,328 @@ def export_population(request):
         A "GET" :class:`django.http.HttpRequest` object containing the
         following parameters::
 
-            * 'outputType' ('csv' or 'nrml')
+            * 'outputType' ('csv', 'nrml' or 'npz')
             * 'lng1'
             * 'lat1'
             * 'lng2'
             * 'lat2'
-    """
-    lng1 = request.GET['lng1']
-    lat1 = request.GET['lat1']
-    lng2 = request.GET['lng2']
-    lat2 = request.GET['lat2']
+            * 'polygon' (optional, a WKT or GeoJSON polygon)
+            * 'regionLevel' and 'regionId' (optional, a GADM region)
+            * 'compress' (optional, 'zip')
 
-    valid, error = _export_area_valid(lat1, lng1, lat2, lng2)
-    if not valid:
+        A 'polygon' or a 'regionId' is exported instead of the bounding box
+        (see :func:`_get_export_area`).
+
+        Unless 'compress' is given, the response is gzip-compressed if the
+        client accepts it. See :func:`_export_response`.
+    """
+    status, error, _ = _export_admission(dict(request.GET.items()),
+                                         'population', background=False)
+    if status != 200:
         return HttpResponse(content=error,
                             content_type="text/html",
                             status=403)
 
     output_type = request.GET['outputType']
-    content_disp = None
-    mimetype = None
+    mimetype, filename = _output_type_info(output_type)
+
+    # Identical exports running at the same time are run once.
+    response_data = metrics.instrument(
+        'population', request.GET,
+        singleflight.stream(
+            singleflight.export_key('population', request.GET),
+            lambda: util.coalesce(
+                _stream_population_exposure(request, output_type)
+            )
+        )
+    )
+    return _export_response(request, response_data, mimetype, filename,
+                            compressible=(output_type != 'npz'))
+
+
+def _accepts_gzip(request):
+    """
+    Check the 'Accept-Encoding' header of a request for gzip support.
+    """
+    accept = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    for coding in accept.split(','):
+        parts = [p.strip() for p in coding.split(';')]
+        if parts[0].lower() in ('gzip', 'x-gzip'):
+            # 'gzip;q=0' means that gzip is *not* acceptable
+            for param in parts[1:]:
+                if param.replace(' ', '').startswith('q='):
+                    try:
+                        return float(param.split('=', 1)[1]) > 0
+                    except ValueError:
+                        return False
+            return True
+    return False
+
+
+def _export_response(request, chunks, mimetype, filename, compressible=True):
+    """
+    Build the streaming response of an export, compressing it on the fly if
+    requested.
+
+    If the 'compress' GET parameter is 'zip', the export is wrapped in a zip
+    archive. Otherwise, if the client accepts it, the response is sent with
+    a gzip 'Content-Encoding'.
+
+    :param chunks:
+        An iterable of strings; the export content.
+    :param bool compressible:
+        `False` if the content is already compressed, and is not worth
+        gzipping.
+    """
+    if _get_compression(request.GET) == 'zip':
+        response = HttpResponse(
+            compression.zip_stream([(filename, chunks)]),
+            mimetype='application/zip'
+        )
+        filename = '%s.zip' % filename
+    elif compressible and _accepts_gzip(request):
+        response = HttpResponse(compression.gzip_stream(chunks),
+                                mimetype=mimetype)
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(chunks, mimetype=mimetype)
+
+    response['Vary'] = 'Accept-Encoding'
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
+
+
+def _bundle_response(bundle):
+    """
+    Build the response of an export served from a bundle (see
+    :mod:`exposure.bundles`), with a gzip 'Content-Encoding'. The file is
+    sent by nginx if :data:`exposure.bundles.BUNDLE_ACCEL_REDIRECT` is set.
+
+    :param bundle:
+        The path of the bundle, as returned by :func:`bundles.find`.
+    :returns:
+        The response, or `None` if the bundle was deleted in the meantime
+        (for example, while the bundles are rebuilt).
+    """
+    mimetype, filename = _output_type_info(
+        'csv' if bundle.endswith('.csv.gz') else 'nrml'
+    )
+    if bundles.BUNDLE_ACCEL_REDIRECT:
+        response = HttpResponse(mimetype=mimetype)
+        response['X-Accel-Redirect'] = bundles.BUNDLE_URL + bundle
+    else:
+        try:
+            fh = open(os.path.join(bundles.BUNDLE_DIR, bundle), 'rb')
+        except IOError:
+            return None
+        response = HttpResponse(FileWrapper(fh), mimetype=mimetype)
+        response['Content-Length'] = os.fstat(fh.fileno()).st_size
+        response['Content-Encoding'] = 'gzip'
+        response['Vary'] = 'Accept-Encoding'
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
+
+
+if columnar.available():
+    _SUPPORTED_OUTPUT_TYPES_MSG = "'nrml', 'csv' and 'npz'"
+else:
+    _SUPPORTED_OUTPUT_TYPES_MSG = "'nrml' and 'csv'"
 
+
+def _output_type_info(output_type):
+    """
+    :returns:
+        A pair of the mimetype and file name of an export of the given
+        `output_type`.
+    """
     if output_type == "csv":
-        content_disp = 'attachment; filename="exposure_export.csv"'
-        mimetype = 'text/csv'
+        return 'text/csv', 'exposure_export.csv'
     elif output_type == "nrml":
-        content_disp = 'attachment; filename="exposure_export.xml"'
-        mimetype = 'text/plain'
+        return 'text/plain', 'exposure_export.xml'
+    elif output_type == "npz" and columnar.available():
+        return 'application/octet-stream', 'exposure_export.npz'
+    else:
+        raise ValueError(
+            "Unrecognized output type '%s', only %s are supported"
+            % (output_type, _SUPPORTED_OUTPUT_TYPES_MSG)
+        )
+
+
+@util.allowed_methods(('POST', ))
+@util.sign_in_required
+def submit_export_job(request):
+    """
+    Submit an export to be run in the background, for areas which are too
+    large to be exported directly by :func:`export_building` or
+    :func:`export_population`.
+
+    :param request:
+        A "POST" :class:`django.http.HttpRequest` object containing an
+        'exportType' parameter ('building' or 'population'), plus all of the
+        parameters of the matching export view.
+    :returns:
+        A 202 (Accepted) response, with a JSON object containing the
+        'job_id' of the new job. Use it to poll :func:`export_job_status`.
+    """
+    params = dict(request.POST.items())
+
+    export_type = params['exportType']
+    if export_type == 'building':
+        stream_func = _stream_building_exposure
+    elif export_type == 'population':
+        stream_func = _stream_population_exposure
     else:
         raise ValueError(
-            "Unrecognized output type '%s', only 'nrml' and 'csv' are "
-            "supported" % output_type
+            "Unrecognized export type '%s', only 'building' and 'population' "
+            "are supported" % export_type
         )
 
-    response_data = _stream_population_exposure(request, output_type)
-    response = HttpResponse(response_data, mimetype=mimetype)
-    response['Content-Disposition'] = content_disp
+    status, error, estimate = _export_admission(params, export_type)
+    if status == 403:
+        return HttpResponse(content=error,
+                            content_type="text/html",
+                            status=403)
+    output_type = params['outputType']
+    mimetype, filename = _output_type_info(output_type)
+
+    job_id = jobs.submit(request.user.username, stream_func, params,
+                         output_type, mimetype, filename,
+                         estimated_rows=estimate and estimate['rows'])
+    return HttpResponse(content=simplejson.dumps(dict(job_id=job_id)),
+                        content_type='application/json',
+                        status=202)
+
+
+def _get_user_job_status(request):
+    """
+    :returns:
+        The status of the job given in the 'job_id' GET parameter, or `None`
+        if there is no such job, or if it belongs to a different user.
+    """
+    status = jobs.get_status(request.GET.get('job_id'))
+    if status is None or status['user'] != request.user.username:
+        return None
+    return status
+
+
+@util.allowed_methods(('GET', ))
+@util.sign_in_required
+def export_job_status(request):
+    """
+    Get the status of a background export job, as JSON.
+
+    The 'status' is one of 'queued', 'running', 'complete' or 'failed'.
+    'bytes' is the amount of data exported so far, and 'rows' the number of
+    rows, to compare with the 'estimated_rows' of the export (`null` if
+    unknown). A failed job also has an 'error' message.
+    """
+    status = _get_user_job_status(request)
+    if status is None:
+        return HttpResponseNotFound()
+
+    result = dict((k, status.get(k))
+                  for k in ('status', 'bytes', 'rows', 'estimated_rows',
+                            'error'))
+    return HttpResponse(content=simplejson.dumps(result),
+                        content_type='application/json')
+
+
+@util.allowed_methods(('GET', ))
+@util.sign_in_required
+def export_metrics(request):
+    """
+    Get the export statistics of this web worker process, as JSON (see
+    :func:`exposure.metrics.snapshot`). Only available to staff users.
+    """
+    if not request.user.is_staff:
+        return HttpResponse(status=403)
+    return HttpResponse(content=simplejson.dumps(metrics.snapshot()),
+                        content_type='application/json')
+
+
+@util.allowed_methods(('GET', ))
+@util.sign_in_required
+def population_total(request):
+    """
+    Get the total population of a bounding box ('lng1', 'lat1', 'lng2' and
+    'lat2' parameters), as a JSON object with the 'population' and the
+    number of populated 'grid_points'. See
+    :func:`exposure.util.population_total`.
+    """
+    total = util.population_total(request.GET['lng1'], request.GET['lat1'],
+                                  request.GET['lng2'], request.GET['lat2'])
+    return HttpResponse(content=simplejson.dumps(total),
+                        content_type='application/json')
+
+
+@util.allowed_methods(('GET', ))
+@util.sign_in_required
+def population_tile(request, z, x, y):
+    """
+    Get a Mapbox Vector Tile of the population of the GED grid points (see
+    :mod:`exposure.vectortiles`).
+    """
+    z, x, y = int(z), int(x), int(y)
+    if not vectortiles.valid_tile(z, x, y):
+        return HttpResponseNotFound()
+    return HttpResponse(content=vectortiles.get_tile(z, x, y),
+                        content_type='application/vnd.mapbox-vector-tile')
+
+
+@util.allowed_methods(('GET', ))
+@util.sign_in_required
+def download_export_job(request):
+    """
+    Download the result of a complete background export job.
+    """
+    status = _get_user_job_status(request)
+    if status is None or status['status'] != jobs.COMPLETE:
+        return HttpResponseNotFound()
+
+    result = open(jobs.result_path(request.GET['job_id']), 'rb')
+    response = HttpResponse(FileWrapper(result), mimetype=status['mimetype'])
+    response['Content-Disposition'] = (
+        'attachment; filename="%s"' % status['filename']
+    )
     return response
 
 
+def _number_formats():
+    """
+    :returns:
+        The %-formats of the population values and of the coordinates of the
+        exports (see :data:`POPULATION_DECIMALS` and
+        :data:`COORDINATE_DECIMALS`).
+    """
+    return (util.number_format(POPULATION_DECIMALS),
+            util.number_format(COORDINATE_DECIMALS))
+
+
+def _nrml_asset_template(gml_id='%s_%s', pop=None, occ=None):
+    """
+    Build a positional version of :data:`NRML_ASSET_FMT`, with the number
+    formats of the exports. Its arguments are the parts of the asset id, the
+    population, the building type, the longitude and the latitude.
+
+    :param gml_id:
+        The format of the asset id.
+    :param pop:
+        The format of the population. Defaults to the one of the exports.
+    :param occ:
+        The format of the occupancies of the assets, if any. The template
+        is then a positional version of :data:`NRML_ASSET_ADMIN_0_FMT`,
+        with the arguments of `occ` last.
+    """
+    pop_fmt, coord_fmt = _number_formats()
+    if pop is None:
+        pop = pop_fmt
+    params = dict(gml_id=gml_id, pop=pop, tax='%s', lon=coord_fmt,
+                  lat=coord_fmt)
+    if occ is None:
+        return NRML_ASSET_FMT % params
+    return NRML_ASSET_ADMIN_0_FMT % dict(params, occ=occ)
+
+
 def _bldg_csv_admin0_generator(exposure_data):
     """
     Helper function for generating admin level 0 CSV data for building
@@ -311,6 +1082,9 @@ def _bldg_csv_admin0_generator(exposure_data):
     yield copyright
     yield BLDG_ADMIN_0_CSV_HEADER
 
+    pop_fmt, coord_fmt = _number_formats()
+    row_fmt = '%%s,%s,%%s,%s,%s,%%s,%%s,%%s,%%s\n' % (pop_fmt, coord_fmt,
+                                                      coord_fmt)
     for (grid_id, lon, lat, pop_value, country_id, iso,
              study_region_id, building_type, dwelling_fraction,
              day_pop_ratio, night_pop_ratio,
@@ -319,32 +1093,48 @@ def _bldg_csv_admin0_generator(exposure_data):
         if all([x is None for x in (day_pop_ratio,
                                     night_pop_ratio,
                                     transit_pop_ratio)]):
-            row = [iso, pop_value, grid_id, lon, lat,
-                   study_region_id, country_id, building_type, '']
-            row = [str(x) for x in row]
-            yield '%s\n' % ','.join(row)
+            yield row_fmt % (iso, pop_value, grid_id, lon, lat,
+                             study_region_id, country_id, building_type, '')
         else:
             for tod, pop_ratio in (('day', day_pop_ratio),
                                    ('night', night_pop_ratio),
                                    ('transit', transit_pop_ratio)):
                 if pop_ratio is not None:
                     calc_pop_value = pop_value * dwelling_fraction * pop_ratio
-                    row = [iso, calc_pop_value, grid_id, lon, lat,
-                           study_region_id, country_id, building_type, tod]
-                    row = [str(x) for x in row]
-                    yield '%s\n' % ','.join(row)
+                    yield row_fmt % (iso, calc_pop_value, grid_id, lon, lat,
+                                     study_region_id, country_id,
+                                     building_type, tod)
 
 
 def _bldg_nrml_admin0_generator(exposure_data):
     """
     Helper function for generating admin level 0 NRML data for building
     exposure.
+
+    Assets are formatted a block of rows at a time (see
+    :func:`_bldg_nrml_admin0_block`).
     """
     yield XML_HEADER
     copyright = copyright_nrml(COPYRIGHT_HEADER)
     yield copyright
     yield NRML_HEADER % dict(cat='buildings')
 
+    for rows in util.batches(exposure_data, util.EXPORT_FETCH_SIZE):
+        yield _bldg_nrml_admin0_block(rows)
+    # finalize the document:
+    yield NRML_FOOTER
+
+
+def _bldg_nrml_admin0_assets(exposure_data):
+    """
+    Generate the admin level 0 NRML assets of building exposure rows, one at
+    a time.
+    """
+    asset_fmt = _nrml_asset_template()
+    occ_asset_fmt = _nrml_asset_template(occ='%s')
+    pop_fmt, _ = _number_formats()
+    occupancy_fmts = dict((tod, OCCUPANCY_FMT % (pop_fmt, tod))
+                          for tod in ('day', 'night', 'transit'))
     for (grid_id, lon, lat, pop_value, country_id, iso,
              study_region_id, building_type, dwelling_fraction,
              day_pop_ratio, night_pop_ratio,
@@ -353,15 +1143,8 @@ def _bldg_nrml_admin0_generator(exposure_data):
         if all([x is None for x in (day_pop_ratio,
                                     night_pop_ratio,
                                     transit_pop_ratio)]):
-            asset_params = dict(
-                gml_id='%s_%s' % (grid_id, building_type),
-                lon=lon,
-                lat=lat,
-                pop=pop_value,
-                tax=building_type,
-            )
-            asset = NRML_ASSET_FMT % asset_params
-            yield '%s' % asset
+            yield asset_fmt % (grid_id, building_type, pop_value,
+                               building_type, lon, lat)
         else:
             occ = ''
             for tod, pop_ratio in (('day', day_pop_ratio),
@@ -369,20 +1152,91 @@ def _bldg_nrml_admin0_generator(exposure_data):
                                    ('transit', transit_pop_ratio)):
                 if pop_ratio is not None:
                     calc_pop_value = pop_value * dwelling_fraction * pop_ratio
-                    occ += OCCUPANCY_FMT % (calc_pop_value, tod)
-
-            asset_params = dict(
-                gml_id='%s_%s' % (grid_id, building_type),
-                lon=lon,
-                lat=lat,
-                pop=calc_pop_value,
-                tax=building_type,
-                occ=occ,
-            )
-            asset = NRML_ASSET_ADMIN_0_FMT % asset_params
-            yield '%s' % asset
-    # finalize the document:
-    yield NRML_FOOTER
+                    occ += occupancy_fmts[tod] % calc_pop_value
+
+            # The asset number is the one of the last time of day.
+            yield occ_asset_fmt % (grid_id, building_type, calc_pop_value,
+                                   building_type, lon, lat, occ)
+
+
+def _vectorizable(pop_values, factors):
+    """
+    Check if products of the population values and other factors can be
+    computed with NumPy, giving the same values (and so the same text) as
+    in Python.
+
+    That is the case if all the factors are floats, and the population
+    values are floats or integers: the Python products are floats, computed
+    in the same order with the same double precision arithmetic.
+    """
+    if numpy is None:
+        return False
+    for value in pop_values:
+        if type(value) not in (float, int):
+            return False
+    for column in factors:
+        for value in column:
+            if value is not None and type(value) is not float:
+                return False
+    return True
+
+
+def _bldg_nrml_admin0_block(rows):
+    """
+    Format a block of admin level 0 building exposure rows as NRML assets.
+
+    Times of day are usually either requested, and available, for all of
+    the rows, or for none of them. In that case, the population of each
+    time of day is computed for the whole block at once with NumPy, and all
+    of the assets are formatted with the same template, occupancies
+    included. Otherwise, or if the block holds values for which NumPy could
+    give different results than Python (see :func:`_vectorizable`), the
+    assets are formatted one at a time. The output is the same either way.
+    """
+    (grid_ids, lons, lats, pop_values, _, _, _, building_types,
+     dwelling_fractions, days, nights, transits) = zip(*rows)
+
+    tods = []
+    for tod, ratios in (('day', days), ('night', nights),
+                        ('transit', transits)):
+        present = [ratio is not None for ratio in ratios]
+        if all(present):
+            tods.append((tod, ratios))
+        elif any(present):
+            # Some ratios are missing: no common template.
+            return ''.join(_bldg_nrml_admin0_assets(rows))
+
+    if not tods:
+        template = _nrml_asset_template()
+        return ''.join([
+            template % args
+            for args in zip(grid_ids, building_types, pop_values,
+                            building_types, lons, lats)
+        ])
+
+    if not _vectorizable(pop_values,
+                         [dwelling_fractions] + [r for _, r in tods]):
+        return ''.join(_bldg_nrml_admin0_assets(rows))
+
+    population = (numpy.array(pop_values, dtype=numpy.float64)
+                  * numpy.array(dwelling_fractions, dtype=numpy.float64))
+    # The population of each time of day, as text. The asset number is the
+    # one of the last time of day.
+    tod_texts = [
+        util.format_numbers(
+            (population * numpy.array(ratios, dtype=numpy.float64)).tolist(),
+            POPULATION_DECIMALS
+        )
+        for _, ratios in tods
+    ]
+    template = _nrml_asset_template(
+        pop='%s', occ=''.join(OCCUPANCY_FMT % ('%s', tod) for tod, _ in tods)
+    )
+    return ''.join([
+        template % args
+        for args in zip(grid_ids, building_types, tod_texts[-1],
+                        building_types, lons, lats, *tod_texts)
+    ])
 
 
 def _bldg_csv_subnat_generator(exposure_data):
@@ -394,14 +1248,15 @@ def _bldg_csv_subnat_generator(exposure_data):
     yield copyright
     yield BLDG_SUBNAT_CSV_HEADER
 
+    pop_fmt, coord_fmt = _number_formats()
+    row_fmt = '%%s,%s,%%s,%s,%s,%%s,%%s,%%s\n' % (pop_fmt, coord_fmt,
+                                                  coord_fmt)
     for (grid_id, lon, lat, pop_value, country_id, iso,
              study_region_id, building_type,
              dwelling_fraction) in exposure_data:
         calc_pop_value = pop_value * dwelling_fraction
-        row = [iso, calc_pop_value, grid_id, lon, lat, study_region_id,
-               country_id, building_type]
-        row = [str(x) for x in row]
-        yield '%s\n' % ','.join(row)
+        yield row_fmt % (iso, calc_pop_value, grid_id, lon, lat,
+                         study_region_id, country_id, building_type)
 
 
 def _bldg_nrml_subnat_generator(exposure_data):
@@ -414,23 +1269,52 @@ def _bldg_nrml_subnat_generator(exposure_data):
     yield copyright
     yield NRML_HEADER % dict(cat='buildings')
 
+    asset_fmt = _nrml_asset_template()
     for (grid_id, lon, lat, pop_value, country_id, iso,
              study_region_id, building_type,
              dwelling_fraction) in exposure_data:
         calc_pop_value = pop_value * dwelling_fraction
-
-        asset = NRML_ASSET_FMT % dict(
-            gml_id='%s_%s' % (grid_id, building_type),
-            lon=lon,
-            lat=lat,
-            pop=calc_pop_value,
-            tax=building_type,
-        )
-        yield asset
+        yield asset_fmt % (grid_id, building_type, calc_pop_value,
+                           building_type, lon, lat)
     # finalize the document:
     yield NRML_FOOTER
 
 
+def _bldg_csv_aggregate_generator(exposure_data):
+    """
+    Helper function for generating aggregated CSV data for building exposure.
+    """
+    copyright = copyright_csv(COPYRIGHT_HEADER)
+    yield copyright
+    yield BLDG_AGGREGATE_CSV_HEADER
+
+    pop_fmt, coord_fmt = _number_formats()
+    row_fmt = '%%s,%%s,%%s,%s,%s,%s,%%s\n' % (pop_fmt, coord_fmt, coord_fmt)
+    for (admin_id, iso, building_type, population, lon, lat,
+             grid_points) in exposure_data:
+        yield row_fmt % (iso, admin_id, building_type, population, lon, lat,
+                         grid_points)
+
+
+def _bldg_nrml_aggregate_generator(exposure_data):
+    """
+    Helper function for generating aggregated NRML data for building
+    exposure. Each asset is located at the population-weighted centre of its
+    region.
+    """
+    yield XML_HEADER
+    copyright = copyright_nrml(COPYRIGHT_HEADER)
+    yield copyright
+    yield NRML_HEADER % dict(cat='buildings')
+
+    asset_fmt = _nrml_asset_template()
+    for (admin_id, iso, building_type, population, lon, lat,
+             grid_points) in exposure_data:
+        yield asset_fmt % (admin_id, building_type, population,
+                           building_type, lon, lat)
+    yield NRML_FOOTER
+
+
 def _pop_csv_generator(exposure_data):
     """
     Helper function for generating CSV data for population exposure.
@@ -438,10 +1322,10 @@ def _pop_csv_generator(exposure_data):
     copyright = copyright_csv(COPYRIGHT_HEADER)
     yield copyright
     yield POP_CSV_HEADER
+    pop_fmt, coord_fmt = _number_formats()
+    row_fmt = '%%s,%s,%%s,%s,%s\n' % (pop_fmt, coord_fmt, coord_fmt)
     for grid_id, lon, lat, pop_value, iso in exposure_data:
-        row = [iso, pop_value, grid_id, lon, lat]
-        row = [str(x) for x in row]
-        yield '%s\n' % ','.join(row)
+        yield row_fmt % (iso, pop_value, grid_id, lon, lat)
 
 
 def _pop_nrml_generator(exposure_data):
@@ -453,15 +1337,9 @@ def _pop_nrml_generator(exposure_data):
     yield copyright
     yield NRML_HEADER % dict(cat='population')
 
+    asset_fmt = _nrml_asset_template(gml_id='%s')
     for grid_id, lon, lat, pop_value, iso in exposure_data:
-        asset = NRML_ASSET_FMT % dict(
-            gml_id=grid_id,
-            lon=lon,
-            lat=lat,
-            pop=pop_value,
-            tax='',
-        )
-        yield asset
+        yield asset_fmt % (grid_id, pop_value, '', lon, lat)
     yield NRML_FOOTER
 
 
@@ -473,34 +1351,50 @@ def _stream_building_exposure(request, output_type):
     :param request:
         A :class:`django.http.request.HttpRequest` object.
     :param str output_type:
-        A string indicating the desired output type. Valid values are 'csv'
-        and 'nrml' (XML).
+        A string indicating the desired output type. Valid values are 'csv',
+        'nrml' (XML) and 'npz' (NumPy arrays, see :mod:`exposure.columnar`).
     """
+    if request.GET.get('aggregate'):
+        for text in _stream_aggregated_exposure(request, output_type):
+            yield text
+        return
+
     # possible values are 'res', 'non-res', or 'both'
     res_select = request.GET['residential']
     tod_select = request.GET['timeOfDay']
     admin_select = request.GET['adminLevel']
-    lng1 = request.GET['lng1']
-    lat1 = request.GET['lat1']
-    lng2 = request.GET['lng2']
-    lat2 = request.GET['lat2']
-
-    if res_select == 'res':
-        occupancy = [0]
-    elif res_select == 'non-res':
-        occupancy = [1]
-    elif res_select == 'both':
-        occupancy = [0, 1]
-    else:
-        msg = ("Invalid 'residential' selection: '%s'."
-               " Expected 'res', 'non-res', or 'both'."
-               % res_select)
-        raise ValueError(msg)
+    lng1 = request.GET.get('lng1')
+    lat1 = request.GET.get('lat1')
+    lng2 = request.GET.get('lng2')
+    lat2 = request.GET.get('lat2')
+
+    occupancy = _get_occupancy(res_select)
+    taxonomy = _get_taxonomy(request.GET)
+    area = _get_export_area(request.GET)
+    # Unfiltered exports keep the tile cache keys they had before taxonomy
+    # filters.
+    taxonomy_args = () if taxonomy is None else (taxonomy, )
+    # The tile cache and the parallel queries merge rows in grid point id
+    # order: spatially ordered exports run a single query.
+    order = _get_export_order(request.GET)
 
     if admin_select == 'admin0':
         # National
-        exposure_data = util._get_national_exposure(lng1, lat1, lng2, lat2,
-                                                    tod_select, occupancy)
+        if order == 'spatial':
+            exposure_data = util._get_national_exposure(
+                lng1, lat1, lng2, lat2, tod_select, occupancy,
+                taxonomy=taxonomy, area=area, order=order
+            )
+        elif area is None:
+            exposure_data = tilecache.get_exposure(
+                util._get_national_exposure, lng1, lat1, lng2, lat2,
+                tod_select, occupancy, *taxonomy_args
+            )
+        else:
+            exposure_data = util._get_national_exposure(
+                None, None, None, None, tod_select, occupancy,
+                taxonomy=taxonomy, area=area
+            )
 
         if output_type == 'csv':
             for text in _bldg_csv_admin0_generator(exposure_data):
@@ -508,11 +1402,27 @@ def _stream_building_exposure(request, output_type):
         elif output_type == 'nrml':
             for text in _bldg_nrml_admin0_generator(exposure_data):
                 yield text
+        elif output_type == 'npz':
+            for text in columnar.bldg_admin0_generator(exposure_data):
+                yield text
 
     elif admin_select in ('admin1', 'admin2', 'admin3'):
         # Subnational
-        exposure_data = util._get_subnational_exposure(lng1, lat1, lng2, lat2,
-                                                       occupancy, admin_select)
+        if order == 'spatial':
+            exposure_data = util._get_subnational_exposure(
+                lng1, lat1, lng2, lat2, occupancy, admin_select,
+                taxonomy=taxonomy, area=area, order=order
+            )
+        elif area is None:
+            exposure_data = tilecache.get_exposure(
+                util._get_subnational_exposure, lng1, lat1, lng2, lat2,
+                occupancy, admin_select, *taxonomy_args
+            )
+        else:
+            exposure_data = util._get_subnational_exposure(
+                None, None, None, None, occupancy, admin_select,
+                taxonomy=taxonomy, area=area
+            )
 
         if output_type == 'csv':
             for text in _bldg_csv_subnat_generator(exposure_data):
@@ -521,6 +1431,10 @@ def _stream_building_exposure(request, output_type):
         elif output_type == 'nrml':
             for text in _bldg_nrml_subnat_generator(exposure_data):
                 yield text
+
+        elif output_type == 'npz':
+            for text in columnar.bldg_subnat_generator(exposure_data):
+                yield text
     else:
         msg = (
             "Invalid 'adminLevel' selection: '%s'."
@@ -530,6 +1444,46 @@ def _stream_building_exposure(request, output_type):
         raise ValueError(msg)
 
 
+def _stream_aggregated_exposure(request, output_type):
+    """
+    Stream building exposure data summed by region and building type (see
+    :func:`exposure.util._get_aggregated_exposure`), for the admin level
+    given in the 'aggregate' parameter.
+
+    :param request:
+        A :class:`django.http.request.HttpRequest` object.
+    :param str output_type:
+        'csv' or 'nrml'.
+    """
+    aggregate = request.GET['aggregate']
+    if aggregate not in ('admin1', 'admin2', 'admin3'):
+        msg = (
+            "Invalid 'aggregate' selection: '%s'."
+            " Expected 'admin1', 'admin2', or 'admin3'."
+            % aggregate
+        )
+        raise ValueError(msg)
+    if output_type == 'csv':
+        generator = _bldg_csv_aggregate_generator
+    elif output_type == 'nrml':
+        generator = _bldg_nrml_aggregate_generator
+    else:
+        raise ValueError("Aggregated exports are only available as 'csv' "
+                         "or 'nrml'")
+
+    occupancy = _get_occupancy(request.GET['residential'])
+    area = _get_export_area(request.GET)
+    # Sums can't be composed from tiles or sub-boxes, so this is always a
+    # single query.
+    exposure_data = util._get_aggregated_exposure(
+        request.GET.get('lng1'), request.GET.get('lat1'),
+        request.GET.get('lng2'), request.GET.get('lat2'),
+        occupancy, aggregate, taxonomy=_get_taxonomy(request.GET), area=area
+    )
+    for text in generator(exposure_data):
+        yield text
+
+
 def _stream_population_exposure(request, output_type):
     """
     Stream population exposure data from the database into a file of the
@@ -538,15 +1492,27 @@ def _stream_population_exposure(request, output_type):
     :param request:
         A :class:`django.http.request.HttpRequest` object.
     :param str output_type:
-        A string indicating the desired output type. Valid values are 'csv'
-        and 'nrml' (XML).
+        A string indicating the desired output type. Valid values are 'csv',
+        'nrml' (XML) and 'npz' (NumPy arrays, see :mod:`exposure.columnar`).
     """
-    lng1 = request.GET['lng1']
-    lat1 = request.GET['lat1']
-    lng2 = request.GET['lng2']
-    lat2 = request.GET['lat2']
-
-    exposure_data = util._get_population_exposure(lng1, lat1, lng2, lat2)
+    area = _get_export_area(request.GET)
+    index = gridindex.get_index()
+    if index is not None and gridindex.supports(area):
+        # No database query at all.
+        exposure_data = index.get_population_exposure(
+            request.GET.get('lng1'), request.GET.get('lat1'),
+            request.GET.get('lng2'), request.GET.get('lat2'), area=area
+        )
+    elif area is None:
+        exposure_data = tilecache.get_exposure(
+            util._get_population_exposure, request.GET['lng1'],
+            request.GET['lat1'], request.GET['lng2'], request.GET['lat2']
+        )
+    else:
+        # Polygons and regions are neither cached nor split, and are exported
+        # with a single query.
+        exposure_data = util._get_population_exposure(None, None, None, None,
+                                                      area=area)
 
     if output_type == 'csv':
         for text in _pop_csv_generator(exposure_data):
@@ -556,6 +1522,10 @@ def _stream_population_exposure(request, output_type):
         for text in _pop_nrml_generator(exposure_data):
             yield text
 
+    elif output_type == 'npz':
+        for text in columnar.pop_generator(exposure_data):
+            yield text
+
 
 def copyright_csv(cr_text):
     lines = cr_text.split('\n')
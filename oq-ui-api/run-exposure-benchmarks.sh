@@ -0,0 +1,19 @@
+#!/bin/bash
+
+# The benchmarks need the same environment as the tests (see
+# `run-exposure-tests.sh`), but no database connection: all of the export
+# data is synthetic, unless `--bbox` is given.
+#
+# Arguments are passed through, for example:
+#
+# $ ./run-exposure-benchmarks.sh coalesce --rows 100000
+# $ ./run-exposure-benchmarks.sh parallel --workers 8 --bbox 88,21,92,26
+# $ ./run-exposure-benchmarks.sh precision --population-decimals 2
+#
+# To use the serializer benchmarks as a regression gate, save a baseline on
+# the reference revision, then compare against it:
+#
+# $ ./run-exposure-benchmarks.sh serializers --save /tmp/baseline.json
+# $ ./run-exposure-benchmarks.sh serializers --baseline /tmp/baseline.json
+
+cd geonode && python -m exposure.benchmark "$@"
@@ -22,6 +22,21 @@ var objToUrlParams = function(obj) {
     return url;
 };
 
+/* Read a cookie value; used to send the Django CSRF token with POSTs. */
+var getCookie = function(name) {
+    var cookies = document.cookie ? document.cookie.split(';') : [];
+    for (var i = 0; i < cookies.length; i++) {
+        var cookie = $.trim(cookies[i]);
+        if (cookie.substring(0, name.length + 1) == (name + '=')) {
+            return decodeURIComponent(cookie.substring(name.length + 1));
+        }
+    }
+    return null;
+};
+
+/* Interval (in ms) at which the status of a background export is polled. */
+var EXPORT_JOB_POLL_INTERVAL = 5000;
+
 var startExposureApp = function() {
     drawnItems = new L.LayerGroup();
     // draw tool
@@ -209,6 +224,102 @@ var startExposureApp = function() {
         $("#error-dialog").dialog(options);
     };
 
+    /*
+     * Poll the status of a background export job until it is complete, then
+     * download the result.
+     */
+    var pollExportJob = function(jobId) {
+        $.ajax({
+            type: 'get',
+            data: {job_id: jobId},
+            dataType: 'json',
+            url: '/exposure/export_job/status/',
+            error: function(response, error) {
+                showErrorDialog('The status of the export could not be found.');
+            },
+            success: function(data, textStatus, jqXHR) {
+                if (data.status == 'complete') {
+                    window.location.href = (
+                        '/exposure/export_job/download/?job_id=' + jobId
+                    );
+                }
+                else if (data.status == 'failed') {
+                    showErrorDialog('The export failed: ' + data.error);
+                }
+                else {
+                    showExportJobProgress(data);
+                    setTimeout(function() { pollExportJob(jobId); },
+                               EXPORT_JOB_POLL_INTERVAL);
+                }
+            },
+        });
+    };
+
+    /*
+     * Show the number of rows exported so far by a running export job, out
+     * of the estimated number of rows, in the dialog of submitExportJob.
+     */
+    var showExportJobProgress = function(data) {
+        if (data.status != 'running' || !data.rows) {
+            return;
+        }
+        var progress = 'Exported rows: ' + data.rows;
+        if (data.estimated_rows) {
+            // The estimate is an upper bound.
+            var percent = Math.min(99, Math.floor(
+                100 * data.rows / data.estimated_rows
+            ));
+            progress += ' of about ' + data.estimated_rows + ' (' + percent
+                + '%)';
+        }
+        $("#export-job-progress").html(progress + '.');
+    };
+
+    /*
+     * Format a size in bytes for display, e.g. 1536 -> '1.5 KB'.
+     */
+    var formatBytes = function(bytes) {
+        var units = ['bytes', 'KB', 'MB', 'GB', 'TB'];
+        var i = 0;
+        while (bytes >= 1024 && i < units.length - 1) {
+            bytes /= 1024;
+            i++;
+        }
+        return (i == 0 ? bytes : bytes.toFixed(1)) + ' ' + units[i];
+    };
+
+    /*
+     * Run an export which is too large to be downloaded directly as a
+     * background job. The download starts when the job is complete.
+     */
+    var submitExportJob = function(exportType, params, estimate) {
+        var data = $.extend({exportType: exportType}, params);
+        $.ajax({
+            type: 'post',
+            data: data,
+            url: '/exposure/export_job/submit/',
+            headers: {'X-CSRFToken': getCookie('csrftoken')},
+            error: function(response, error) {
+                showErrorDialog(response.responseText,
+                                {height: 175, width: 420});
+            },
+            success: function(data, textStatus, jqXHR) {
+                var msg = (
+                    'The selected area is large, so the export is running in '
+                    + 'the background. The download will start as soon as it '
+                    + 'is ready; please keep this page open.'
+                );
+                if (estimate && estimate.bytes) {
+                    msg += ('<br />Expected size (uncompressed): '
+                            + formatBytes(estimate.bytes) + '.');
+                }
+                msg += '<br /><span id="export-job-progress"></span>';
+                showErrorDialog(msg, {title: 'Export started'});
+                pollExportJob(data.job_id);
+            },
+        });
+    };
+
     var selectArea = function(topLeft, bottomRight) {
         latlonTopLeft = topLeft;
         latlonBottomRight = bottomRight;
@@ -369,7 +480,8 @@ var startExposureApp = function() {
                 // Otherwise, display an error.
                 $.ajax({
                     type: 'get',
-                    data: params,
+                    data: $.extend({exportType: 'building'}, params),
+                    dataType: 'json',
                     url: '/exposure/validate_export/',
                     error: function(response, error){
                         if (response.status == 403) {
@@ -380,9 +492,14 @@ var startExposureApp = function() {
                         }
                     },
                     success: function(data, textStatus, jqXHR) {
-                        var url = '/exposure/export_building?';
-                        url += objToUrlParams(params);
-                        window.location.href = url;
+                        if (jqXHR.status == 202) {
+                            submitExportJob('building', params, data);
+                        }
+                        else {
+                            var url = '/exposure/export_building?';
+                            url += objToUrlParams(params);
+                            window.location.href = url;
+                        }
                     },
                     complete: function() {
                         $("#download-button-spinner").css("display", "none");
@@ -436,7 +553,8 @@ var startExposureApp = function() {
                 // Otherwise, display an error.
                 $.ajax({
                     type: 'get',
-                    data: params,
+                    data: $.extend({exportType: 'population'}, params),
+                    dataType: 'json',
                     url: '/exposure/validate_export/',
                     error: function(response, error){
                         if (response.status == 403) {
@@ -451,6 +569,9 @@ var startExposureApp = function() {
                             var msg = 'No exposure data available in the selected area.';
                             showErrorDialog(msg, {title: 'Nothing here'});
                         }
+                        else if (jqXHR.status == 202) {
+                            submitExportJob('population', params, data);
+                        }
                         else {
                             var url = '/exposure/export_population?';
                             url += objToUrlParams(params);